@@ -1,53 +1,118 @@
 import os
-import re
-import ast
+import time
+import signal
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, Iterable, Optional
 from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from manual_retrieval.tree_retrieval import manual_retrieval
+from manual_retrieval.tree_retrieval import manual_retrieval, start_manual_retrievers, manual_retriever_stats
+from courses import COURSE_PROMPTS, load_course_configs, get_course_config
+from scheduler import run_stages
+from embedding_cache import get_embedding_cache
+from local_index import preload_local_indexes
+from ocr_cache import get_ocr_cache
+from assignment_generation import prepare_assignment_response
+from semantic_cache import get_semantic_cache
+from job_queue import get_job_queue
+from idempotency import get_idempotency_store, request_key
+from question_answering import run_sync, check_question, reload_configs, answer_question, publish_answer
 
 from utils import (
     ocr_process_input,
     process_conversation_search,
     retrieve_qa,
     retrieve_docs_hybrid,
-    retrieve_docs_manual,
+    embed_text,
     generate,
+    generate_stream,
+    stream_to_ed,
     log_blob,
     log_local,
     reply_to_ed,
-    delete_comment,
-    xml_to_markdown
+    delete_comment
 )
 
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+
+class SyncBackend:
+    """
+    The I/O of the question pipeline (question_answering) with the blocking clients of utils.py;
+    retrieval stages run in the thread pool of scheduler.run_stages.
+    """
+
+    async def ocr_process_input(self, **kwargs):
+        return ocr_process_input(**kwargs)
+
+    async def process_conversation_search(self, **kwargs):
+        return process_conversation_search(**kwargs)
+
+    async def embed_text(self, text: str, model_name: str):
+        return embed_text(text, model_name=model_name)
+
+    def retrieve_qa(self, **kwargs):
+        return retrieve_qa(**kwargs)
+
+    def retrieve_docs_hybrid(self, **kwargs):
+        return retrieve_docs_hybrid(**kwargs)
+
+    def manual_retrieval(self, question: str, course: str, **kwargs):
+        return manual_retrieval(question, course, **kwargs)
+
+    async def run_stages(self, stages):
+        return run_stages(stages)
+
+    async def prepare_assignment_response(self, **kwargs):
+        return prepare_assignment_response(**kwargs)
+
+    async def generate(self, prompt):
+        return generate(prompt=prompt)
+
+    async def stream_to_ed(self, course: str, id: str, prompt, min_chars: int, edit_interval: float):
+        return stream_to_ed(course=course, id=id, chunks=generate_stream(prompt=prompt), min_chars=min_chars,
+                            edit_interval=edit_interval)
+
+    async def log_blob(self, log_dict: Dict[str, Any], blob_name: str, container_name: str):
+        log_blob(log_dict, blob_name, container_name)
+
+    async def log_local(self, log_dict: Dict[str, Any], path: str):
+        log_local(log_dict, path)
+
+    async def reply_to_ed(self, **kwargs):
+        return reply_to_ed(**kwargs)
+
+    async def delete_comments(self, course: str, ids: Iterable[str]):
+        for id in ids:
+            delete_comment(course=course, id=id)
+
+
+backend = SyncBackend()
 app = Flask(__name__)
 load_dotenv('./keys.env')
+load_course_configs(COURSE_PROMPTS)
+preload_local_indexes()
+start_manual_retrievers(COURSE_PROMPTS)
+
+
+def handle_sighup(signum, frame):
+    try:
+        reload_configs()
+    except Exception as e:
+        logger.error(f"Error reloading course configs: {e}")
+
+
+if hasattr(signal, 'SIGHUP'):
+    try:
+        signal.signal(signal.SIGHUP, handle_sighup)
+    except ValueError:  # not imported from the main thread
+        pass
 
-def load_course_config(course: str) -> None:
-    global prompts
-    if 'ds100' in course:
-        import prompts.ds100_multiturn_prompts as prompts
-        course = 'ds100'
-    elif 'ds8' in course:
-        import prompts.ds8_multiturn_prompts as prompts
-        course = 'ds8'
-    elif 'cs61a' in course:
-        import prompts.cs61a_multiturn_prompts as prompts
-        course = 'cs61a'
-    else:
-        raise ValueError(f"Unsupported course: {course}")
-    load_dotenv(f'configs/{course}.env', override=True)
-
-def get_env_list(key: str) -> list:
-    return ast.literal_eval(os.getenv(key, '[]'))
 
 @app.route('/', methods=['POST'])
 def edison():
+    request_start = time.monotonic()
     if request.headers.get('Authorization') != os.getenv('API_KEY'):
         logger.warning('Unauthorized access attempt')
         return jsonify(error='Unauthorized'), 401
@@ -55,167 +120,33 @@ def edison():
     input_dict = request.json or {}
     logger.info('Received input: %s', input_dict)
 
-    course = input_dict.get('course')
-    if not course:
-        logger.error('No course specified in input')
-        return jsonify(error='Bad Request: No course specified'), 400
-    logger.info('Course: %s', course)
-    load_course_config(course)
-
-    question_category = input_dict.get('category')
-    if not question_category:
-        logger.error('No category specified in input')
-        return jsonify(error='Bad Request: No category specified'), 400
-    logger.info('Question category: %s', question_category)
-
-    assignment_categories = get_env_list('ASSIGNMENT_CATEGORIES')
-    content_categories = get_env_list('CONTENT_CATEGORIES')
-    logistics_categories = get_env_list('LOGISTICS_CATEGORIES')
-    worksheet_categories = get_env_list('WORKSHEET_CATEGORIES')
-
-
-    # Conversation processing (OCR)
-    fields = ["thread_title", "category", "subcategory", "subsubcategory"]
-    metadata = [input_dict.get(f, "") for f in fields]
-    metadata_str = " | ".join(f"{f}: {val}" for f, val in zip(fields, metadata) if val)
-    logger.info("Metadata string: %s", metadata_str)
-    processed_conversation = ocr_process_input(
-        metadata=metadata_str,
-        conversation_history=input_dict.get("conversation_history")
+    error = check_question(input_dict)
+    if error:
+        logger.error('Bad request: %s', error)
+        return jsonify(error=f'Bad Request: {error}'), 400
+
+    # Answer in a queued job unless the caller waits for the outputs (sync) or the queue is off
+    if job_queue is None or input_dict.get('sync') == 'true':
+        return jsonify(answer_question_once(input_dict, request_start))
+    config = get_course_config(input_dict['course'])
+    priority = config.job_priorities.get(input_dict['category'], 0)
+    job_id, duplicate = job_queue.enqueue_once('edison', input_dict, key=request_key(input_dict), priority=priority)
+    if duplicate:
+        logger.info('Duplicate of job %d', job_id)
+        return jsonify(job_id=job_id, status=job_queue.get(job_id)['status'], duplicate=True), 202
+    logger.info('Queued job %d (priority %d)', job_id, priority)
+    return jsonify(job_id=job_id, status='queued'), 202
+
+
+def answer_question_once(input_dict: Dict[str, Any], request_start: Optional[float] = None) -> Dict[str, Any]:
+    """
+    question_answering.answer_question, run once per idempotency key: a duplicate (Ed retry,
+    repeated TA trigger) shares the outputs of the running or recent request and posts nothing.
+    """
+    output_dict, duplicate = get_idempotency_store().run(
+        request_key(input_dict), lambda: run_sync(answer_question(backend, input_dict, request_start))
     )
-    # processed_conversation = ocr_process_input(
-    #     thread_title=input_dict.get('thread_title'),
-    #     conversation_history=input_dict.get('conversation_history'),
-    # )
-    logger.info('Processed conversation: %s', processed_conversation)
-
-    processed_conversation_search = process_conversation_search(
-        processed_conversation=processed_conversation,
-        prompt_summarize=prompts.get_summarize_conversation_prompt(processed_conversation[:-1])
-    )
-    logger.info('Processed (summarized) conversation for search: %s', processed_conversation_search)
-
-    # QA retrieval
-    top_k = int(os.getenv('QA_TOP_K', '3'))
-    retrieved_qa_pairs = retrieve_qa(conversation=processed_conversation_search, top_k=top_k)
-    logger.info('Retrieved QA pairs: %s', retrieved_qa_pairs)
-
-    # Hybrid document retrieval
-    retrieved_docs_hybrid = 'none'
-    if question_category in content_categories:
-        retrieved_docs_hybrid = retrieve_docs_hybrid(
-            text=processed_conversation_search,
-            index_name=os.getenv('CONTENT_INDEX_NAME'),
-            top_k=int(os.getenv('CONTENT_INDEX_TOP_K', '1')),
-            semantic_reranking=True
-        )
-    elif question_category in logistics_categories:
-        retrieved_docs_hybrid = retrieve_docs_hybrid(
-            text=processed_conversation_search,
-            index_name=os.getenv('LOGISTICS_INDEX_NAME'),
-            top_k=int(os.getenv('LOGISTICS_INDEX_TOP_K', '1')),
-            semantic_reranking=False
-        )
-    elif question_category in worksheet_categories:
-        retrieved_docs_hybrid = retrieve_docs_hybrid(
-            text=processed_conversation_search,
-            index_name=os.getenv('WORKSHEET_INDEX_NAME'),
-            top_k=int(os.getenv('WORKSHEET_INDEX_TOP_K', '1')),
-            semantic_reranking=True
-        )
-    logger.info('Retrieved hybrid documents: %s', retrieved_docs_hybrid)
-
-    # Manual document retrieval
-    problem_list_manual = selected_doc_manual = retrieved_docs_manual = 'none'
-    if question_category in (assignment_categories + worksheet_categories):
-    #     question_info = re.sub(r"\n+", " ", f"{question_category} {input_dict.get('subcategory')} {input_dict.get('subsubcategory')} {input_dict.get('thread_title')} \
-    #                            {processed_conversation[-1]['text'] if len(processed_conversation) <= 2 else processed_conversation[0]['text'] + processed_conversation[-1]['text']}")
-    #     problem_list_manual, selected_doc_manual, retrieved_docs_manual = retrieve_docs_manual(
-    #         question_category=question_category,
-    #         category_mapping=ast.literal_eval(os.getenv('CATEGORY_MAPPING', '{}')),
-    #         question_subcategory=input_dict.get('subcategory'),
-    #         subcategory_mapping=ast.literal_eval(os.getenv('SUBCATEGORY_MAPPING', '{}')),
-    #         question_info=question_info,
-    #         get_prompt=prompts.get_choose_problem_path_prompt)
-    #     logger.info('List of problems: %s', problem_list_manual)
-    #     logger.info('Selected manual document: %s', selected_doc_manual)
-        retrieved_docs_manual, gpt_num_called = manual_retrieval(processed_conversation_search)
-        logger.info('Retrieved manual documents: %s', retrieved_docs_manual)
-
-    # Response generation
-    response_0 = response = ''
-    if question_category in assignment_categories:
-        response_0 = generate(
-            prompt=prompts.get_first_assignment_prompt(
-                processed_conversation=processed_conversation,
-                retrieved_qa_pairs=retrieved_qa_pairs,
-                retrieved_docs_manual=retrieved_docs_manual
-            )
-        )
-        logger.info('Initial response (assignment question): %s', response_0)
-        response = generate(
-            prompt=prompts.get_second_assignment_prompt(
-                processed_conversation=processed_conversation,
-                first_answer=response_0
-            )
-        )
-    elif question_category in content_categories:
-        response = generate(
-            prompt=prompts.get_content_prompt(
-                processed_conversation=processed_conversation,
-                retrieved_qa_pairs=retrieved_qa_pairs,
-                retrieved_docs_hybrid=retrieved_docs_hybrid
-            )
-        )
-    elif question_category in logistics_categories:
-        response = generate(
-            prompt=prompts.get_logistics_prompt(
-                processed_conversation=processed_conversation,
-                retrieved_qa_pairs=retrieved_qa_pairs,
-                retrieved_docs_hybrid=retrieved_docs_hybrid
-            )
-        )
-    elif question_category in worksheet_categories:
-        response = generate(
-            prompt=prompts.get_worksheet_prompt(
-                processed_conversation=processed_conversation,
-                retrieved_qa_pairs=retrieved_qa_pairs,
-                retrieved_docs_manual=retrieved_docs_manual,
-                retrieved_docs_hybrid=retrieved_docs_hybrid
-            )
-         )
-    logger.info('Final response: %s', response)
-    
-    # Logging and posting
-    output_dict = {
-        'processed_conversation': processed_conversation,
-        'processed_conversation_search': processed_conversation_search,
-        'retrieved_qa_pairs': retrieved_qa_pairs,
-        'retrieved_docs_hybrid': retrieved_docs_hybrid,
-        'problem_list_manual': problem_list_manual,
-        'selected_doc_manual': selected_doc_manual,
-        'retrieved_docs_manual': retrieved_docs_manual,
-        'response_0': response_0,
-        'response': response
-    }
-    
-    prod = input_dict['prod'] == 'true'
-    version = os.getenv('EDISON_VERSION')
-    experiment_name = input_dict.get('experiment_name', 'test')
-
-    if input_dict.get('log_blob') == 'true':
-        log_path_blob = f"logs/{'production' if prod else 'test'}/{version if prod else experiment_name}.jsonl"
-        log_blob({"inputs": input_dict, "outputs": output_dict}, log_path_blob)
-
-    if input_dict.get('log_local') == 'true':
-        log_path_local = f"logs/{course}/{'production' if prod else 'test'}/{version if prod else experiment_name}.jsonl"
-        log_local({"inputs": input_dict, "outputs": output_dict}, log_path_local)
-
-    if input_dict.get('post_comment') == 'true':
-        reply_to_ed(course=course, id=input_dict.get('comment_id'), text='edison'+response, post_answer=False, private=True)
-    
-    return jsonify(output_dict)
-
+    return {**output_dict, 'duplicate': True} if duplicate else output_dict
 
 
 @app.route('/public', methods=['POST'])
@@ -226,31 +157,44 @@ def public_edison():
     
     input_dict = request.json or {}
     logger.info('Received input: %s', input_dict)
-    
-    course = input_dict.get('course')
-    load_course_config(course)
-    version = os.getenv('EDISON_VERSION')
-    
-    question_id = input_dict.get('question_id', '')
-    input_dict['text'] = xml_to_markdown(input_dict.get('text', ''))
-    post_answer = "thread" in question_id
-
-    delete_comment(course=course, id=input_dict.get('curr_comment_id'))
-    delete_comment(course=course, id=input_dict.get('parent_comment_id'))
-    input_dict.pop('curr_comment_id', None)
-    input_dict.pop('parent_comment_id', None)
-    
-    if input_dict.get('log_blob') == 'true':
-        log_path_blob = f"logs/production/{version}_final.jsonl"
-        log_blob(input_dict, log_path_blob)
-    
-    reply_to_ed(
-        course=course,
-        id=question_id.split('_')[-1],
-        text=f"publicedison{'answer' if post_answer else 'comment'}{input_dict['text']}",
-        post_answer=post_answer,
-        private=False)
-    return jsonify(message='Success')
+    return jsonify(run_sync(publish_answer(backend, input_dict)))
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    if request.headers.get('Authorization') != os.getenv('API_KEY'):
+        logger.warning('Unauthorized access attempt')
+        return jsonify(error='Unauthorized'), 401
+    return jsonify(ocr_cache=get_ocr_cache().stats(), semantic_cache=get_semantic_cache().stats(),
+                   embedding_cache=get_embedding_cache().stats(), tree_stores=manual_retriever_stats(),
+                   job_queue=job_queue.stats() if job_queue is not None else None,
+                   idempotency=get_idempotency_store().stats())
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def job_status(job_id: int):
+    if request.headers.get('Authorization') != os.getenv('API_KEY'):
+        logger.warning('Unauthorized access attempt')
+        return jsonify(error='Unauthorized'), 401
+    job = job_queue.get(job_id) if job_queue is not None else None
+    if job is None:
+        return jsonify(error='Not Found'), 404
+    return jsonify(job)
+
+@app.route('/reload', methods=['POST'])
+def reload():
+    if request.headers.get('Authorization') != os.getenv('API_KEY'):
+        logger.warning('Unauthorized access attempt')
+        return jsonify(error='Unauthorized'), 401
+    try:
+        courses = reload_configs()
+    except Exception as e:
+        logger.exception('Error reloading course configs: %s', e)
+        return jsonify(error=f'Error reloading course configs: {e}'), 500
+    return jsonify(message='Success', courses=courses)
+
+# Questions are answered by a pool of job workers draining a durable queue (JOB_QUEUE=false answers them inline)
+job_queue = get_job_queue() if os.getenv('JOB_QUEUE', 'true') == 'true' else None
+if job_queue is not None:
+    job_queue.start({'edison': answer_question_once})
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,232 @@
+import os
+import json
+import signal
+import asyncio
+import logging
+from typing import Dict, Any, Iterable
+
+from dotenv import load_dotenv
+
+from courses import COURSE_PROMPTS, load_course_configs
+from manual_retrieval.tree_retrieval import start_manual_retrievers, manual_retriever_stats
+from utils import log_local
+from scheduler import run_stages_async
+from embedding_cache import get_embedding_cache
+from local_index import preload_local_indexes
+from ocr_cache import get_ocr_cache
+from assignment_generation import prepare_assignment_response_async
+from semantic_cache import get_semantic_cache
+from idempotency import get_idempotency_store, request_key
+from question_answering import check_question, reload_configs, answer_question, publish_answer
+from async_utils import (
+    create_async_client,
+    ocr_process_input_async,
+    process_conversation_search_async,
+    retrieve_qa_async,
+    retrieve_docs_hybrid_async,
+    embed_text_async,
+    manual_retrieval_async,
+    generate_async,
+    generate_stream_async,
+    stream_to_ed_async,
+    log_blob_async,
+    reply_to_ed_async,
+    delete_comment_async
+)
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+load_dotenv('./keys.env')
+
+
+class BadRequest(Exception):
+    pass
+
+
+class AsyncBackend:
+    """
+    The I/O of the question pipeline (question_answering) over the shared httpx client; retrieval
+    stages run as tasks of scheduler.run_stages_async.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def ocr_process_input(self, **kwargs):
+        return await ocr_process_input_async(self.client, **kwargs)
+
+    async def process_conversation_search(self, **kwargs):
+        return await process_conversation_search_async(self.client, **kwargs)
+
+    async def embed_text(self, text: str, model_name: str):
+        return await embed_text_async(self.client, text, model_name=model_name)
+
+    def retrieve_qa(self, **kwargs):
+        return retrieve_qa_async(self.client, **kwargs)
+
+    def retrieve_docs_hybrid(self, **kwargs):
+        return retrieve_docs_hybrid_async(self.client, **kwargs)
+
+    def manual_retrieval(self, question: str, course: str, **kwargs):
+        return manual_retrieval_async(question, course, **kwargs)
+
+    async def run_stages(self, stages):
+        return await run_stages_async(stages)
+
+    async def prepare_assignment_response(self, **kwargs):
+        return await prepare_assignment_response_async(self.client, **kwargs)
+
+    async def generate(self, prompt):
+        return await generate_async(self.client, prompt=prompt)
+
+    async def stream_to_ed(self, course: str, id: str, prompt, min_chars: int, edit_interval: float):
+        return await stream_to_ed_async(self.client, course=course, id=id,
+                                        chunks=generate_stream_async(self.client, prompt=prompt),
+                                        min_chars=min_chars, edit_interval=edit_interval)
+
+    async def log_blob(self, log_dict: Dict[str, Any], blob_name: str, container_name: str):
+        await log_blob_async(log_dict, blob_name, container_name)
+
+    async def log_local(self, log_dict: Dict[str, Any], path: str):
+        await asyncio.to_thread(log_local, log_dict, path)
+
+    async def reply_to_ed(self, **kwargs):
+        return await reply_to_ed_async(self.client, **kwargs)
+
+    async def delete_comments(self, course: str, ids: Iterable[str]):
+        await asyncio.gather(*(delete_comment_async(self.client, course=course, id=id) for id in ids))
+
+
+async def edison_pipeline(client, input_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Async variant of the `/` route of app.py (answered inline): answer a forum question end to
+    end, once per idempotency key (see app.answer_question_once).
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        input_dict (Dict[str, Any]): The request sent by the Ed bot.
+
+    Returns:
+        Dict[str, Any]: The intermediate and final outputs of the pipeline.
+    """
+    error = check_question(input_dict)
+    if error:
+        raise BadRequest(error)
+    output_dict, duplicate = await get_idempotency_store().run_async(
+        request_key(input_dict), lambda: answer_question(AsyncBackend(client), input_dict)
+    )
+    return {**output_dict, 'duplicate': True} if duplicate else output_dict
+
+
+async def public_edison_pipeline(client, input_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Async variant of the `/public` route of app.py: publish a TA-approved answer.
+    """
+    return await publish_answer(AsyncBackend(client), input_dict)
+
+
+async def stats(client, input_dict: Dict[str, Any]) -> Dict[str, Any]:
+    return {'ocr_cache': get_ocr_cache().stats(), 'semantic_cache': get_semantic_cache().stats(),
+            'embedding_cache': get_embedding_cache().stats(), 'tree_stores': manual_retriever_stats(),
+            'idempotency': get_idempotency_store().stats()}
+
+
+async def reload(client, input_dict: Dict[str, Any]) -> Dict[str, Any]:
+    return {'message': 'Success', 'courses': await asyncio.to_thread(reload_configs)}
+
+
+def handle_sighup() -> None:
+    async def reload_in_background():
+        try:
+            await asyncio.to_thread(reload_configs)
+        except Exception as e:
+            logger.error(f"Error reloading course configs: {e}")
+
+    asyncio.ensure_future(reload_in_background())
+
+
+ROUTES = {
+    ('POST', '/'): edison_pipeline,
+    ('POST', '/public'): public_edison_pipeline,
+    ('GET', '/stats'): stats,
+    ('POST', '/reload'): reload,
+}
+
+
+async def read_body(receive) -> bytes:
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def send_json(send, status: int, payload: Dict[str, Any]) -> None:
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def app(scope, receive, send):
+    """
+    ASGI entry point serving the same routes as app.py, e.g. `uvicorn asgi:app`.
+    One shared keep-alive HTTP client is opened at startup and reused by every request.
+    """
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                load_course_configs(COURSE_PROMPTS)
+                preload_local_indexes()
+                start_manual_retrievers(COURSE_PROMPTS)
+                if hasattr(signal, 'SIGHUP'):
+                    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, handle_sighup)
+                app.client = create_async_client(
+                    max_connections=int(os.getenv('ASYNC_MAX_CONNECTIONS', '200'))
+                )
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await app.client.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    handler = ROUTES.get((scope['method'], scope['path']))
+    if handler is None:
+        await send_json(send, 404, {'error': 'Not Found'})
+        return
+
+    headers = dict(scope['headers'])
+    if headers.get(b'authorization', b'').decode() != os.getenv('API_KEY'):
+        logger.warning('Unauthorized access attempt')
+        await send_json(send, 401, {'error': 'Unauthorized'})
+        return
+
+    try:
+        input_dict = json.loads(await read_body(receive) or b'{}')
+    except json.JSONDecodeError:
+        await send_json(send, 400, {'error': 'Bad Request: Invalid JSON'})
+        return
+    logger.info('Received input: %s', input_dict)
+
+    try:
+        output_dict = await handler(app.client, input_dict)
+    except BadRequest as e:
+        logger.error('Bad request: %s', e)
+        await send_json(send, 400, {'error': f'Bad Request: {e}'})
+        return
+    except Exception as e:
+        logger.exception('Error processing request: %s', e)
+        await send_json(send, 500, {'error': 'Internal Server Error'})
+        return
+    await send_json(send, 200, output_dict)
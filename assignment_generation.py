@@ -0,0 +1,155 @@
+import time
+import logging
+import threading
+from types import ModuleType
+from typing import Dict, List, Optional, Tuple
+
+from utils import generate
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+TWO_PASS = 'two_pass'
+SINGLE_PASS = 'single_pass'
+
+
+class LatencyTracker:
+    """
+    Exponentially weighted moving average of the latency of each generation pass per course.
+    """
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.averages = {}
+        self.lock = threading.Lock()
+
+    def record(self, course: str, stage: str, seconds: float) -> None:
+        with self.lock:
+            previous = self.averages.get((course, stage))
+            self.averages[(course, stage)] = seconds if previous is None else (
+                self.alpha * seconds + (1 - self.alpha) * previous
+            )
+
+    def estimate(self, course: str, stage: str) -> Optional[float]:
+        return self.averages.get((course, stage))
+
+
+latency_tracker = LatencyTracker()
+
+
+def get_single_pass_assignment_prompt(prompts: ModuleType, processed_conversation: str, retrieved_qa_pairs: str,
+                                      retrieved_docs_manual: str) -> List[Dict[str, str]]:
+    """
+    Fold the revision guidelines of the second assignment pass into the first prompt.
+
+    Args:
+        prompts (ModuleType): The prompts module of the course.
+        processed_conversation (str): The processed conversation.
+        retrieved_qa_pairs (str): The retrieved historical QA pairs.
+        retrieved_docs_manual (str): The retrieved assignment documents.
+
+    Returns:
+        List[Dict[str, str]]: A prompt answering the question in one pass.
+    """
+    prompt = prompts.get_first_assignment_prompt(
+        processed_conversation=processed_conversation,
+        retrieved_qa_pairs=retrieved_qa_pairs,
+        retrieved_docs_manual=retrieved_docs_manual
+    )
+    second_system_prompt = prompts.get_second_assignment_prompt(
+        processed_conversation=processed_conversation,
+        first_answer=''
+    )[0]['content']
+    guidelines = second_system_prompt.split(':\n', 1)[-1]
+    prompt[-1] = {**prompt[-1], 'content': f"{prompt[-1]['content']}\n\nYour answer must also follow these guidelines:\n{guidelines}"}
+    return prompt
+
+
+def choose_assignment_mode(course: str, mode: str, latency_budget: Optional[float], elapsed: float) -> str:
+    """
+    Fall back to a single generation pass when two passes would exceed the latency budget.
+
+    Args:
+        course (str): The course identifier.
+        mode (str): The configured generation mode.
+        latency_budget (Optional[float]): The end-to-end latency budget in seconds, if any.
+        elapsed (float): Seconds already spent on the request.
+
+    Returns:
+        str: The generation mode to use for this request.
+    """
+    if mode == SINGLE_PASS or latency_budget is None:
+        return mode
+    first, second = latency_tracker.estimate(course, 'first_pass'), latency_tracker.estimate(course, 'final_pass')
+    if first is not None and second is not None and elapsed + first + second > latency_budget:
+        logger.info('Two passes would take ~%.1fs of the remaining %.1fs budget, using a single pass',
+                    first + second, latency_budget - elapsed)
+        return SINGLE_PASS
+    return mode
+
+
+def prepare_assignment_response(prompts: ModuleType, course: str, processed_conversation: str,
+                                retrieved_qa_pairs: str, retrieved_docs_manual: str, mode: str,
+                                latency_budget: Optional[float],
+                                elapsed: float) -> Tuple[str, List[Dict[str, str]]]:
+    """
+    Run the first assignment pass (unless falling back to a single pass) and return the final prompt.
+
+    Args:
+        prompts (ModuleType): The prompts module of the course.
+        course (str): The course identifier.
+        processed_conversation (str): The processed conversation.
+        retrieved_qa_pairs (str): The retrieved historical QA pairs.
+        retrieved_docs_manual (str): The retrieved assignment documents.
+        mode (str): The ASSIGNMENT_GENERATION_MODE of the course.
+        latency_budget (Optional[float]): The ASSIGNMENT_LATENCY_BUDGET of the course (seconds), if any.
+        elapsed (float): Seconds already spent on the request.
+
+    Returns:
+        Tuple[str, List[Dict[str, str]]]: The first-pass response ('' in single-pass mode) and the final prompt.
+    """
+    mode = choose_assignment_mode(course, mode, latency_budget, elapsed)
+    if mode == SINGLE_PASS:
+        return '', get_single_pass_assignment_prompt(prompts, processed_conversation, retrieved_qa_pairs,
+                                                     retrieved_docs_manual)
+
+    first_prompt = prompts.get_first_assignment_prompt(
+        processed_conversation=processed_conversation,
+        retrieved_qa_pairs=retrieved_qa_pairs,
+        retrieved_docs_manual=retrieved_docs_manual
+    )
+    start = time.monotonic()
+    response_0 = generate(prompt=first_prompt)
+    latency_tracker.record(course, 'first_pass', time.monotonic() - start)
+    return response_0, prompts.get_second_assignment_prompt(
+        processed_conversation=processed_conversation,
+        first_answer=response_0
+    )
+
+
+async def prepare_assignment_response_async(client, prompts: ModuleType, course: str, processed_conversation: str,
+                                            retrieved_qa_pairs: str, retrieved_docs_manual: str, mode: str,
+                                            latency_budget: Optional[float],
+                                            elapsed: float) -> Tuple[str, List[Dict[str, str]]]:
+    """
+    Async variant of prepare_assignment_response.
+    """
+    from async_utils import generate_async
+
+    mode = choose_assignment_mode(course, mode, latency_budget, elapsed)
+    if mode == SINGLE_PASS:
+        return '', get_single_pass_assignment_prompt(prompts, processed_conversation, retrieved_qa_pairs,
+                                                     retrieved_docs_manual)
+
+    first_prompt = prompts.get_first_assignment_prompt(
+        processed_conversation=processed_conversation,
+        retrieved_qa_pairs=retrieved_qa_pairs,
+        retrieved_docs_manual=retrieved_docs_manual
+    )
+    start = time.monotonic()
+    response_0 = await generate_async(client, prompt=first_prompt)
+    latency_tracker.record(course, 'first_pass', time.monotonic() - start)
+    return response_0, prompts.get_second_assignment_prompt(
+        processed_conversation=processed_conversation,
+        first_answer=response_0
+    )
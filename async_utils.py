@@ -0,0 +1,557 @@
+import os
+import time
+import asyncio
+import logging
+from typing import List, Dict, Any, AsyncIterator, Optional
+
+import httpx
+
+from ocr_cache import get_ocr_cache, url_key, content_key
+from embedding_cache import get_embedding_cache, embedding_key
+from local_index import get_local_index
+from manual_retrieval.tree_retrieval import manual_retrieval
+from utils import (
+    OCR_POLL_INITIAL_DELAY,
+    OCR_POLL_BACKOFF,
+    OCR_POLL_MAX_DELAY,
+    get_image_links,
+    batch_texts,
+    process_question,
+    parse_sse_data,
+    get_ed_comment_content,
+    get_ed_api_url,
+    get_edstem_token,
+    log_blob,
+    CommentPostedError
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+OCR_API_PATH = '/vision/v3.2/read/analyze'
+QA_API_VERSION = '2021-10-01'
+OPENAI_API_VERSION = '2024-02-01'
+SEARCH_API_VERSION = '2024-07-01'
+
+
+def create_async_client(max_connections: int = 200, timeout: float = 120.0) -> httpx.AsyncClient:
+    """
+    Create the shared HTTP client used by every async pipeline stage.
+
+    Args:
+        max_connections (int, optional): The maximum number of pooled connections. Defaults to 200.
+        timeout (float, optional): The request timeout in seconds. Defaults to 120.
+
+    Returns:
+        httpx.AsyncClient: A keep-alive HTTP client.
+    """
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        timeout=httpx.Timeout(timeout)
+    )
+
+
+async def ocr_images_async(client: httpx.AsyncClient, image_links: List[str]) -> List[str]:
+    """
+    Async variant of utils.ocr_images using the Computer Vision Read REST API.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        image_links (List[str]): The URLs of the images.
+
+    Returns:
+        List[str]: The extracted text of each image, in the same order as image_links.
+    """
+    cache = get_ocr_cache()
+    extracted_texts = [cache.get_by_url(link) for link in image_links]
+    missing = [i for i, text in enumerate(extracted_texts) if text is None]
+    if not missing:
+        return extracted_texts
+    headers = {'Ocp-Apim-Subscription-Key': os.getenv('OCR_KEY')}
+
+    async def download(img_link: str) -> bytes:
+        response = await client.get(img_link)
+        response.raise_for_status()
+        return response.content
+
+    async def submit(content: bytes) -> str:
+        read_response = await client.post(
+            f"{os.getenv('OCR_ENDPOINT').rstrip('/')}{OCR_API_PATH}",
+            headers={**headers, 'Content-Type': 'application/octet-stream'},
+            content=content
+        )
+        read_response.raise_for_status()
+        return read_response.headers['Operation-Location']
+
+    async def poll(operation_location: str) -> dict:
+        result_response = await client.get(operation_location, headers=headers)
+        result_response.raise_for_status()
+        return result_response.json()
+
+    contents = dict(zip(missing, await asyncio.gather(*(download(image_links[i]) for i in missing))))
+    for i, content in contents.items():
+        extracted_texts[i] = cache.get_by_content(image_links[i], content)
+    to_ocr = [i for i in missing if extracted_texts[i] is None]
+
+    operation_locations = await asyncio.gather(*(submit(contents[i]) for i in to_ocr))
+    pending = dict(zip(to_ocr, operation_locations))
+    read_results = {}
+    delay = OCR_POLL_INITIAL_DELAY
+    while pending:
+        await asyncio.sleep(delay)
+        delay = min(delay * OCR_POLL_BACKOFF, OCR_POLL_MAX_DELAY)
+        polled = await asyncio.gather(*(poll(location) for location in pending.values()))
+        for i, read_result in zip(list(pending), polled):
+            if read_result['status'] not in ['notStarted', 'running']:
+                read_results[i] = read_result
+                del pending[i]
+
+    for i in to_ocr:
+        extracted_text = []
+        if read_results[i]['status'] == 'succeeded':
+            for text_result in read_results[i]['analyzeResult']['readResults']:
+                extracted_text.extend(line['text'] for line in text_result['lines'])
+            cache.put([url_key(image_links[i]), content_key(contents[i])], "\n".join(extracted_text))
+        extracted_texts[i] = "\n".join(extracted_text)
+    return extracted_texts
+
+
+async def question_ocr_async(client: httpx.AsyncClient, xml: str) -> str:
+    """
+    Extract text from images embedded in an XML document using the Computer Vision Read REST API.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        xml (str): An XML string containing image elements with 'src' attribute pointing to the image URL.
+
+    Returns:
+        str: A concatenated string of all extracted text from the images in the XML.
+    """
+    return "\n".join(text for text in await ocr_images_async(client, get_image_links(xml)) if text)
+
+
+async def ocr_process_input_async(client: httpx.AsyncClient, metadata: str,
+                                  conversation_history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Async variant of utils.ocr_process_input; every image of every turn is OCR'd in one batch.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        metadata (str): metadata associated with the query.
+        conversation_history (List[Dict[str, Any]]): A list of previous conversation turns.
+
+    Returns:
+        List[Dict[str, Any]]: A list representing the processed conversation turns, including extracted image context.
+    """
+    turn_image_links = [get_image_links(turn['document']) for turn in conversation_history]
+    image_texts = iter(await ocr_images_async(client, [link for links in turn_image_links for link in links]))
+    image_contexts = [
+        "\n".join(text for text in (next(image_texts) for _ in links) if text)
+        for links in turn_image_links
+    ]
+    processed_conversation = [
+        {
+            'role': (
+                'Student' if turn['user_role'].lower() == 'student'
+                else 'Assistant 0.2.0' if turn['user_role'].lower() == 'assistant'
+                else 'TA'
+            ),
+            'text': process_question(turn['text']) if turn['user_role'].lower() == 'student' else turn['text'],
+            'image_context': image_context
+        }
+        for turn, image_context in zip(conversation_history, image_contexts)
+    ]
+    processed_conversation[0]['text'] = metadata + '\n' + processed_conversation[0]['text']
+    return processed_conversation
+
+
+async def process_conversation_search_async(client: httpx.AsyncClient, processed_conversation: List[Dict[str, Any]],
+                                            prompt_summarize: List[Dict[str, Any]]) -> str:
+    """
+    Async variant of utils.process_conversation_search.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        processed_conversation (List[Dict[str, Any]]): A list of messages in the conversation.
+        prompt_summarize (List[Dict[str, Any]]): A prompt for summarizing the conversation.
+
+    Returns:
+        str: A string containing the summarized conversation followed by the context and text of the last message.
+    """
+    last_message = processed_conversation[-1]
+    if len(processed_conversation) > 1:
+        conversation_summary = await generate_async(client, prompt=prompt_summarize)
+        return f"{conversation_summary}\n{last_message['image_context']}{last_message['text']}"
+    return f"{last_message['image_context']}{last_message['text']}"
+
+
+async def generate_async(client: httpx.AsyncClient, prompt: List[Dict[str, str]],
+                         temperature: float = 0.7, top_p: float = 0.95) -> str:
+    """
+    Send a prompt to an API endpoint of an LLM and retrieve a response.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        prompt (List[Dict[str, str]]): A list of message dictionaries representing the conversation history.
+        temperature (float, optional): The sampling temperature for the model's output. Defaults to 0.7.
+        top_p (float, optional): The cumulative probability cutoff for top-p sampling. Defaults to 0.95.
+
+    Returns:
+        str: The content of the response message from the API.
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "api-key": os.getenv('OPENAI_KEY')
+    }
+    payload = {
+        "messages": prompt,
+        "temperature": temperature,
+        "top_p": top_p,
+    }
+    response = await client.post(os.getenv('LLM_ENDPOINT'), headers=headers, json=payload)
+    response.raise_for_status()
+    return response.json()['choices'][0]['message']['content']
+
+
+async def generate_stream_async(client: httpx.AsyncClient, prompt: List[Dict[str, str]],
+                                temperature: float = 0.7, top_p: float = 0.95) -> AsyncIterator[str]:
+    """
+    Streaming variant of generate_async: yield the response of the LLM as content deltas arrive.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        prompt (List[Dict[str, str]]): A list of message dictionaries representing the conversation history.
+        temperature (float, optional): The sampling temperature for the model's output. Defaults to 0.7.
+        top_p (float, optional): The cumulative probability cutoff for top-p sampling. Defaults to 0.95.
+
+    Yields:
+        str: The next piece of the response message.
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "api-key": os.getenv('OPENAI_KEY')
+    }
+    payload = {
+        "messages": prompt,
+        "temperature": temperature,
+        "top_p": top_p,
+        "stream": True,
+    }
+    async with client.stream('POST', os.getenv('LLM_ENDPOINT'), headers=headers, json=payload) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            delta = parse_sse_data(line)
+            if delta is None:
+                break
+            if delta:
+                yield delta
+
+
+async def retrieve_qa_async(client: httpx.AsyncClient, conversation: str, top_k: int, project_name: str,
+                            deployment_name: str, confidence_threshold: float = 0.08) -> str:
+    """
+    Retrieve historical question-answer pairs using the Question Answering REST API.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        conversation (str): Summary of the conversation of previous turns and the most recent student question.
+        top_k (int): The maximum number of top answers to retrieve.
+        project_name (str): The Question Answering project of the course.
+        deployment_name (str): The deployment of the Question Answering project.
+        confidence_threshold (float): The minimum confidence threshold for answers. Defaults to 0.08.
+
+    Returns:
+        str: A formatted string containing the top matching question-answer pairs retrieved from the service.
+    """
+    response = await client.post(
+        f"{os.getenv('QA_ENDPOINT').rstrip('/')}/language/:query-knowledgebases",
+        params={
+            'projectName': project_name,
+            'deploymentName': deployment_name,
+            'api-version': QA_API_VERSION
+        },
+        headers={'Ocp-Apim-Subscription-Key': os.getenv('QA_KEY')},
+        json={
+            'question': conversation[-4999:],  # the limit is 5000 chars
+            'top': top_k,
+            'confidenceScoreThreshold': confidence_threshold
+        }
+    )
+    response.raise_for_status()
+    answers = response.json().get('answers') or []
+    qa_pairs = ""
+    for pair in answers:
+        if pair.get('questions'):
+            qa_pairs += f"\n==========================================\nConversation History and Student question: {pair['questions'][0]}\nTA's response: {pair['answer']}"
+    if qa_pairs == "":
+        return "None"
+    return "Retrieved historical QA" + qa_pairs
+
+
+async def embed_texts_async(client: httpx.AsyncClient, texts: List[str], model_name: str,
+                            dimensions: Optional[int] = None) -> List[List[float]]:
+    """
+    Generate embeddings for several texts using the Azure OpenAI embeddings REST API, serving repeated
+    texts from the embedding cache and packing the rest into batched requests.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        texts (List[str]): The input texts to generate embeddings for.
+        model_name (str): The name of the model to use for generating the embeddings.
+        dimensions (Optional[int]): The number of dimensions of the embeddings, if not the model's default.
+
+    Returns:
+        List[List[float]]: The embedding vectors, in the order of the input texts.
+    """
+    cache = get_embedding_cache()
+    keys = [embedding_key(model_name, dimensions, text) for text in texts]
+    vectors = cache.get_many(keys)
+    missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in vectors))
+    batches = batch_texts(missing)
+
+    async def embed_batch(batch: List[str]) -> List[List[float]]:
+        response = await client.post(
+            f"{os.getenv('OPENAI_ENDPOINT').rstrip('/')}/openai/deployments/{model_name}/embeddings",
+            params={'api-version': OPENAI_API_VERSION},
+            headers={'api-key': os.getenv('OPENAI_KEY')},
+            json={'input': batch, **({'dimensions': dimensions} if dimensions else {})}
+        )
+        response.raise_for_status()
+        return [item['embedding'] for item in sorted(response.json()['data'], key=lambda item: item['index'])]
+
+    computed = [vector for batch in await asyncio.gather(*map(embed_batch, batches)) for vector in batch]
+    computed = [(embedding_key(model_name, dimensions, text), vector) for text, vector in zip(missing, computed)]
+    cache.put_many(computed)
+    vectors.update(computed)
+    return [vectors[key] for key in keys]
+
+
+async def embed_text_async(client: httpx.AsyncClient, text: str, model_name: str) -> List[float]:
+    """
+    Generate an embedding for a given text using the Azure OpenAI embeddings REST API.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        text (str): The input text to generate the embedding for.
+        model_name (str): The name of the model to use for generating the embedding.
+
+    Returns:
+        List[float]: A list representing the embedding vector for the input text.
+    """
+    return (await embed_texts_async(client, [text], model_name=model_name))[0]
+
+
+async def retrieve_docs_hybrid_async(client: httpx.AsyncClient, text: str, index_name: str, top_k: int,
+                                     semantic_reranking: bool, model_name: str, retrieval_backend: str = 'azure',
+                                     local_index_dir: str = 'indexes', local_index_mmap: bool = False) -> str:
+    """
+    Retrieve documents using a hybrid search through the Azure AI Search REST API, or the in-process
+    local index of the same name.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        text (str): The text query for the search.
+        index_name (str): The name of the search index.
+        top_k (int): The number of top documents to retrieve.
+        semantic_reranking (bool): Whether to use semantic reranking (Azure AI Search only).
+        model_name (str): The embedding model used for the vector query.
+        retrieval_backend (str): 'azure' or 'local'.
+        local_index_dir (str): The directory of the local indexes.
+        local_index_mmap (bool): Whether to memory-map the vectors of the local index.
+
+    Returns:
+        str: The retrieved documents or an empty string if an error occurs.
+    """
+    try:
+        if retrieval_backend == 'local':
+            index = get_local_index(local_index_dir, index_name, mmap=local_index_mmap)
+            documents = index.search(text, await embed_text_async(client, text, model_name=model_name), top_k)
+            return "Retrieved course documents" + "".join(
+                f"\n==========================================\n{document}" for document in documents
+            )
+        search_params = {
+            'search': text,
+            'vectorQueries': [{
+                'kind': 'vector',
+                'vector': await embed_text_async(client, text, model_name=model_name),
+                'k': top_k,
+                'fields': 'vector'
+            }],
+            'select': 'content',
+            'top': top_k
+        }
+        if semantic_reranking:
+            search_params.update({
+                'queryType': 'semantic',
+                'semanticQuery': text,
+                'semanticConfiguration': 'my-semantic-config'
+            })
+        response = await client.post(
+            f"{os.getenv('SEARCH_ENDPOINT').rstrip('/')}/indexes/{index_name}/docs/search",
+            params={'api-version': SEARCH_API_VERSION},
+            headers={'api-key': os.getenv('SEARCH_KEY')},
+            json=search_params
+        )
+        response.raise_for_status()
+        retrieved_docs = "Retrieved course documents"
+        for retrieved_doc in response.json()['value']:
+            retrieved_docs += f"\n==========================================\n{retrieved_doc['content']}"
+        return retrieved_docs
+    except Exception as e:
+        logger.error(f"Error retrieving documents: {e}")
+        return ''
+
+
+async def manual_retrieval_async(question: str, course: str, scorer: Optional[str] = None, mode: Optional[str] = None,
+                                 assignment_type: Optional[str] = None, hint: str = '',
+                                 toc_candidates: Optional[int] = None) -> tuple:
+    """
+    Run the (blocking) manual tree retrieval in a worker thread.
+
+    Args:
+        question (str): The summarized student question.
+        course (str): The course whose trees are searched.
+        scorer (Optional[str]): The beam search scorer ('llm' or 'embedding'), MANUAL_RETRIEVAL_SCORER if None.
+        mode (Optional[str]): The retrieval mode ('traversal' or 'collapsed'), MANUAL_RETRIEVAL_MODE if None.
+        assignment_type (Optional[str]): The assignment kind of the thread (a CATEGORY_MAPPING value); trees of other kinds are skipped.
+        hint (str): Thread metadata searched for assignment identifiers (e.g. 'hw4') along with the question.
+        toc_candidates (Optional[int]): The number of files shortlisted for the LLM file selection, MANUAL_TOC_CANDIDATES if None.
+
+    Returns:
+        tuple: The retrieved documents string and the number of GPT calls made.
+    """
+    return await asyncio.to_thread(manual_retrieval, question, course, scorer=scorer, mode=mode,
+                                   assignment_type=assignment_type, hint=hint,
+                                   toc_candidates=toc_candidates)
+
+
+async def log_blob_async(log_dict: Dict[str, Any], blob_name: str, container_name: str) -> None:
+    """
+    Save a log entry to an Azure Blob Storage append blob without blocking the event loop.
+
+    Args:
+        log_dict (Dict[str, Any]): The dictionary containing data to be logged.
+        blob_name (str): The name of the blob file where the log entry will be saved.
+        container_name (str): The blob container to log to.
+    """
+    await asyncio.to_thread(log_blob, log_dict, blob_name, container_name)
+
+
+async def delete_comment_async(client: httpx.AsyncClient, course: str, id: str) -> None:
+    """
+    Delete a comment from EdStem for a given course.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        course (str): The course identifier.
+        id (str): The ID of the comment to delete.
+    """
+    headers = {
+        'Authorization': f'Bearer {get_edstem_token(course)}',
+        'Content-Type': 'application/json'
+    }
+    response = await client.delete(f"{get_ed_api_url()}/comments/{id}", headers=headers)
+    response.raise_for_status()
+
+
+async def reply_to_ed_async(client: httpx.AsyncClient, course: str, id: str, text: str,
+                            post_answer: bool, private: bool) -> Optional[int]:
+    """
+    Reply to a thread on EdStem for a given course.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        course (str): The course identifier.
+        id (str): The ID of the thread or comment to reply to.
+        text (str): The content of the reply.
+        post_answer (bool): Whether to post as an answer or a comment.
+        private (bool): Whether the reply should be private.
+
+    Returns:
+        Optional[int]: The ID of the posted comment.
+    """
+    url = f"{get_ed_api_url()}/{'threads' if post_answer else 'comments'}/{id}/comments"
+    payload = {
+        "comment": {
+            "type": "answer" if post_answer else "comment",
+            "content": get_ed_comment_content(text),
+            "is_private": private,
+        }
+    }
+    headers = {
+        'Authorization': f'Bearer {get_edstem_token(course)}',
+        'Content-Type': 'application/json'
+    }
+    response = await client.post(url, headers=headers, json=payload)
+    response.raise_for_status()
+    return (response.json().get('comment') or {}).get('id')
+
+
+async def edit_comment_async(client: httpx.AsyncClient, course: str, id: str, text: str) -> None:
+    """
+    Replace the content of a comment on EdStem for a given course.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        course (str): The course identifier.
+        id (str): The ID of the comment to edit.
+        text (str): The new content of the comment.
+    """
+    headers = {
+        'Authorization': f'Bearer {get_edstem_token(course)}',
+        'Content-Type': 'application/json'
+    }
+    payload = {"comment": {"content": get_ed_comment_content(text)}}
+    response = await client.put(f"{get_ed_api_url()}/comments/{id}", headers=headers, json=payload)
+    response.raise_for_status()
+
+
+async def stream_to_ed_async(client: httpx.AsyncClient, course: str, id: str, chunks: AsyncIterator[str],
+                             prefix: str = '', min_chars: int = 200, edit_interval: float = 2.0) -> str:
+    """
+    Async variant of utils.stream_to_ed: progressively post a streamed response as a private Ed comment.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        course (str): The course identifier.
+        id (str): The ID of the comment to reply to.
+        chunks (AsyncIterator[str]): The streamed pieces of the response.
+        prefix (str, optional): Text prepended to the comment. Defaults to ''.
+        min_chars (int, optional): Characters to accumulate before the comment is created. Defaults to 200.
+        edit_interval (float, optional): Minimum number of seconds between edits. Defaults to 2.0.
+
+    Returns:
+        str: The complete response.
+
+    Raises:
+        CommentPostedError: If generation or an edit failed after the comment was created.
+    """
+    response = ''
+    posted_text = None  # the text of the comment as last posted or edited
+    comment_id = None
+    last_update = 0.0
+    try:
+        async for chunk in chunks:
+            response += chunk
+            if posted_text is None:
+                if len(response) >= min_chars:
+                    comment_id = await reply_to_ed_async(client, course=course, id=id, text=prefix+response,
+                                                         post_answer=False, private=True)
+                    posted_text, last_update = response, time.monotonic()
+            elif comment_id is not None and time.monotonic() - last_update >= edit_interval:
+                await edit_comment_async(client, course=course, id=comment_id, text=prefix+response)
+                posted_text, last_update = response, time.monotonic()
+
+        if posted_text is None:
+            await reply_to_ed_async(client, course=course, id=id, text=prefix+response, post_answer=False, private=True)
+        elif posted_text != response:
+            if comment_id is None:  # Ed returned no id to edit: post the complete response once instead
+                await reply_to_ed_async(client, course=course, id=id, text=prefix+response,
+                                        post_answer=False, private=True)
+            else:
+                await edit_comment_async(client, course=course, id=comment_id, text=prefix+response)
+    except Exception as e:
+        if posted_text is not None:
+            raise CommentPostedError(comment_id) from e
+        raise
+    return response
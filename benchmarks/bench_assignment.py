@@ -0,0 +1,71 @@
+"""
+End-to-end latency of assignment answer generation per course and mode
+(two_pass, single_pass, and two_pass with a latency budget that forces the
+single-pass fallback once the per-course estimates are warm).
+
+    python benchmarks/bench_assignment.py --runs 5 --token-latency 0.01
+
+Run from the repository root so that configs/ resolves.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_servers import start_stub_server, stub_env
+
+CONVERSATION = [{'role': 'Student', 'text': 'How do I do 1d? My groupby returns the wrong shape.', 'image_context': ''}]
+
+
+def run_once(prompts, course: str, mode: str, latency_budget) -> float:
+    from utils import generate
+    from assignment_generation import prepare_assignment_response, latency_tracker
+
+    start = time.monotonic()
+    response_0, final_prompt = prepare_assignment_response(
+        prompts=prompts,
+        course=course,
+        processed_conversation=CONVERSATION,
+        retrieved_qa_pairs='None',
+        retrieved_docs_manual='Q1d: use groupby and agg.',
+        mode=mode,
+        latency_budget=latency_budget,
+        elapsed=0.0
+    )
+    final_start = time.monotonic()
+    generate(prompt=final_prompt)
+    if response_0:
+        latency_tracker.record(course, 'final_pass', time.monotonic() - final_start)
+    return time.monotonic() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--words', type=int, default=150)
+    parser.add_argument('--token-latency', type=float, default=0.01)
+    parser.add_argument('--llm-latency', type=float, default=0.3)
+    args = parser.parse_args()
+
+    answer = ' '.join(f'word{i}' for i in range(args.words))
+    server, base_url = start_stub_server(completion=lambda payload: answer, token_latency=args.token_latency,
+                                         latency={'chat': args.llm_latency})
+    os.environ.update(stub_env(base_url))
+
+    from courses import COURSE_PROMPTS, get_course_config
+
+    print(f"{'course':<8}{'mode':<24}{'p50 (s)':>10}{'vs two_pass':>14}")
+    for course in COURSE_PROMPTS:
+        prompts = get_course_config(course).prompts
+        baseline = None
+        for label, mode, budget in [
+            ('two_pass', 'two_pass', None),
+            ('single_pass', 'single_pass', None),
+            ('two_pass + tight budget', 'two_pass', 0.1),
+        ]:
+            p50 = statistics.median(run_once(prompts, course, mode, budget) for _ in range(args.runs))
+            baseline = baseline or p50
+            print(f"{course:<8}{label:<24}{p50:>10.2f}{(baseline - p50) / baseline:>13.0%}")
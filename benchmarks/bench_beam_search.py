@@ -0,0 +1,116 @@
+"""
+Latency, LLM calls and agreement of the manual retrieval strategies: beam search with the llm or
+embedding scorer, and the collapsed-tree index (one lookup over every node of every tree).
+
+Against the stub server, over synthetic trees (stub embeddings and LLM answers are arbitrary, so
+agreement is only meaningful with --live):
+
+    python benchmarks/bench_beam_search.py --questions 20 --llm-latency 0.8
+
+Against the real services and trees of a course (keys.env), to compare accuracy:
+
+    python benchmarks/bench_beam_search.py --live --course ds100 --questions-file questions.json --files hw4.json lab8.json
+
+Run from the repository root so that configs/ resolves.
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_servers import start_stub_server, stub_env
+
+TOPICS = ['groupby', 'pivot tables', 'regex', 'joins', 'histograms', 'bootstrap', 'linear regression',
+          'gradient descent', 'cross validation']
+
+
+def select_first(payload: dict) -> str:
+    """Stub LLM answer: the first N candidates."""
+    match = re.search(r'Select the top (\d+)', payload['messages'][0]['content'])
+    return str(list(range(1, int(match.group(1)) + 1))) if match else 'Stub answer.'
+
+
+def synthetic_tree(assignment: str, depth: int, branch_factor: int, prefix: str = ''):
+    """A balanced tree of question summaries; returns the value of its root node."""
+    if depth == 0:
+        return f"{assignment} question {prefix}: full instructions."
+    children = {}
+    for i in range(branch_factor):
+        label = f"{prefix}{i + 1}" if depth > 1 else f"{prefix}{'abc'[i % 3]}"
+        summary = f"{assignment} question {label} about {TOPICS[(len(prefix) + i * 3) % len(TOPICS)]}"
+        children[summary] = synthetic_tree(assignment, depth - 1, branch_factor, label)
+    return children
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--questions', type=int, default=20)
+    parser.add_argument('--llm-latency', type=float, default=0.8)
+    parser.add_argument('--embedding-latency', type=float, default=0.05)
+    parser.add_argument('--live', action='store_true')
+    parser.add_argument('--course', default='ds100')
+    parser.add_argument('--questions-file')
+    parser.add_argument('--files', nargs='*', default=['hw1.json', 'hw2.json', 'lab1.json'])
+    args = parser.parse_args()
+
+    if args.live:
+        from dotenv import load_dotenv
+        load_dotenv('./keys.env')
+        with open(args.questions_file) as f:
+            questions = json.load(f)
+    else:
+        server, base_url = start_stub_server(completion=select_first, embedding_dimensions=64, latency={
+            'chat': args.llm_latency, 'embeddings': args.embedding_latency})
+        os.environ.update(stub_env(base_url))
+        os.environ.setdefault('AZURE_STORAGE_CONNECTION_STRING',
+                              'DefaultEndpointsProtocol=https;AccountName=stub;AccountKey=c3R1Yg==;EndpointSuffix=core.windows.net')
+        os.environ['EMBEDDING_MODEL_NAME'] = 'embedding'
+        questions = [f"How do I do question {i % 3 + 1}{'abc'[i % 3]} on {TOPICS[i % len(TOPICS)]}?"
+                     for i in range(args.questions)]
+
+    from manual_retrieval.tree_retrieval import get_manual_retriever
+    from manual_retrieval.tree_utils import EMBEDDINGS_DIR, build_node_embeddings
+
+    retriever = get_manual_retriever(args.course)
+    if not args.live:
+        retriever.embedding_model = 'embedding'
+
+    if not args.live:
+        toc = {}
+        for file_name in args.files:
+            tree = {f"{file_name} overview": synthetic_tree(file_name[:-5], depth=3, branch_factor=3)}
+            retriever.tree_store._store(file_name, tree, None, 0)
+            toc[file_name] = next(iter(tree))
+            retriever.tree_store._store(f"{EMBEDDINGS_DIR}/{file_name}",
+                                        build_node_embeddings(tree, 'embedding'), None, 0)
+        retriever.tree_store._store('table_of_contents.json', toc, None, 0)
+
+    results = {}
+    for scorer in ['llm', 'embedding', 'collapsed']:
+        latencies, calls, docs = [], [], []
+        if scorer == 'collapsed':
+            # Built in the background; wait for it so the lookups are measured on a ready index
+            retriever.collapsed_index.refresh()
+            retriever.collapsed_index.wait()
+        for question in questions:
+            retriever.reset_llm_calls()
+            start = time.perf_counter()
+            if scorer == 'collapsed':
+                retrieved = retriever.collapsed_index.search(question, final_doc_count=1)
+            else:
+                retrieved = retriever.beam_search_across_blobs(question, args.files, beam_width=3,
+                                                               final_doc_count=1, scorer=scorer)
+            latencies.append(time.perf_counter() - start)
+            calls.append(retriever.llm_calls)
+            docs.append([doc['Text'] for doc in retrieved])
+        results[scorer] = docs
+        print(f"{scorer:<10} p50 {statistics.median(latencies) * 1000:9.1f}ms  mean LLM calls {statistics.mean(calls):.2f}")
+
+    for other in ['embedding', 'collapsed']:
+        agreement = sum(a == b for a, b in zip(results['llm'], results[other])) / len(questions)
+        print(f"same documents retrieved by llm and {other}: {agreement:.0%}")
@@ -0,0 +1,88 @@
+"""
+Question header extraction over a corpus of markdown assignments: the sequential scan
+(accumulate_question_headers) versus the map-reduce scan (accumulate_question_headers_map_reduce),
+against a stub LLM that reports the header lines of each section.
+
+    python benchmarks/bench_chunking.py --documents 5 --questions 12 --llm-latency 0.5
+
+Pass --corpus DIR to use real markdown files instead of the synthetic assignments.
+"""
+import io
+import os
+import re
+import ast
+import sys
+import time
+import random
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_servers import start_stub_server, stub_env
+
+HEADER_LINE = re.compile(r'^#+\s*(.+)$', re.MULTILINE)
+FILLER = ('Use the DataFrame from the previous part and compute the requested statistic. '
+          'Make sure your answer passes the autograder tests before submitting.').split('. ')
+
+
+def synthetic_assignment(name: str, questions: int, rng: random.Random) -> str:
+    lines = [f'# {name}', '', 'Instructions: submit to Gradescope.', '']
+    for q in range(1, questions + 1):
+        lines += [f'## Question {q}: {rng.choice(["Joins", "Groupby", "Regex", "Plots", "Sampling"])}', '']
+        for part in 'abc'[:rng.randint(1, 3)]:
+            lines += [f'### Question {q}{part}', '']
+            lines += [rng.choice(FILLER) + '.' for _ in range(rng.randint(4, 12))] + ['']
+    return '\n'.join(lines)
+
+
+def stub_llm(payload: dict) -> str:
+    system = payload['messages'][0]['content']
+    if 'cleaning up lists' in system:
+        return system.split('contains question headers: \n', 1)[1].split('\n', 1)[0]
+    existing = ast.literal_eval(system.split('collected so far:\n', 1)[1].split('\n\n', 1)[0])
+    section = payload['messages'][1]['content']
+    return str([header for header in HEADER_LINE.findall(section) if 'Question' in header and header not in existing])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--documents', type=int, default=5)
+    parser.add_argument('--questions', type=int, default=12)
+    parser.add_argument('--llm-latency', type=float, default=0.5)
+    parser.add_argument('--corpus')
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(completion=stub_llm, latency={'chat': args.llm_latency})
+    os.environ.update(stub_env(base_url))
+
+    from manual_retrieval.chunking import (split_into_sections, accumulate_question_headers,
+                                           accumulate_question_headers_map_reduce)
+
+    if args.corpus:
+        documents = []
+        for filename in sorted(os.listdir(args.corpus)):
+            if filename.endswith('.md'):
+                with open(os.path.join(args.corpus, filename)) as f:
+                    documents.append(f.read())
+    else:
+        rng = random.Random(0)
+        documents = [synthetic_assignment(f'Homework {i + 1}', args.questions, rng) for i in range(args.documents)]
+
+    totals = {'sequential': 0.0, 'map_reduce': 0.0}
+    agreement = []
+    for document in documents:
+        sections = split_into_sections(document, type='line', section_length=32, overlap=16)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            sequential = accumulate_question_headers(sections)
+            totals['sequential'] += time.perf_counter() - start
+            start = time.perf_counter()
+            map_reduce = accumulate_question_headers_map_reduce(sections)
+            totals['map_reduce'] += time.perf_counter() - start
+        agreement.append(len(set(sequential) & set(map_reduce)) / max(len(set(sequential) | set(map_reduce)), 1))
+
+    print(f"{len(documents)} documents")
+    for mode, seconds in totals.items():
+        print(f"{mode:<11} {seconds:.2f}s")
+    print(f"header overlap (Jaccard): {sum(agreement) / len(agreement):.0%}")
@@ -0,0 +1,84 @@
+"""
+Per-request connection overhead of building service clients on every call
+(the old behaviour) versus reusing the pooled clients from clients.py.
+
+    python benchmarks/bench_clients.py --calls 100
+
+The stub server speaks plain HTTP, so the numbers exclude TLS handshakes and
+understate the savings against the real Azure endpoints.
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_servers import start_stub_server, stub_env
+
+
+def fresh_generate():
+    import requests
+    response = requests.post(os.getenv('LLM_ENDPOINT'), headers={'api-key': os.getenv('OPENAI_KEY')},
+                             json={'messages': [{'role': 'user', 'content': 'hi'}]})
+    response.raise_for_status()
+
+
+def pooled_generate():
+    from clients import get_http_session
+    response = get_http_session().post(os.getenv('LLM_ENDPOINT'), headers={'api-key': os.getenv('OPENAI_KEY')},
+                                       json={'messages': [{'role': 'user', 'content': 'hi'}]})
+    response.raise_for_status()
+
+
+def fresh_embed():
+    from openai import AzureOpenAI
+    client = AzureOpenAI(api_key=os.getenv('OPENAI_KEY'), api_version='2024-02-01',
+                         azure_endpoint=os.getenv('OPENAI_ENDPOINT'))
+    client.embeddings.create(input='hi', model='text-embedding-3-small')
+
+
+def pooled_embed():
+    from clients import get_openai_client
+    get_openai_client().embeddings.create(input='hi', model='text-embedding-3-small')
+
+
+def fresh_search():
+    from azure.core.credentials import AzureKeyCredential
+    from azure.search.documents import SearchClient
+    client = SearchClient(os.getenv('SEARCH_ENDPOINT'), 'bench-index', AzureKeyCredential(os.getenv('SEARCH_KEY')))
+    list(client.search(search_text='hi', top=1))
+
+
+def pooled_search():
+    from clients import get_search_client
+    list(get_search_client('bench-index').search(search_text='hi', top=1))
+
+
+def measure(server, fn, calls: int) -> tuple:
+    fn()  # warm-up: imports and, for pooled clients, the one-time construction
+    connections = server.connections
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    elapsed = time.perf_counter() - start
+    return elapsed / calls * 1000, server.connections - connections
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=100)
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server()
+    os.environ.update(stub_env(base_url))
+
+    print(f"{'stage':<12}{'mode':<8}{'ms/call':>10}{'new conns':>12}")
+    for stage, fresh, pooled in [
+        ('generate', fresh_generate, pooled_generate),
+        ('embed', fresh_embed, pooled_embed),
+        ('search', fresh_search, pooled_search),
+    ]:
+        for mode, fn in [('fresh', fresh), ('pooled', pooled)]:
+            ms, connections = measure(server, fn, args.calls)
+            print(f"{stage:<12}{mode:<8}{ms:>10.2f}{connections:>12}")
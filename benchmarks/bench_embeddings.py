@@ -0,0 +1,48 @@
+"""
+Embedding N texts one request at a time versus embed_texts() batches, and again from the cache.
+
+    python benchmarks/bench_embeddings.py --texts 500 --latency 0.05
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_servers import start_stub_server, stub_env
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--texts', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.05)
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency={'embeddings': args.latency})
+    os.environ.update(stub_env(base_url))
+
+    from utils import get_openai_client, embed_texts
+    from embedding_cache import get_embedding_cache
+
+    texts = [f'Section {i}: how to apply groupby and agg to column {i % 17}' for i in range(args.texts)]
+
+    start = time.perf_counter()
+    for text in texts:
+        get_openai_client().embeddings.create(input=text, model='embedding')
+    one_by_one = time.perf_counter() - start
+
+    requests_before = server.requests.get('embeddings', 0)
+    start = time.perf_counter()
+    embed_texts(texts, model_name='embedding')
+    batched = time.perf_counter() - start
+    batched_requests = server.requests.get('embeddings', 0) - requests_before
+
+    start = time.perf_counter()
+    embed_texts(texts, model_name='embedding')
+    cached = time.perf_counter() - start
+
+    print(f"one request per text: {one_by_one:.2f}s ({args.texts} requests)")
+    print(f"embed_texts:          {batched:.2f}s ({batched_requests} requests)")
+    print(f"embed_texts, cached:  {cached:.3f}s")
+    print('Embedding cache:', get_embedding_cache().stats())
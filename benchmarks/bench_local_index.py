@@ -0,0 +1,67 @@
+"""
+Hybrid retrieval latency: Azure AI Search (stub server with --search-latency) versus the
+in-process local index over a synthetic course index.
+
+    python benchmarks/bench_local_index.py --documents 5000 --queries 200
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_servers import start_stub_server, stub_env
+
+WORDS = ('groupby aggregation regression gradient descent loss function sampling bootstrap variance '
+         'bias pandas dataframe index join merge pivot histogram distribution probability lecture').split()
+
+
+def p50(seconds):
+    return statistics.median(seconds) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--documents', type=int, default=5000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--dimensions', type=int, default=1536)
+    parser.add_argument('--search-latency', type=float, default=0.05)
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency={'search': args.search_latency}, embedding_dimensions=args.dimensions)
+    os.environ.update(stub_env(base_url))
+
+    import local_index
+    from local_index import LocalIndex
+    from utils import embed_text, retrieve_docs_hybrid
+
+    rng = random.Random(0)
+    documents = [' '.join(rng.choices(WORDS, k=120)) for _ in range(args.documents)]
+    vectors = [[rng.gauss(0, 1) for _ in range(args.dimensions)] for _ in range(args.documents)]
+    queries = [' '.join(rng.choices(WORDS, k=12)) for _ in range(args.queries)]
+    for query in queries:
+        embed_text(query, model_name='embedding')  # warm the embedding cache so both backends only pay for retrieval
+
+    with tempfile.TemporaryDirectory() as index_dir:
+        start = time.perf_counter()
+        LocalIndex.save(os.path.join(index_dir, 'bench-index'), documents, vectors)
+        print(f"built and saved {args.documents} documents in {time.perf_counter() - start:.2f}s")
+
+        for backend, mmap in [('azure', False), ('local', False), ('local', True)]:
+            settings = {'model_name': 'embedding', 'retrieval_backend': backend, 'local_index_dir': index_dir,
+                        'local_index_mmap': mmap}
+            local_index._local_indexes.clear()  # time the load of each variant
+            start = time.perf_counter()
+            retrieve_docs_hybrid(queries[0], index_name='bench-index', top_k=2, semantic_reranking=False, **settings)
+            first = time.perf_counter() - start
+            latencies = []
+            for query in queries:
+                start = time.perf_counter()
+                retrieve_docs_hybrid(query, index_name='bench-index', top_k=2, semantic_reranking=False, **settings)
+                latencies.append(time.perf_counter() - start)
+            label = backend + (' (mmap)' if mmap else '')
+            print(f"{label:<14} first query {first * 1000:8.1f}ms  p50 {p50(latencies):7.2f}ms")
@@ -0,0 +1,74 @@
+"""
+Throughput of the async pipeline (asgi.edison_pipeline) against the local stub server.
+
+    python benchmarks/bench_pipeline.py --requests 100 --llm-latency 0.5
+
+Run from the repository root so that configs/ resolves.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_servers import start_stub_server, stub_env
+
+
+def make_request(i: int, course: str, category: str) -> dict:
+    return {
+        'prod': 'false',
+        'course': course,
+        'category': category,
+        'thread_title': f'Question {i}',
+        'question_id': f'thread_{i}',
+        'comment_id': str(i),
+        'conversation_history': [{
+            'user_role': 'student',
+            'document': '<document version="2.0"><paragraph>How does regularization work?</paragraph></document>',
+            'text': 'How does regularization work?'
+        }]
+    }
+
+
+async def run(num_requests: int, course: str, category: str) -> None:
+    from asgi import edison_pipeline
+    from async_utils import create_async_client
+
+    latencies = []
+
+    async def timed(client, i):
+        start = time.perf_counter()
+        await edison_pipeline(client, make_request(i, course, category))
+        latencies.append(time.perf_counter() - start)
+
+    async with create_async_client() as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(timed(client, i) for i in range(num_requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"{num_requests} requests in {elapsed:.2f}s ({num_requests / elapsed:.1f} req/s)")
+    print(f"p50 {statistics.median(latencies):.3f}s  p95 {latencies[int(0.95 * (len(latencies) - 1))]:.3f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--course', default='ds100')
+    parser.add_argument('--category', default='Lectures')
+    parser.add_argument('--llm-latency', type=float, default=0.5)
+    parser.add_argument('--retrieval-latency', type=float, default=0.1)
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency={
+        'chat': args.llm_latency,
+        'embeddings': args.retrieval_latency,
+        'search': args.retrieval_latency,
+        'qa': args.retrieval_latency,
+    })
+    os.environ.update(stub_env(base_url))
+    asyncio.run(run(args.requests, args.course, args.category))
+    print('Stub requests per service:', server.requests)
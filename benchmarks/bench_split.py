@@ -0,0 +1,63 @@
+"""
+Header splitting of a large markdown document: one scan per header (the previous
+split_document_by_headers) versus the single compiled alternation.
+
+    python benchmarks/bench_split.py --questions 200 --repeat 5
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from manual_retrieval.chunking import split_document_by_headers
+
+
+def split_per_header(text, headers):
+    """The previous implementation: a re.finditer over the whole text for every header."""
+    chunks = []
+    start_idx = 0
+    header_positions = []
+    for header in headers:
+        header_positions.extend((m.start(), header) for m in re.finditer(re.escape(header), text))
+    header_positions.sort()
+    for pos, header in header_positions:
+        if pos > start_idx:
+            chunk = text[start_idx:pos].strip()
+            if chunk:
+                chunks.append(chunk)
+        start_idx = pos
+    last_chunk = text[start_idx:].strip()
+    if last_chunk:
+        chunks.append(last_chunk)
+    return chunks
+
+
+def synthetic_document(questions: int, rng: random.Random):
+    lines, headers = [], []
+    for q in range(1, questions + 1):
+        headers.append(f'Question {q}')
+        lines.append(f'## Question {q}')
+        for part in 'abcd'[:rng.randint(1, 4)]:
+            headers.append(f'Question {q}{part}')
+            lines.append(f'### Question {q}{part}')
+            lines += ['Compute the statistic over the table and explain the result in a sentence.'] * rng.randint(5, 40)
+    return '\n'.join(lines), headers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--questions', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    text, headers = synthetic_document(args.questions, random.Random(0))
+    print(f"{len(text) / 1e6:.1f} MB, {len(headers)} headers")
+    for name, split in [('per header', split_per_header), ('alternation', split_document_by_headers)]:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            chunks = split(text, headers)
+        print(f"{name:<12} {(time.perf_counter() - start) / args.repeat * 1000:8.1f}ms  {len(chunks)} chunks")
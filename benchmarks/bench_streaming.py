@@ -0,0 +1,54 @@
+"""
+Time to first visible content on Ed: one blocking generate() + reply_to_ed()
+versus generate_stream() fed into stream_to_ed().
+
+    python benchmarks/bench_streaming.py --words 300 --token-latency 0.02
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_servers import start_stub_server, stub_env
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--words', type=int, default=300)
+    parser.add_argument('--token-latency', type=float, default=0.02)
+    parser.add_argument('--min-chars', type=int, default=200)
+    parser.add_argument('--edit-interval', type=float, default=2.0)
+    args = parser.parse_args()
+
+    answer = ' '.join(f'word{i}' for i in range(args.words))
+    server, base_url = start_stub_server(completion=lambda payload: answer, token_latency=args.token_latency)
+    os.environ.update(stub_env(base_url))
+
+    import utils
+    prompt = [{'role': 'user', 'content': 'How do I do 1d?'}]
+
+    # Blocking: the stub only answers once every token is "generated"
+    start = time.perf_counter()
+    response = utils.generate(prompt)
+    utils.reply_to_ed(course='ds100', id='1', text='edison' + response, post_answer=False, private=True)
+    blocking = time.perf_counter() - start
+
+    first_post = []
+    reply_to_ed = utils.reply_to_ed
+
+    def timed_reply(**kwargs):
+        first_post.append(time.perf_counter())
+        return reply_to_ed(**kwargs)
+
+    utils.reply_to_ed = timed_reply
+    start = time.perf_counter()
+    utils.stream_to_ed(course='ds100', id='1', chunks=utils.generate_stream(prompt), prefix='edison',
+                       min_chars=args.min_chars, edit_interval=args.edit_interval)
+    total = time.perf_counter() - start
+    utils.reply_to_ed = reply_to_ed
+
+    print(f"blocking:  first visible content after {blocking:.2f}s")
+    print(f"streaming: first visible content after {first_post[0] - start:.2f}s, complete after {total:.2f}s")
+    print('Ed requests:', server.requests.get('ed', 0))
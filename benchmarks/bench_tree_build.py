@@ -0,0 +1,60 @@
+"""
+Tree build time: the serial builder (generate_leaf_nodes + build_balanced_tree) versus
+build_tree_parallel, and a rerun of the parallel build resuming from its checkpoint.
+
+    python benchmarks/bench_tree_build.py --chunks 60 --llm-latency 0.5 --workers 16
+"""
+import io
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_servers import start_stub_server, stub_env
+
+
+def summary_of(payload: dict) -> str:
+    """Stub summary: deterministic in the summarized text, like a temperature-0.1 model mostly is."""
+    return 'Summary ' + hashlib.sha256(payload['messages'][-1]['content'].encode()).hexdigest()[:12]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=60)
+    parser.add_argument('--branch-factor', type=int, default=3)
+    parser.add_argument('--llm-latency', type=float, default=0.5)
+    parser.add_argument('--workers', type=int, default=16)
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(completion=summary_of, latency={'chat': args.llm_latency})
+    os.environ.update(stub_env(base_url))
+
+    from manual_retrieval.tree_utils import generate_leaf_nodes, build_balanced_tree, build_tree_parallel
+
+    chunks = [f'Question {i}: write a function that computes statistic {i}.' for i in range(args.chunks)]
+    with contextlib.redirect_stdout(io.StringIO()), tempfile.TemporaryDirectory() as checkpoint_dir:
+        checkpoint_path = os.path.join(checkpoint_dir, 'tree.jsonl')
+        start = time.perf_counter()
+        serial = build_balanced_tree(generate_leaf_nodes(chunks), branch_factor=args.branch_factor)
+        serial_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        parallel = build_tree_parallel(chunks, branch_factor=args.branch_factor, max_workers=args.workers,
+                                       checkpoint_path=checkpoint_path)
+        parallel_seconds = time.perf_counter() - start
+
+        calls = server.requests['chat']
+        start = time.perf_counter()
+        build_tree_parallel(chunks, branch_factor=args.branch_factor, max_workers=args.workers,
+                            checkpoint_path=checkpoint_path)
+        resumed_seconds = time.perf_counter() - start
+        resumed_calls = server.requests['chat'] - calls
+
+    print(f"serial:   {serial_seconds:.2f}s")
+    print(f"parallel: {parallel_seconds:.2f}s (identical tree: {serial == parallel})")
+    print(f"resumed:  {resumed_seconds:.2f}s ({resumed_calls} LLM calls)")
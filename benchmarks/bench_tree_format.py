@@ -0,0 +1,83 @@
+"""
+Size and load time of a manual-retrieval tree as JSON (as uploaded by the pipeline) versus the compact
+binary format (with and without node embeddings, against the JSON embeddings sidecar), and the time of a
+root-to-leaf walk over each. The compact tree is about the size of the JSON one: it only loads faster.
+
+    python benchmarks/bench_tree_format.py --depth 5 --branch-factor 3 --dimensions 1536
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+from collections.abc import Mapping
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_beam_search import synthetic_tree
+from manual_retrieval.tree_utils import collect_node_keys, collect_leaf_texts, encode_vector
+from manual_retrieval.tree_format import encode_tree, load_tree, load_tree_file
+
+
+def walk(tree):
+    """Follow the first child down to a leaf, reading every key on the way (like one beam)."""
+    node = tree
+    while isinstance(node, Mapping):
+        keys = list(node.keys())
+        node = node[keys[0]]
+    return node
+
+
+def timed(fn, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depth', type=int, default=5)
+    parser.add_argument('--branch-factor', type=int, default=3)
+    parser.add_argument('--dimensions', type=int, default=1536)
+    parser.add_argument('--chunk-length', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    tree = synthetic_tree('hw4', depth=args.depth, branch_factor=args.branch_factor)
+    tree = {'hw4 overview': tree}
+
+    def pad(node):
+        return {key: pad(value) if isinstance(value, dict) else value + ' x' * (args.chunk_length // 2)
+                for key, value in node.items()}
+    tree = pad(tree)
+    rng = np.random.default_rng(0)
+    texts = collect_node_keys(tree) + collect_leaf_texts(tree)
+    vectors = {text: rng.standard_normal(args.dimensions).astype(np.float32) for text in texts}
+
+    formats = {
+        'json': json.dumps(tree).encode('utf-8'),
+        'compact': encode_tree(tree),
+        'compact+vectors': encode_tree(tree, vectors),
+    }
+    sidecar = json.dumps({'model': 'embedding', 'vectors': {text: encode_vector(v) for text, v in vectors.items()}})
+    assert load_tree(formats['compact']).to_dict() == tree
+    print(f"{len(texts)} texts; json tree + embeddings sidecar: "
+          f"{(len(formats['json']) + len(sidecar)) / 1e6:.2f} MB")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, content in formats.items():
+            path = os.path.join(directory, name)
+            with open(path, 'wb') as f:
+                f.write(content)
+            load_ms = timed(lambda: load_tree(content), args.repeat)
+            mmap_ms = timed(lambda: load_tree_file(path), args.repeat)
+            loaded = load_tree(content)
+            walk_ms = timed(lambda: walk(loaded), args.repeat)
+            print(f"{name:<16} {len(content) / 1e6:8.2f} MB  load {load_ms:8.3f}ms  "
+                  f"load from file {mmap_ms:8.3f}ms  walk {walk_ms:7.3f}ms")
@@ -0,0 +1,225 @@
+"""
+Local stub HTTP server standing in for Azure OpenAI, AI Search, Question Answering,
+Computer Vision and the Ed API, so the pipeline can be exercised offline.
+
+    server, base_url = start_stub_server(latency={'chat': 0.5})
+    os.environ.update(stub_env(base_url))
+"""
+import re
+import json
+import time
+import uuid
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+DEFAULT_LATENCY = {
+    'chat': 0.0,
+    'embeddings': 0.0,
+    'search': 0.0,
+    'qa': 0.0,
+    'ocr': 0.0,
+    'ed': 0.0,
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; with Nagle's algorithm on, a kept-alive connection
+    # stalls ~40ms on the client's delayed ACK before the body, swamping the pooled-client numbers
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def read_json(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if len(body) < length:
+            # The client gave up mid-request (e.g. a stage deadline cancelled it)
+            self.close_connection = True
+            raise ConnectionAbortedError
+        if 'json' not in (self.headers.get('Content-Type') or 'json'):
+            return {'body': body}
+        return json.loads(body or b'{}')
+
+    def send_json(self, payload: dict, status: int = 200, headers: Dict[str, str] = None) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, content: str) -> None:
+        # Server-sent events in the Azure OpenAI format, one word per chunk
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        events = [{'choices': []}]  # Azure sends the prompt filter results first
+        events += [{'choices': [{'index': 0, 'delta': {'content': token}}]} for token in re.findall(r'\S+\s*', content)]
+        for event in events:
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+            time.sleep(self.server.token_latency)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def wait(self, service: str) -> None:
+        with self.server.lock:
+            self.server.requests[service] = self.server.requests.get(service, 0) + 1
+        time.sleep(self.server.latency.get(service, 0.0))
+
+    def do_POST(self):
+        path = self.path.split('?')[0]
+        try:
+            payload = self.read_json()
+        except ConnectionAbortedError:
+            return
+        if path.endswith('/chat/completions'):
+            self.wait('chat')
+            content = self.server.completion(payload)
+            if payload.get('stream'):
+                self.send_stream(content)
+                return
+            time.sleep(self.server.token_latency * len(content.split()))
+            self.send_json({'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}}]})
+        elif path.endswith('/embeddings'):
+            self.wait('embeddings')
+            inputs = payload['input'] if isinstance(payload['input'], list) else [payload['input']]
+            self.send_json({'data': [
+                {'index': i, 'embedding': self.server.embedding(text)} for i, text in enumerate(inputs)
+            ]})
+        elif re.fullmatch(r"/indexes(/[^/]+|\('[^/]+'\))/docs/search(\.post\.search)?", path):
+            self.wait('search')
+            self.send_json({'value': [{'content': f"Stub course document for: {payload.get('search', '')[:64]}"}]})
+        elif path.endswith('/language/:query-knowledgebases'):
+            self.wait('qa')
+            self.send_json({'answers': [{
+                'questions': ['How do I start the homework?'],
+                'answer': 'Read the assignment instructions first.',
+                'confidenceScore': 0.5
+            }]})
+        elif path.endswith('/vision/v3.2/read/analyze'):
+            self.wait('ocr')
+            operation_id = str(uuid.uuid4())
+            with self.server.lock:
+                self.server.operations[operation_id] = time.monotonic() + self.server.ocr_duration
+            self.send_json({}, status=202, headers={
+                'Operation-Location': f"{self.server.base_url}/vision/v3.2/read/analyzeResults/{operation_id}"
+            })
+        elif re.fullmatch(r'/api/(comments|threads)/[^/]+/comments', path):
+            self.wait('ed')
+            with self.server.lock:
+                self.server.comment_count += 1
+                comment_id = self.server.comment_count
+            self.send_json({'comment': {'id': comment_id}})
+        else:
+            self.send_json({'error': 'Not Found'}, status=404)
+
+    def do_PUT(self):
+        path = self.path.split('?')[0]
+        self.read_json()
+        if re.fullmatch(r'/api/comments/[^/]+', path):
+            self.wait('ed')
+            self.send_json({})
+        else:
+            self.send_json({'error': 'Not Found'}, status=404)
+
+    def do_GET(self):
+        if self.path.startswith('/images/'):
+            # Image bytes for OCR; the content only depends on the file name
+            body = self.path.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        match = re.fullmatch(r'/vision/v3.2/read/analyzeResults/([^/]+)', self.path.split('?')[0])
+        if not match:
+            self.send_json({'error': 'Not Found'}, status=404)
+            return
+        self.wait('ocr')
+        with self.server.lock:
+            ready_at = self.server.operations.get(match.group(1))
+        if ready_at is None:
+            self.send_json({'error': 'Not Found'}, status=404)
+        elif time.monotonic() < ready_at:
+            self.send_json({'status': 'running'})
+        else:
+            self.send_json({'status': 'succeeded', 'analyzeResult': {'readResults': [
+                {'lines': [{'text': f'stub OCR line for operation {match.group(1)[:8]}'}]}
+            ]}})
+
+    def do_DELETE(self):
+        if re.fullmatch(r'/api/comments/[^/]+', self.path.split('?')[0]):
+            self.wait('ed')
+            self.send_json({})
+        else:
+            self.send_json({'error': 'Not Found'}, status=404)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency: Dict[str, float] = None, ocr_duration: float = 0.0,
+                 embedding_dimensions: int = 8, completion=None, token_latency: float = 0.0):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.base_url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.latency = {**DEFAULT_LATENCY, **(latency or {})}
+        self.ocr_duration = ocr_duration
+        self.token_latency = token_latency
+        self.embedding_dimensions = embedding_dimensions
+        self.completion = completion or (lambda payload: 'Stub answer. Feel free to follow up!')
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.requests = {}
+        self.connections = 0
+        self.comment_count = 0
+
+    def embedding(self, text: str) -> list:
+        # Deterministic pseudo-embedding so identical texts map to identical vectors.
+        seed = sum(ord(c) for c in text)
+        return [((seed * (i + 7)) % 97) / 97 for i in range(self.embedding_dimensions)]
+
+
+def start_stub_server(**kwargs) -> Tuple[StubServer, str]:
+    """
+    Start a stub server on a free local port in a daemon thread.
+
+    Returns:
+        Tuple[StubServer, str]: The server and its base URL.
+    """
+    server = StubServer(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.base_url
+
+
+def stub_env(base_url: str) -> Dict[str, str]:
+    """
+    Environment variables pointing every service used by the pipeline at the stub server.
+    """
+    return {
+        'LLM_ENDPOINT': f"{base_url}/openai/deployments/gpt/chat/completions?api-version=2024-02-01",
+        'OPENAI_ENDPOINT': base_url,
+        'OPENAI_KEY': 'stub',
+        'SEARCH_ENDPOINT': base_url,
+        'SEARCH_KEY': 'stub',
+        'QA_ENDPOINT': base_url,
+        'QA_KEY': 'stub',
+        'OCR_ENDPOINT': base_url,
+        'OCR_KEY': 'stub',
+        'ED_API_URL': f"{base_url}/api",
+        'API_KEY': 'stub',
+    }
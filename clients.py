@@ -0,0 +1,115 @@
+import os
+import threading
+from typing import Any, Callable, Hashable
+
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
+from azure.cognitiveservices.vision.computervision import ComputerVisionClient
+from msrest.authentication import CognitiveServicesCredentials
+from azure.ai.language.questionanswering import QuestionAnsweringClient
+from openai import AzureOpenAI
+from azure.storage.blob import BlobServiceClient
+from azure.search.documents import SearchClient
+
+POOL_CONNECTIONS = 32
+POOL_MAXSIZE = 64
+
+
+class ClientRegistry:
+    """
+    Process-wide registry of service clients.
+
+    Clients are built on first use and reused by every later request. Keys include the
+    endpoint, credential and course-specific resource (index, container), so each course
+    gets its own search/container clients and rotated keys produce fresh clients.
+    """
+
+    def __init__(self):
+        self.clients = {}
+        self.lock = threading.RLock()  # factories may build the clients they depend on (e.g. the shared session)
+
+    def get(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        client = self.clients.get(key)
+        if client is None:
+            with self.lock:
+                client = self.clients.get(key)
+                if client is None:
+                    client = self.clients[key] = factory()
+        return client
+
+    def clear(self) -> None:
+        with self.lock:
+            self.clients.clear()
+
+
+registry = ClientRegistry()
+
+
+def get_http_session() -> requests.Session:
+    """
+    Get the shared keep-alive session used for raw HTTP calls and as the Azure SDK transport.
+    """
+    def create_session() -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+    return registry.get('http_session', create_session)
+
+
+def get_transport() -> RequestsTransport:
+    return RequestsTransport(session=get_http_session(), session_owner=False)
+
+
+def get_computervision_client() -> ComputerVisionClient:
+    endpoint, key = os.getenv('OCR_ENDPOINT'), os.getenv('OCR_KEY')
+    return registry.get(
+        ('computervision', endpoint, key),
+        lambda: ComputerVisionClient(endpoint, CognitiveServicesCredentials(key))
+    )
+
+
+def get_qa_client() -> QuestionAnsweringClient:
+    endpoint, key = os.getenv('QA_ENDPOINT'), os.getenv('QA_KEY')
+    return registry.get(
+        ('qa', endpoint, key),
+        lambda: QuestionAnsweringClient(endpoint, AzureKeyCredential(key), transport=get_transport())
+    )
+
+
+def get_openai_client() -> AzureOpenAI:
+    endpoint, key = os.getenv('OPENAI_ENDPOINT'), os.getenv('OPENAI_KEY')
+    return registry.get(
+        ('openai', endpoint, key),
+        lambda: AzureOpenAI(api_key=key, api_version="2024-02-01", azure_endpoint=endpoint)
+    )
+
+
+def get_search_client(index_name: str) -> SearchClient:
+    endpoint, key = os.getenv('SEARCH_ENDPOINT'), os.getenv('SEARCH_KEY')
+    return registry.get(
+        ('search', endpoint, key, index_name),
+        lambda: SearchClient(endpoint, index_name, AzureKeyCredential(key), transport=get_transport())
+    )
+
+
+def get_blob_service_client() -> BlobServiceClient:
+    connection_string = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
+    return registry.get(
+        ('blob', connection_string),
+        lambda: BlobServiceClient.from_connection_string(connection_string, transport=get_transport())
+    )
+
+
+def get_container_client(container_name: str):
+    """
+    Get the client of a blob container (the AZURE_BLOB_CONTAINER_NAME of a course config).
+    """
+    blob_service_client = get_blob_service_client()
+    return registry.get(
+        ('container', id(blob_service_client), container_name),
+        lambda: blob_service_client.get_container_client(container_name)
+    )
@@ -0,0 +1,243 @@
+import os
+import ast
+import logging
+import importlib
+import importlib.util
+import threading
+from types import MappingProxyType, ModuleType
+from typing import Dict, Iterable, Mapping, NamedTuple, Optional, Tuple
+
+from dotenv import dotenv_values
+
+logger = logging.getLogger(__name__)
+
+COURSE_PROMPTS = {
+    'ds100': 'prompts.ds100_multiturn_prompts',
+    'ds8': 'prompts.ds8_multiturn_prompts',
+    'cs61a': 'prompts.cs61a_multiturn_prompts',
+}
+CONFIG_DIR = 'configs'
+
+
+def resolve_course(course: str) -> str:
+    """
+    Map a course identifier sent by Ed (e.g. 'ds100-sp25') to its config name.
+
+    Args:
+        course (str): The course identifier.
+
+    Returns:
+        str: The config name of the course ('ds100', 'ds8' or 'cs61a').
+    """
+    for name in COURSE_PROMPTS:
+        if name in (course or ''):
+            return name
+    raise ValueError(f"Unsupported course: {course}")
+
+
+class CourseConfig(NamedTuple):
+    """
+    The settings and prompts of one course, parsed once from configs/<course>.env.
+
+    Settings the course file leaves unset (or empty) fall back to the process environment
+    (keys.env) as of loading. Configs are immutable and never touch os.environ, so requests of
+    different courses can run concurrently; reload_course_configs swaps in new ones.
+    """
+    name: str
+    prompts: ModuleType
+    values: Mapping[str, str]  # the raw values of the course file
+    assignment_categories: Tuple[str, ...]
+    content_categories: Tuple[str, ...]
+    logistics_categories: Tuple[str, ...]
+    worksheet_categories: Tuple[str, ...]
+    category_mapping: Mapping[str, str]
+    subcategory_mapping: Mapping[str, str]
+    content_index: Tuple[Optional[str], int, bool]  # index name, top k, semantic reranking
+    logistics_index: Tuple[Optional[str], int, bool]
+    worksheet_index: Tuple[Optional[str], int, bool]
+    qa_top_k: int
+    qa_project_name: Optional[str]
+    qa_deployment_name: Optional[str]
+    embedding_model_name: Optional[str]
+    retrieval_backend: str
+    local_index_dir: str
+    local_index_mmap: bool
+    container_name: Optional[str]
+    version: Optional[str]
+    qa_timeout: float
+    hybrid_timeout: float
+    manual_timeout: float
+    manual_retrieval_scorer: str
+    manual_retrieval_mode: str
+    manual_tree_prefix: str
+    manual_beam_width: int
+    manual_final_doc_count: int
+    manual_toc_candidates: int
+    assignment_generation_mode: str
+    assignment_latency_budget: Optional[float]
+    semantic_cache: bool
+    semantic_cache_threshold: float
+    job_priorities: Mapping[str, int]
+
+    @classmethod
+    def load(cls, course: str, config_dir: str = CONFIG_DIR, fresh_prompts: bool = False) -> 'CourseConfig':
+        """
+        Parse the config file and import the prompts module of a course.
+
+        Args:
+            course (str): The course identifier.
+            config_dir (str): The directory of the course config files.
+            fresh_prompts (bool): Execute the prompts module anew (to pick up edits) instead of
+                reusing the imported one.
+
+        Returns:
+            CourseConfig: The config of the course.
+        """
+        name = resolve_course(course)
+        path = os.path.join(config_dir, f'{name}.env')
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No config file for {name}: {path}")
+        values = {key: value for key, value in dotenv_values(path).items() if value is not None}
+        environment = dict(os.environ)
+
+        def setting(key, default=None):
+            value = values.get(key)
+            return value if value not in (None, '') else environment.get(key, default)
+
+        def literal(key, default):
+            return ast.literal_eval(setting(key) or default)
+
+        budget = setting('ASSIGNMENT_LATENCY_BUDGET')
+        return cls(
+            name=name,
+            prompts=load_prompts(COURSE_PROMPTS[name], fresh=fresh_prompts),
+            values=MappingProxyType(values),
+            assignment_categories=tuple(literal('ASSIGNMENT_CATEGORIES', '[]')),
+            content_categories=tuple(literal('CONTENT_CATEGORIES', '[]')),
+            logistics_categories=tuple(literal('LOGISTICS_CATEGORIES', '[]')),
+            worksheet_categories=tuple(literal('WORKSHEET_CATEGORIES', '[]')),
+            category_mapping=MappingProxyType(literal('CATEGORY_MAPPING', '{}')),
+            subcategory_mapping=MappingProxyType(literal('SUBCATEGORY_MAPPING', '{}')),
+            content_index=(setting('CONTENT_INDEX_NAME'), int(setting('CONTENT_INDEX_TOP_K', '1')), True),
+            logistics_index=(setting('LOGISTICS_INDEX_NAME'), int(setting('LOGISTICS_INDEX_TOP_K', '1')), False),
+            worksheet_index=(setting('WORKSHEET_INDEX_NAME'), int(setting('WORKSHEET_INDEX_TOP_K', '1')), True),
+            qa_top_k=int(setting('QA_TOP_K', '3')),
+            qa_project_name=setting('QA_PROJECT_NAME'),
+            qa_deployment_name=setting('QA_DEPLOYMENT_NAME'),
+            embedding_model_name=setting('EMBEDDING_MODEL_NAME'),
+            retrieval_backend=setting('RETRIEVAL_BACKEND', 'azure'),
+            local_index_dir=setting('LOCAL_INDEX_DIR', 'indexes'),
+            local_index_mmap=setting('LOCAL_INDEX_MMAP') == 'true',
+            container_name=setting('AZURE_BLOB_CONTAINER_NAME'),
+            version=setting('EDISON_VERSION'),
+            qa_timeout=float(setting('QA_TIMEOUT', '10')),
+            hybrid_timeout=float(setting('HYBRID_TIMEOUT', '10')),
+            manual_timeout=float(setting('MANUAL_TIMEOUT', '30')),
+            manual_retrieval_scorer=setting('MANUAL_RETRIEVAL_SCORER', 'llm'),
+            manual_retrieval_mode=setting('MANUAL_RETRIEVAL_MODE', 'traversal'),
+            manual_tree_prefix=setting('MANUAL_TREE_PREFIX', 'docs_manual/trees/'),
+            manual_beam_width=int(setting('MANUAL_BEAM_WIDTH', '3')),
+            manual_final_doc_count=int(setting('MANUAL_FINAL_DOC_COUNT', '1')),
+            manual_toc_candidates=int(setting('MANUAL_TOC_CANDIDATES', '6')),
+            assignment_generation_mode=setting('ASSIGNMENT_GENERATION_MODE', 'two_pass'),
+            assignment_latency_budget=float(budget) if budget else None,
+            semantic_cache=setting('SEMANTIC_CACHE') == 'true',
+            semantic_cache_threshold=float(setting('SEMANTIC_CACHE_THRESHOLD', '0.95')),
+            job_priorities=MappingProxyType(literal('JOB_PRIORITIES', '{}')),
+        )
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        """
+        A raw setting of the course, falling back to the process environment.
+        """
+        value = self.values.get(key)
+        return value if value not in (None, '') else os.getenv(key, default)
+
+    def hybrid_index_params(self, question_category: str) -> Optional[Tuple[str, int, bool]]:
+        """
+        Get the hybrid search parameters of the course for a question category.
+
+        Args:
+            question_category (str): The category of the question.
+
+        Returns:
+            Optional[Tuple[str, int, bool]]: The index name, top k and whether to use semantic reranking,
+                or None if the category does not use hybrid retrieval.
+        """
+        if question_category in self.content_categories:
+            return self.content_index
+        if question_category in self.logistics_categories:
+            return self.logistics_index
+        if question_category in self.worksheet_categories:
+            return self.worksheet_index
+        return None
+
+
+def load_prompts(module_name: str, fresh: bool = False) -> ModuleType:
+    """
+    Import a prompts module; with fresh, execute its current source into a new module object,
+    leaving the imported one (and the configs holding it) untouched.
+    """
+    if not fresh:
+        return importlib.import_module(module_name)
+    spec = importlib.util.find_spec(module_name)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+_course_configs: Dict[str, CourseConfig] = {}
+_course_configs_lock = threading.Lock()
+
+
+def load_course_configs(courses: Iterable[str] = COURSE_PROMPTS, config_dir: str = CONFIG_DIR) -> Dict[str, CourseConfig]:
+    """
+    Load the configs of the given courses into the registry at startup.
+    """
+    configs = {config.name: config for config in (CourseConfig.load(course, config_dir) for course in courses)}
+    with _course_configs_lock:
+        _course_configs.update(configs)
+    logger.info('Loaded course configs: %s', ', '.join(configs))
+    return configs
+
+
+def reload_course_configs(config_dir: str = CONFIG_DIR) -> Dict[str, CourseConfig]:
+    """
+    Re-read the config files and prompts modules of every course, e.g. after a deployment edited
+    them. All courses are parsed before any is replaced, so an invalid file leaves the registry as
+    it was; requests already running keep the config they started with.
+
+    Returns:
+        Dict[str, CourseConfig]: The new configs by course.
+    """
+    configs = {course: CourseConfig.load(course, config_dir, fresh_prompts=True) for course in COURSE_PROMPTS}
+    global _course_configs
+    with _course_configs_lock:
+        _course_configs = configs
+    logger.info('Reloaded course configs: %s', ', '.join(configs))
+    return dict(configs)
+
+
+def get_course_config(course: str) -> CourseConfig:
+    """
+    Get the config of a course (loading it on first use if it was not preloaded).
+
+    Args:
+        course (str): The course identifier.
+
+    Returns:
+        CourseConfig: The config of the course.
+    """
+    name = resolve_course(course)
+    config = _course_configs.get(name)
+    if config is None:
+        with _course_configs_lock:
+            config = _course_configs.get(name)
+            if config is None:
+                config = _course_configs[name] = CourseConfig.load(name)
+    return config
+
+
+def course_configs() -> Dict[str, CourseConfig]:
+    with _course_configs_lock:
+        return dict(_course_configs)
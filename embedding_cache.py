@@ -0,0 +1,144 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Fraction of max_disk_entries freed once the disk cache is over it, so evictions run in batches
+DISK_EVICTION_BATCH = 0.1
+
+
+def embedding_key(model_name: str, dimensions: Optional[int], text: str) -> str:
+    return f"{model_name}:{dimensions or ''}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+
+class EmbeddingCache:
+    """
+    Memoized embeddings keyed by (model, dimensions, SHA-256 of the text).
+
+    The in-memory layer is an LRU bounded by max_entries; when db_path is set, vectors are also
+    persisted to SQLite as float32 blobs (bounded by max_disk_entries) and survive restarts, so
+    rebuilding a tree or re-embedding a repeated question costs no API call.
+    """
+
+    def __init__(self, max_entries: int = 50000, db_path: Optional[str] = None, max_disk_entries: int = 1000000):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0}
+        self.db = None
+        self.disk_entries = 0  # upper bound on the rows on disk, recounted before evicting
+        if db_path:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS embedding_cache (key TEXT PRIMARY KEY, vector BLOB, last_used REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS embedding_cache_last_used ON embedding_cache (last_used)')
+            self.db.commit()
+            self.disk_entries = self.db.execute('SELECT COUNT(*) FROM embedding_cache').fetchone()[0]
+
+    @classmethod
+    def from_env(cls) -> 'EmbeddingCache':
+        return cls(
+            max_entries=int(os.getenv('EMBEDDING_CACHE_SIZE', '50000')),
+            db_path=os.getenv('EMBEDDING_CACHE_PATH') or None
+        )
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, List[float]]:
+        """
+        Look up several keys at once; missing keys are left out of the result.
+        """
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[key] = self.entries[key]
+            missing = [key for key in keys if key not in found]
+            if self.db is not None and missing:
+                now = time.time()
+                for start in range(0, len(missing), 500):
+                    chunk = missing[start:start + 500]
+                    rows = self.db.execute(
+                        f"SELECT key, vector FROM embedding_cache WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                    ).fetchall()
+                    for key, blob in rows:
+                        found[key] = np.frombuffer(blob, dtype=np.float32)
+                        self._remember(key, found[key])
+                    self.db.executemany('UPDATE embedding_cache SET last_used = ? WHERE key = ?',
+                                        [(now, key) for key, _ in rows])
+                self.db.commit()
+            self.counters['hits'] += len(found)
+            self.counters['misses'] += len(keys) - len(found)
+        return {key: vector.tolist() for key, vector in found.items()}
+
+    def put_many(self, items: Iterable[Tuple[str, List[float]]]) -> None:
+        with self.lock:
+            rows = []
+            now = time.time()
+            for key, vector in items:
+                vector = np.asarray(vector, dtype=np.float32)
+                self._remember(key, vector)
+                rows.append((key, vector.tobytes(), now))
+            if self.db is not None and rows:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO embedding_cache (key, vector, last_used) VALUES (?, ?, ?)', rows
+                )
+                self.disk_entries += len(rows)
+                if self.disk_entries > self.max_disk_entries:
+                    self._evict_disk()
+                self.db.commit()
+
+    def _evict_disk(self) -> None:
+        """
+        Delete the least recently used rows beyond max_disk_entries (less DISK_EVICTION_BATCH of it).
+        """
+        self.disk_entries = self.db.execute('SELECT COUNT(*) FROM embedding_cache').fetchone()[0]
+        if self.disk_entries <= self.max_disk_entries:
+            return
+        keep = int(self.max_disk_entries * (1 - DISK_EVICTION_BATCH))
+        self.disk_entries -= self.db.execute(
+            'DELETE FROM embedding_cache WHERE key IN '
+            '(SELECT key FROM embedding_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+            (keep,)
+        ).rowcount
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            return {
+                **self.counters,
+                'hit_rate': self.counters['hits'] / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+            }
+
+
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """
+    Get the process-wide embedding cache, configured by EMBEDDING_CACHE_SIZE and EMBEDDING_CACHE_PATH on first use.
+    """
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache.from_env()
+        return _embedding_cache
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from courses import resolve_course
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def request_key(input_dict: Dict[str, Any]) -> str:
+    """
+    Idempotency key of a question request: (course, question_id, comment_id, conversation hash).
+    Ed retries and repeated TA triggers of the same prompt share it; a new turn of the thread does not.
+    """
+    conversation = json.dumps(input_dict.get('conversation_history'), sort_keys=True)
+    return ':'.join((
+        resolve_course(input_dict.get('course')),
+        str(input_dict.get('question_id', '')),
+        str(input_dict.get('comment_id', '')),
+        hashlib.sha256(conversation.encode('utf-8')).hexdigest()
+    ))
+
+
+class IdempotencyStore:
+    """
+    Runs each request key at most once at a time and remembers its result for ttl seconds.
+
+    A duplicate that arrives while the first request is still running waits for that computation
+    instead of starting its own (coalesced); one that arrives after it finished gets the stored
+    result (hit). Failures are not stored, so a retry after an error runs again. Beyond
+    max_entries the least recently used results are evicted.
+    """
+
+    def __init__(self, ttl: float = 600, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.results = OrderedDict()  # key -> (value, expires_at)
+        self.in_flight = {}  # key -> concurrent.futures.Future of the running computation
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'coalesced': 0, 'misses': 0, 'evictions': 0}
+
+    @classmethod
+    def from_env(cls) -> 'IdempotencyStore':
+        return cls(
+            ttl=float(os.getenv('IDEMPOTENCY_TTL', '600')),
+            max_entries=int(os.getenv('IDEMPOTENCY_SIZE', '10000'))
+        )
+
+    def _claim(self, key: str) -> Tuple[Optional[Future], Optional[Future], Any]:
+        """
+        Returns (future to run, None, None) for the first request of a key, (None, future to wait
+        on, None) for a duplicate of a running one and (None, None, value) for a stored result.
+        """
+        with self.lock:
+            now = time.time()
+            if key in self.results:
+                value, expires_at = self.results[key]
+                if expires_at > now:
+                    self.results.move_to_end(key)
+                    self.counters['hits'] += 1
+                    return None, None, value
+                del self.results[key]
+            if key in self.in_flight:
+                self.counters['coalesced'] += 1
+                return None, self.in_flight[key], None
+            future = self.in_flight[key] = Future()
+            self.counters['misses'] += 1
+            return future, None, None
+
+    def _complete(self, key: str, future: Future, value: Any = None, error: Optional[BaseException] = None) -> None:
+        with self.lock:
+            del self.in_flight[key]
+            if error is None:
+                self.results[key] = (value, time.time() + self.ttl)
+                while len(self.results) > self.max_entries:
+                    self.results.popitem(last=False)
+                    self.counters['evictions'] += 1
+        if error is None:
+            future.set_result(value)
+        else:
+            future.set_exception(error)
+
+    def run(self, key: str, compute: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Run compute for a key unless it is running or recently ran.
+
+        Returns:
+            Tuple[Any, bool]: The result and whether it was shared with an earlier request.
+        """
+        future, pending, value = self._claim(key)
+        if future is None:
+            logger.info('Duplicate request %s', key)
+            return (pending.result() if pending is not None else value), True
+        try:
+            value = compute()
+        except BaseException as e:
+            self._complete(key, future, error=e)
+            raise
+        self._complete(key, future, value)
+        return value, False
+
+    async def run_async(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Async variant of run: a duplicate waits for the running computation without blocking the event loop.
+        """
+        future, pending, value = self._claim(key)
+        if future is None:
+            logger.info('Duplicate request %s', key)
+            return (await asyncio.wrap_future(pending) if pending is not None else value), True
+        try:
+            value = await compute()
+        except BaseException as e:
+            self._complete(key, future, error=e)
+            raise
+        self._complete(key, future, value)
+        return value, False
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            requests = self.counters['hits'] + self.counters['coalesced'] + self.counters['misses']
+            return {
+                **self.counters,
+                'duplicate_rate': (self.counters['hits'] + self.counters['coalesced']) / requests if requests else 0.0,
+                'entries': len(self.results),
+                'in_flight': len(self.in_flight),
+            }
+
+
+_idempotency_store = None
+_idempotency_store_lock = threading.Lock()
+
+
+def get_idempotency_store() -> IdempotencyStore:
+    """
+    Get the process-wide idempotency store, configured by IDEMPOTENCY_TTL and IDEMPOTENCY_SIZE.
+    """
+    global _idempotency_store
+    with _idempotency_store_lock:
+        if _idempotency_store is None:
+            _idempotency_store = IdempotencyStore.from_env()
+        return _idempotency_store
@@ -0,0 +1,326 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class PermanentJobError(Exception):
+    """
+    Raised by a handler whose job must not be retried, e.g. because it already had side effects.
+    """
+
+
+class JobQueue:
+    """
+    Durable job queue backed by SQLite, drained by a pool of worker threads.
+
+    Jobs are claimed highest priority first (then oldest first) under a lease: a job whose worker
+    died (or whose process restarted) is picked up again once its lease expires, so several
+    processes can share one database; a worker whose lease expired cannot overwrite the outcome of
+    the attempt that took the job over. A failed job is retried after retry_delay seconds, doubling
+    on each attempt, until max_attempts (unless its handler raised PermanentJobError); finished
+    jobs are kept for retention seconds so that their status can be looked up. Jobs enqueued with
+    a key are deduplicated (enqueue_once) while one of that key is pending or finished less than
+    dedup_window seconds ago.
+    """
+
+    def __init__(self, db_path: str, workers: int = 4, max_attempts: int = 3, retry_delay: float = 30,
+                 lease: float = 600, retention: float = 86400, dedup_window: float = 600, poll_interval: float = 1.0):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease = lease
+        self.retention = retention
+        self.dedup_window = dedup_window
+        self.poll_interval = poll_interval
+        self.handlers = {}
+        self.threads = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.stopped = threading.Event()
+        self.counters = {'enqueued': 0, 'deduplicated': 0, 'completed': 0, 'retried': 0, 'failed': 0}
+        self.wait_seconds = deque(maxlen=1000)  # enqueue -> first claim of recent jobs
+        self.run_seconds = deque(maxlen=1000)  # claim -> completion of recent jobs
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, payload TEXT, '
+            'priority INTEGER, status TEXT, attempts INTEGER DEFAULT 0, available_at REAL, lease_until REAL, '
+            'created_at REAL, started_at REAL, finished_at REAL, result TEXT, error TEXT)'
+        )
+        if 'key' not in [column[1] for column in self.db.execute('PRAGMA table_info(jobs)')]:
+            self.db.execute('ALTER TABLE jobs ADD COLUMN key TEXT')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, priority, available_at)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)')
+
+    @classmethod
+    def from_env(cls) -> 'JobQueue':
+        return cls(
+            db_path=os.getenv('JOB_QUEUE_PATH') or 'jobs/jobs.db',
+            workers=int(os.getenv('JOB_WORKERS', '4')),
+            max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', '3')),
+            retry_delay=float(os.getenv('JOB_RETRY_DELAY', '30')),
+            lease=float(os.getenv('JOB_LEASE', '600')),
+            retention=float(os.getenv('JOB_RETENTION', '86400')),
+            dedup_window=float(os.getenv('IDEMPOTENCY_TTL', '600'))
+        )
+
+    def enqueue(self, kind: str, payload: Dict[str, Any], priority: int = 0) -> int:
+        """
+        Add a job; higher priorities are claimed first.
+
+        Returns:
+            int: The job id.
+        """
+        now = time.time()
+        with self.wakeup:
+            job_id = self.db.execute(
+                'INSERT INTO jobs (kind, payload, priority, status, available_at, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (kind, json.dumps(payload), priority, QUEUED, now, now)
+            ).lastrowid
+            self.counters['enqueued'] += 1
+            self.wakeup.notify()
+        return job_id
+
+    def enqueue_once(self, kind: str, payload: Dict[str, Any], key: str, priority: int = 0) -> Tuple[int, bool]:
+        """
+        Add a job unless one with the same key is queued, running, or finished successfully within
+        the last dedup_window seconds.
+
+        Returns:
+            Tuple[int, bool]: The id of the new or existing job, and whether it already existed.
+        """
+        now = time.time()
+        with self.wakeup:
+            self.db.execute('BEGIN IMMEDIATE')  # no other process can add the same key in between
+            try:
+                row = self.db.execute(
+                    'SELECT id FROM jobs WHERE key = ? AND (status IN (?, ?) OR (status = ? AND finished_at >= ?)) '
+                    'ORDER BY id DESC LIMIT 1',
+                    (key, QUEUED, RUNNING, DONE, now - self.dedup_window)
+                ).fetchone()
+                if row is None:
+                    job_id = self.db.execute(
+                        'INSERT INTO jobs (kind, payload, priority, status, available_at, created_at, key) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (kind, json.dumps(payload), priority, QUEUED, now, now, key)
+                    ).lastrowid
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+            if row is not None:
+                self.counters['deduplicated'] += 1
+                return row[0], True
+            self.counters['enqueued'] += 1
+            self.wakeup.notify()
+        return job_id, False
+
+    def _claim(self) -> Optional[tuple]:
+        """
+        Take the next available job (or one whose lease expired) and lease it to the caller.
+
+        Returns:
+            Optional[tuple]: The job (id, kind, payload, attempts, created_at, started_at) followed by
+            the end of its lease, which identifies this attempt to _finish; None if no job is available.
+        """
+        now = time.time()
+        lease_until = now + self.lease
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')  # the select and update are atomic across processes
+            try:
+                row = self.db.execute(
+                    'SELECT id, kind, payload, attempts, created_at, started_at FROM jobs '
+                    'WHERE (status = ? AND available_at <= ?) OR (status = ? AND lease_until < ? AND attempts < ?) '
+                    'ORDER BY priority DESC, id LIMIT 1',
+                    (QUEUED, now, RUNNING, now, self.max_attempts)
+                ).fetchone()
+                if row is not None:
+                    self.db.execute(
+                        'UPDATE jobs SET status = ?, attempts = attempts + 1, lease_until = ?, '
+                        'started_at = COALESCE(started_at, ?) WHERE id = ?',
+                        (RUNNING, lease_until, now, row[0])
+                    )
+                    row += (lease_until,)
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+            if row is not None and row[5] is None:
+                self.wait_seconds.append(now - row[4])
+        return row
+
+    def _finish(self, job_id: int, lease_until: float, attempts: int, started: float, result: Any = None,
+                error: Optional[str] = None) -> None:
+        """
+        Record the outcome of an attempt, unless its lease expired and the job was claimed again.
+        """
+        now = time.time()
+        with self.lock:
+            if error is None:
+                updated = self.db.execute(
+                    'UPDATE jobs SET status = ?, finished_at = ?, result = ?, error = NULL '
+                    'WHERE id = ? AND lease_until = ?',
+                    (DONE, now, json.dumps(result), job_id, lease_until)
+                ).rowcount
+                counter = 'completed'
+            elif attempts < self.max_attempts:
+                updated = self.db.execute(
+                    'UPDATE jobs SET status = ?, available_at = ?, error = ? WHERE id = ? AND lease_until = ?',
+                    (QUEUED, now + self.retry_delay * 2 ** (attempts - 1), error, job_id, lease_until)
+                ).rowcount
+                counter = 'retried'
+            else:
+                updated = self.db.execute(
+                    'UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ? AND lease_until = ?',
+                    (FAILED, now, error, job_id, lease_until)
+                ).rowcount
+                counter = 'failed'
+            if not updated:
+                logger.warning('Job %d lost its lease before finishing; its outcome is discarded', job_id)
+                return
+            self.counters[counter] += 1
+            if counter == 'completed':
+                self.run_seconds.append(now - started)
+
+    def run_next(self) -> bool:
+        """
+        Run one available job with the handler of its kind.
+
+        Returns:
+            bool: Whether a job was run.
+        """
+        row = self._claim()
+        if row is None:
+            return False
+        job_id, kind, payload, attempts, lease_until = row[0], row[1], json.loads(row[2]), row[3] + 1, row[6]
+        started = time.time()
+        try:
+            result = self.handlers[kind](payload)
+        except PermanentJobError as e:
+            logger.exception('Job %d (%s) failed permanently on attempt %d: %s', job_id, kind, attempts, e)
+            self._finish(job_id, lease_until, self.max_attempts, started, error=f'{type(e).__name__}: {e}')
+        except Exception as e:
+            logger.exception('Job %d (%s) failed on attempt %d: %s', job_id, kind, attempts, e)
+            self._finish(job_id, lease_until, attempts, started, error=f'{type(e).__name__}: {e}')
+        else:
+            self._finish(job_id, lease_until, attempts, started, result=result)
+        return True
+
+    def purge(self) -> int:
+        """
+        Fail the jobs whose last attempt never finished, and delete the jobs that finished more
+        than retention seconds ago.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, error = 'Lease expired' "
+                'WHERE status = ? AND lease_until < ? AND attempts >= ?',
+                (FAILED, now, RUNNING, now, self.max_attempts)
+            )
+            return self.db.execute('DELETE FROM jobs WHERE finished_at < ?', (now - self.retention,)).rowcount
+
+    def _work(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                if self.run_next():
+                    continue
+                self.purge()
+            except Exception as e:
+                logger.error(f"Error running jobs: {e}")
+            with self.wakeup:
+                self.wakeup.wait(self.poll_interval)
+
+    def start(self, handlers: Dict[str, Callable[[Dict[str, Any]], Any]]) -> None:
+        """
+        Register the handler of each job kind and start the worker threads.
+        """
+        self.handlers.update(handlers)
+        if self.threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self) -> None:
+        self.stopped.set()
+        with self.wakeup:
+            self.wakeup.notify_all()
+
+    def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """
+        The status of a job (and its result once done), or None if it does not exist.
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT id, kind, priority, status, attempts, created_at, started_at, finished_at, result, error '
+                'FROM jobs WHERE id = ?', (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(('id', 'kind', 'priority', 'status', 'attempts', 'created_at', 'started_at',
+                        'finished_at', 'result', 'error'), row))
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+        return job
+
+    def stats(self) -> Dict[str, float]:
+        now = time.time()
+        with self.lock:
+            statuses = dict(self.db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+            depth_by_priority = dict(self.db.execute(
+                'SELECT priority, COUNT(*) FROM jobs WHERE status = ? GROUP BY priority', (QUEUED,)
+            ).fetchall())
+            oldest = self.db.execute('SELECT MIN(created_at) FROM jobs WHERE status = ?', (QUEUED,)).fetchone()[0]
+            wait_seconds, run_seconds = list(self.wait_seconds), list(self.run_seconds)
+            counters = dict(self.counters)
+
+        def percentile(values, q):
+            return float(np.percentile(values, q)) if values else 0.0
+
+        return {
+            **counters,
+            'depth': statuses.get(QUEUED, 0),
+            'running': statuses.get(RUNNING, 0),
+            'depth_by_priority': {str(priority): count for priority, count in depth_by_priority.items()},
+            'oldest_queued_seconds': now - oldest if oldest is not None else 0.0,
+            'wait_p50': percentile(wait_seconds, 50),
+            'wait_p95': percentile(wait_seconds, 95),
+            'run_p50': percentile(run_seconds, 50),
+            'run_p95': percentile(run_seconds, 95),
+            'workers': len(self.threads),
+        }
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """
+    Get the process-wide job queue, configured by JOB_QUEUE_PATH, JOB_WORKERS, JOB_MAX_ATTEMPTS,
+    JOB_RETRY_DELAY, JOB_LEASE, JOB_RETENTION and IDEMPOTENCY_TTL on first use.
+    """
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue.from_env()
+        return _job_queue
@@ -0,0 +1,219 @@
+import os
+import re
+import json
+import logging
+import argparse
+import threading
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from courses import course_configs, get_course_config
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+TOKEN_PATTERN = re.compile(r'\w+')
+RRF_K = 60
+CANDIDATES = 50
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """
+    Okapi BM25 over an inverted index of term -> (document ids, term frequencies).
+    """
+
+    def __init__(self, documents: Sequence[str], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.num_documents = len(documents)
+        postings = defaultdict(lambda: ([], []))
+        lengths = np.zeros(len(documents), dtype=np.float32)
+        for doc_id, document in enumerate(documents):
+            counts = Counter(tokenize(document))
+            lengths[doc_id] = sum(counts.values())
+            for term, count in counts.items():
+                postings[term][0].append(doc_id)
+                postings[term][1].append(count)
+        self.postings = {
+            term: (np.asarray(doc_ids, dtype=np.int32), np.asarray(counts, dtype=np.float32))
+            for term, (doc_ids, counts) in postings.items()
+        }
+        self.length_norm = 1 - b + b * lengths / max(float(lengths.mean()) if len(documents) else 0.0, 1.0)
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.num_documents, dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            doc_ids, counts = self.postings[term]
+            idf = np.log(1 + (self.num_documents - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            scores[doc_ids] += idf * counts * (self.k1 + 1) / (counts + self.k1 * self.length_norm[doc_ids])
+        return scores
+
+
+def top_ranks(scores: np.ndarray, k: int, positive_only: bool = False) -> List[int]:
+    k = min(k, len(scores))
+    if k == 0:
+        return []
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    ranked = candidates[np.argsort(-scores[candidates], kind='stable')]
+    return [int(i) for i in ranked if not positive_only or scores[i] > 0]
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int = RRF_K) -> List[int]:
+    fused = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            fused[doc_id] += 1 / (k + rank + 1)
+    return sorted(fused, key=fused.get, reverse=True)
+
+
+class LocalIndex:
+    """
+    In-memory retrieval over a course index small enough to hold in the process.
+
+    An index directory holds documents.json (a list of {"content": ...}) and vectors.npy (one
+    unit-norm float32 embedding per document, optionally memory-mapped). Queries are ranked by
+    cosine similarity and by BM25 and the rankings are fused by reciprocal rank, like the hybrid
+    queries sent to Azure AI Search.
+    """
+
+    def __init__(self, documents: List[str], vectors: np.ndarray):
+        if len(documents) != len(vectors):
+            raise ValueError(f"{len(documents)} documents but {len(vectors)} vectors")
+        self.documents = documents
+        self.vectors = vectors
+        self.bm25 = BM25Index(documents)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = False) -> 'LocalIndex':
+        directory = Path(directory)
+        with open(directory / 'documents.json') as f:
+            documents = [document['content'] for document in json.load(f)]
+        vectors = np.load(directory / 'vectors.npy', mmap_mode='r' if mmap else None)
+        logger.info('Loaded local index %s (%d documents)', directory, len(documents))
+        return cls(documents, vectors)
+
+    @staticmethod
+    def save(directory: str, documents: List[str], vectors: List[List[float]]) -> None:
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.save(directory / 'vectors.npy', vectors / np.where(norms == 0, 1, norms))
+        with open(directory / 'documents.json', 'w') as f:
+            json.dump([{'content': document} for document in documents], f)
+
+    def rank(self, text: str, vector: Optional[List[float]], top_k: int) -> List[int]:
+        """
+        Get the ids of the top documents of a hybrid query.
+
+        Args:
+            text (str): The text query, ranked with BM25.
+            vector (Optional[List[float]]): The query embedding, ranked by cosine similarity (skipped if None).
+            top_k (int): The number of documents to return.
+
+        Returns:
+            List[int]: The ids (positions) of the top documents, best first.
+        """
+        candidates = max(top_k, CANDIDATES)
+        rankings = [top_ranks(self.bm25.scores(text), candidates, positive_only=True)]
+        if vector is not None:
+            rankings.append(top_ranks(self.vectors @ np.asarray(vector, dtype=np.float32), candidates))
+        return reciprocal_rank_fusion(rankings)[:top_k]
+
+    def search(self, text: str, vector: Optional[List[float]], top_k: int) -> List[str]:
+        """
+        Get the contents of the top documents of a hybrid query (see rank).
+        """
+        return [self.documents[doc_id] for doc_id in self.rank(text, vector, top_k)]
+
+
+_local_indexes = {}  # path -> (files stamp, mmap, index)
+_local_indexes_lock = threading.Lock()
+
+
+def _files_stamp(path: str):
+    """
+    The modification time and size of the files of an index, which change when it is rebuilt.
+    """
+    stats = [os.stat(os.path.join(path, name)) for name in ('documents.json', 'vectors.npy')]
+    return tuple((stat.st_mtime_ns, stat.st_size) for stat in stats)
+
+
+def get_local_index(index_dir: str, index_name: str, mmap: bool = False) -> LocalIndex:
+    """
+    Get a local index, loading it on first use and reloading it when its files change (the
+    previous load keeps being served if the reload fails, e.g. while the index is being rewritten).
+
+    Args:
+        index_dir (str): The directory holding one subdirectory per index.
+        index_name (str): The name of the index (same as the Azure AI Search index name).
+        mmap (bool): Whether to memory-map the vectors instead of reading them into memory.
+
+    Returns:
+        LocalIndex: The loaded index.
+    """
+    path = os.path.join(index_dir, index_name)
+    with _local_indexes_lock:
+        cached = _local_indexes.get(path)
+        try:
+            stamp = _files_stamp(path)
+            if cached is None or cached[:2] != (stamp, mmap):
+                _local_indexes[path] = (stamp, mmap, LocalIndex.load(path, mmap=mmap))
+        except Exception as e:
+            if cached is None:
+                raise
+            logger.error(f"Error reloading local index {path}, keeping the previous one: {e}")
+        return _local_indexes[path][2]
+
+
+def preload_local_indexes() -> None:
+    """
+    Load the indexes of every course configured with RETRIEVAL_BACKEND=local, so that the first
+    request does not pay for it; indexes rebuilt since they were loaded are reloaded.
+    """
+    for course, config in course_configs().items():
+        if config.retrieval_backend != 'local':
+            continue
+        index_names = {config.content_index[0], config.logistics_index[0], config.worksheet_index[0]}
+        for index_name in filter(None, index_names):
+            try:
+                get_local_index(config.local_index_dir, index_name, mmap=config.local_index_mmap)
+            except Exception as e:
+                logger.error(f"Error loading local index {index_name} of {course}: {e}")
+
+
+def export_search_index(index_name: str, index_dir: str, model_name: str) -> None:
+    """
+    Copy the documents of an Azure AI Search index into a local index directory.
+    """
+    from clients import get_search_client
+    from utils import embed_texts
+
+    documents = [result['content'] for result in get_search_client(index_name).search(search_text='*', select=['content'])]
+    LocalIndex.save(os.path.join(index_dir, index_name), documents, embed_texts(documents, model_name=model_name))
+    logger.info('Exported %d documents of %s', len(documents), index_name)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Manage local retrieval indexes')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export = subparsers.add_parser('export', help='Export an Azure AI Search index to a local index')
+    export.add_argument('course')
+    export.add_argument('index_name')
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+
+    load_dotenv('./keys.env')
+    config = get_course_config(args.course)
+    export_search_index(args.index_name, config.local_index_dir, config.embedding_model_name)
@@ -1,6 +1,9 @@
 import os
 import json
-from tree_utils import generate_leaf_nodes, build_balanced_tree, create_TOC
+from tree_utils import (generate_leaf_nodes, build_balanced_tree, build_tree_parallel, update_TOC_entry,
+                        write_node_embeddings)
+
+CHECKPOINT_DIR = "checkpoints"
 
 def process_json(input_file, output_file, branch_factor=3):
     with open(input_file, "r", encoding="utf-8") as file:
@@ -19,7 +22,14 @@ def process_json(input_file, output_file, branch_factor=3):
 
     print(f"Processed data saved to {output_file}")
 
-def build_tree_from_chunks(input_file, output_file, tree_dir, branch_factor=3):
+def build_tree_from_chunks(input_file, output_file, tree_dir, embedding_model, branch_factor=3, max_workers=8,
+                           requests_per_minute=None):
+    """
+    Builds a tree with the parallel builder; summaries are checkpointed under tree_dir/checkpoints,
+    so rerunning after a crash resumes the build. If the tree already exists, only the summaries
+    whose inputs changed are regenerated, and only its TOC entry is updated. The node embeddings
+    are written with embedding_model (the EMBEDDING_MODEL_NAME of the course config).
+    """
     with open(input_file, "r", encoding="utf-8") as file:
         data = json.load(file)
 
@@ -27,9 +37,15 @@ def build_tree_from_chunks(input_file, output_file, tree_dir, branch_factor=3):
         print(f"Skipping {input_file}: Input JSON must be a list of strings.")
         return
 
-    chunks = [chunk for chunk in data if chunk.strip()]
-    leaf_nodes = generate_leaf_nodes(chunks)
-    hierarchy = build_balanced_tree(leaf_nodes, branch_factor=branch_factor)
+    previous_tree = None
+    if os.path.exists(output_file):
+        with open(output_file, "r", encoding="utf-8") as file:
+            previous_tree = json.load(file)
+
+    checkpoint_path = os.path.join(tree_dir, CHECKPOINT_DIR, os.path.basename(output_file) + "l")
+    hierarchy = build_tree_parallel(data, branch_factor=branch_factor, max_workers=max_workers,
+                                    requests_per_minute=requests_per_minute, checkpoint_path=checkpoint_path,
+                                    previous_tree=previous_tree)
 
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
     with open(output_file, "w", encoding="utf-8") as file:
@@ -37,18 +53,23 @@ def build_tree_from_chunks(input_file, output_file, tree_dir, branch_factor=3):
 
     print(f"Processed data saved to {output_file}")
 
-    # Update TOC after processing this file
-    create_TOC(tree_dir)
-    print("TOC updated!")
+    # Update the TOC entry of this file
+    update_TOC_entry(tree_dir, os.path.basename(output_file), hierarchy)
+
+    # Node embeddings for the embedding scorer of the beam search; without them the tree is still
+    # searchable with the LLM scorer, and a rerun only embeds what is missing
+    try:
+        write_node_embeddings(hierarchy, output_file, embedding_model)
+    except Exception as e:
+        print(f"Error writing the node embeddings of {output_file}: {e}")
 
 
-def build_tree(chunks, branch_factor=3):
+def build_tree(chunks, branch_factor=3, max_workers=8, requests_per_minute=None, checkpoint_path=None):
     """
     Accepts a list of string chunks, builds and returns the hierarchy tree as a dict.
     Used when chunks are already in memory (e.g., from blob download).
     """
     if not isinstance(chunks, list):
         raise ValueError("Chunks must be a list of strings.")
-    filtered = [chunk for chunk in chunks if chunk.strip()]
-    leaf_nodes = generate_leaf_nodes(filtered)
-    return build_balanced_tree(leaf_nodes, branch_factor=branch_factor)
\ No newline at end of file
+    return build_tree_parallel(chunks, branch_factor=branch_factor, max_workers=max_workers,
+                               requests_per_minute=requests_per_minute, checkpoint_path=checkpoint_path)
\ No newline at end of file
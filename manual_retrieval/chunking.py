@@ -2,9 +2,15 @@ import ast
 import json
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from utils import generate
 
+QUESTION_HEADER_PATTERN = re.compile(
+    r'^[#*\s]*((?:Question|Problem|Exercise|Task|Part|Q)\s*\d+[a-z]?(?:\.\d+)*\b[^\n]{0,80}?)[*\s]*$',
+    re.IGNORECASE | re.MULTILINE
+)
+
 def read_markdown_file(filepath):
     with open(filepath, 'r') as file:
         text = file.read()
@@ -80,6 +86,47 @@ def accumulate_question_headers(sections):
             print(f"Error parsing headers update: {e}")
     return accumulated_headers
 
+def parse_headers(headers_update):
+    try:
+        new_headers = ast.literal_eval(headers_update)
+        if isinstance(new_headers, list):
+            return new_headers
+        print("Unexpected format for headers. Skipping update.")
+    except Exception as e:
+        print(f"Error parsing headers update: {e}")
+    return []
+
+def regex_question_headers(text):
+    """
+    Cheap pre-pass: lines that obviously are question headers ('## Question 3: Joins', 'Q1d', ...).
+    """
+    return list(dict.fromkeys(match.group(1).strip() for match in QUESTION_HEADER_PATTERN.finditer(text)))
+
+def accumulate_question_headers_map_reduce(sections, max_workers=8, regex_prepass=True):
+    """
+    Map-reduce variant of accumulate_question_headers: every section is scanned concurrently (each
+    prompt only sees the regex pre-pass headers instead of the running list), then the per-section
+    lists are merged in document order and deduplicated.
+    """
+    known_headers = regex_question_headers('\n'.join('\n'.join(section) for section in sections)) if regex_prepass else []
+
+    def extract(section):
+        headers_update = generate(get_question_headers_prompt(known_headers, '\n\n'.join(section)), temperature=0.1)
+        print("Question headers update:", headers_update)
+        return parse_headers(headers_update)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        section_headers = list(executor.map(extract, sections))
+
+    accumulated_headers = []
+    seen = set()
+    for header in known_headers + [header for headers in section_headers for header in headers]:
+        normalized = ' '.join(str(header).split()).lower()
+        if normalized and normalized not in seen:
+            seen.add(normalized)
+            accumulated_headers.append(header)
+    return accumulated_headers
+
 def get_clean_headers_prompt(headers):
     prompt_text = (
         "You are an expert at cleaning up lists of question headers. "
@@ -108,18 +155,24 @@ def clean_question_headers(headers):
         print(f"Error parsing cleaned headers: {e}")
         return headers
 
+def compile_header_pattern(headers):
+    """
+    One alternation of all the headers, longest first: a scan matches the longest header starting at
+    the leftmost position, and matches never overlap (a header inside an already matched one, e.g.
+    "1a" in "Question 1a", does not split it again).
+    """
+    headers = sorted({header for header in headers if header}, key=lambda header: (-len(header), header))
+    if not headers:
+        return None
+    return re.compile('|'.join(re.escape(header) for header in headers))
+
 def split_document_by_headers(text, headers):
     chunks = []
     start_idx = 0
-    header_positions = []
-
-    for header in headers:
-        matches = [(m.start(), header) for m in re.finditer(re.escape(header), text)]
-        header_positions.extend(matches)
+    pattern = compile_header_pattern(headers)
+    header_positions = [m.start() for m in pattern.finditer(text)] if pattern else []
 
-    header_positions.sort()
-
-    for pos, header in header_positions:
+    for pos in header_positions:
         if pos > start_idx:
             chunk = text[start_idx:pos].strip()
             if chunk:
@@ -132,11 +185,18 @@ def split_document_by_headers(text, headers):
 
     return chunks
 
-def chunk_markdown_file(full_text):
+def chunk_markdown_file(full_text, mode='map_reduce'):
+    """
+    mode: 'map_reduce' scans all sections concurrently, 'sequential' scans them one by one with the
+    running header list in every prompt.
+    """
     # print(f"Processing: {input_path}")
     # full_text = read_markdown_file(input_path)
     sections = split_into_sections(full_text, type='line', section_length=32, overlap=16)
-    question_headers = accumulate_question_headers(sections)
+    if mode == 'sequential':
+        question_headers = accumulate_question_headers(sections)
+    else:
+        question_headers = accumulate_question_headers_map_reduce(sections)
     print("Accumulated Question Headers:")
     print(question_headers)
     cleaned_headers = clean_question_headers(question_headers)
@@ -149,7 +209,7 @@ def chunk_markdown_file(full_text):
     #     json.dump(chunks, file, indent=4)
     # print(f"Saved header-split chunks to: {output_path}")
 
-def main(input_dir, output_dir):
+def main(input_dir, output_dir, mode='map_reduce'):
 
     os.makedirs(output_dir, exist_ok=True)
     for filename in os.listdir(input_dir):
@@ -157,15 +217,7 @@ def main(input_dir, output_dir):
         outpath = os.path.join(output_dir, filename.replace(".md", ".json"))
         print(f"Processing: {inpath}")
         full_text = read_markdown_file(inpath)
-        sections = split_into_sections(full_text, type='line', section_length=32, overlap=16)
-        question_headers = accumulate_question_headers(sections)
-        print("Accumulated Question Headers:")
-        print(question_headers)
-        cleaned_headers = clean_question_headers(question_headers)
-        print("Cleaned Question Headers:")
-        print(cleaned_headers)
-        header_split_chunks = split_document_by_headers(full_text, cleaned_headers)
-        chunks = merge_small_chunks(header_split_chunks, min_length=128)
+        chunks = chunk_markdown_file(full_text, mode=mode)
         with open(outpath, "w", encoding="utf-8") as file:
             json.dump(chunks, file, indent=4)
         print(f"Saved header-split chunks to: {outpath}")
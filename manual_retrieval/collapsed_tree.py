@@ -0,0 +1,188 @@
+import time
+import threading
+from collections.abc import Mapping
+from typing import Any, List, NamedTuple, Tuple
+
+import numpy as np
+
+from local_index import LocalIndex
+from utils import embed_text, embed_texts
+from manual_retrieval.tree_utils import decode_vector, embeddings_name
+from manual_retrieval.tree_format import CompactNode
+
+CANDIDATES = 50
+
+# Seconds before retrying a failed build, doubling on each consecutive failure
+BUILD_RETRY_DELAY = 30
+BUILD_RETRY_MAX_DELAY = 600
+
+
+class CollapsedSnapshot(NamedTuple):
+    version: Any  # tree store version the index was built from
+    index: LocalIndex
+    leaves: List[Tuple[str, str]]  # leaf id -> (file name, leaf text)
+    entry_leaves: List[List[int]]  # entry id -> leaf ids reachable from the entry
+    leaf_entries: List[int]  # leaf id -> entry id of the leaf summary
+
+
+class CollapsedTreeIndex:
+    """
+    Flat ("collapsed tree") index over every node of every manual-retrieval tree.
+
+    Every summary, at any level, and every leaf chunk is one entry of a dense + BM25 LocalIndex, so a
+    question reaches the best leaves in a single lookup instead of a top-down traversal. An entry
+    of a leaf (its summary or its chunk) points at that leaf; an internal summary points at its
+    descendant leaf most similar to the question. When the trees of the store change, the index is
+    rebuilt in a background thread and swapped in once complete; searches keep using the previous
+    one meanwhile. A failed build is retried after BUILD_RETRY_DELAY seconds, doubling up to
+    BUILD_RETRY_MAX_DELAY.
+    """
+
+    def __init__(self, tree_store, model_name):
+        self.tree_store = tree_store
+        self.model_name = model_name
+        self.snapshot = None
+        self.lock = threading.Lock()
+        self.building = False
+        self.idle = threading.Event()
+        self.idle.set()
+        self.failures = 0
+        self.retry_at = 0.0
+
+    @staticmethod
+    def _add_node(file_name, node, texts, leaves, entry_leaves, leaf_entries):
+        """
+        Adds the entries of the children of a node and returns the ids of the leaves below it.
+        """
+        leaf_ids = []
+        for key, value in node.items():
+            if isinstance(value, Mapping):
+                entry_id = len(texts)
+                texts.append(key)
+                entry_leaves.append([])
+                entry_leaves[entry_id] = CollapsedTreeIndex._add_node(file_name, value, texts, leaves,
+                                                                      entry_leaves, leaf_entries)
+                leaf_ids.extend(entry_leaves[entry_id])
+            else:
+                leaf_id = len(leaves)
+                leaves.append((file_name, value))
+                leaf_entries.append(len(texts))
+                texts.extend([key, value])
+                entry_leaves.extend([[leaf_id], [leaf_id]])
+                leaf_ids.append(leaf_id)
+        return leaf_ids
+
+    def _build(self):
+        # Read before the build: a tree changed mid-build is only partly indexed, so the next refresh rebuilds
+        version = self.tree_store.version
+        leaves, entry_leaves, leaf_entries = [], [], []
+        texts, node_vectors = [], {}
+        for file_name in self.tree_store.table_of_contents():
+            try:
+                tree = self.tree_store.get(file_name)
+                self._add_node(file_name, tree, texts, leaves, entry_leaves, leaf_entries)
+            except Exception as e:
+                print(f"Error loading {file_name} into the collapsed tree: {e}")
+                continue
+            if isinstance(tree, CompactNode) and tree.tree.key_vectors is not None:
+                node_vectors.update(tree.tree.vectors())
+                continue
+            try:
+                node_vectors.update(self.tree_store.get(embeddings_name(file_name))["vectors"])
+            except Exception as e:
+                print(f"No node embeddings for {file_name}: {e}")
+
+        missing = list(dict.fromkeys(text for text in texts if text not in node_vectors))
+        if missing:
+            computed = embed_texts(missing, model_name=self.model_name)
+            node_vectors.update(zip(missing, computed))
+        vectors = np.stack([
+            decode_vector(node_vectors[text]) if isinstance(node_vectors[text], str)
+            else np.asarray(node_vectors[text], dtype=np.float32)
+            for text in texts
+        ]) if texts else np.zeros((0, 0), dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        print(f"Collapsed tree index built: {len(texts)} entries, {len(leaves)} leaves")
+        return CollapsedSnapshot(version, LocalIndex(texts, vectors), leaves, entry_leaves, leaf_entries)
+
+    def _rebuild(self):
+        try:
+            snapshot = self._build()
+        except Exception as e:
+            with self.lock:
+                self.failures += 1
+                delay = min(BUILD_RETRY_DELAY * 2 ** (self.failures - 1), BUILD_RETRY_MAX_DELAY)
+                self.retry_at = time.monotonic() + delay
+            print(f"Error building the collapsed tree index: {e}. Retrying in {delay:g} seconds")
+        else:
+            with self.lock:
+                self.snapshot = snapshot
+                self.failures = 0
+        finally:
+            with self.lock:
+                self.building = False
+                self.idle.set()
+
+    def refresh(self):
+        """
+        Starts a background build if the trees changed since the current index, unless a build is
+        running or backing off after a failure.
+        """
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.version == self.tree_store.version:
+            return
+        with self.lock:
+            if self.building or time.monotonic() < self.retry_at:
+                return
+            self.building = True
+            self.idle.clear()
+        threading.Thread(target=self._rebuild, name='collapsed-index-build', daemon=True).start()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the running build, if any; returns whether an index is available.
+        """
+        self.idle.wait(timeout)
+        return self.snapshot is not None
+
+    def search(self, question, final_doc_count=1, files=None):
+        """
+        Returns the final_doc_count best leaves for a question, as [{"File": ..., "Text": ...}],
+        only from the given tree files if files is set. Nothing is returned until the first build
+        is complete.
+        """
+        self.refresh()
+        snapshot = self.snapshot
+        if snapshot is None:
+            print("The collapsed tree index is not built yet")
+            return []
+        index, leaves, entry_leaves, leaf_entries = (snapshot.index, snapshot.leaves, snapshot.entry_leaves,
+                                                     snapshot.leaf_entries)
+        if not leaves:
+            return []
+
+        try:
+            question_vector = np.asarray(embed_text(question, model_name=self.model_name), dtype=np.float32)
+            question_vector /= max(np.linalg.norm(question_vector), 1e-12)
+        except Exception as e:
+            print(f"Error embedding question: {e}. Using lexical matches only")
+            question_vector = None
+
+        selected = []
+        files = set(files) if files is not None else None
+        top_k = max(final_doc_count, CANDIDATES) if files is None else len(index.documents)
+        for entry_id in index.rank(question, question_vector, top_k):
+            leaf_ids = entry_leaves[entry_id]
+            if files is not None:
+                leaf_ids = [leaf_id for leaf_id in leaf_ids if leaves[leaf_id][0] in files]
+                if not leaf_ids:
+                    continue
+            if len(leaf_ids) == 1 or question_vector is None:
+                leaf_id = leaf_ids[0]
+            else:
+                leaf_id = leaf_ids[int(np.argmax(index.vectors[[leaf_entries[i] for i in leaf_ids]] @ question_vector))]
+            if leaf_id not in selected:
+                selected.append(leaf_id)
+            if len(selected) == final_doc_count:
+                break
+        return [{"File": leaves[leaf_id][0], "Text": leaves[leaf_id][1]} for leaf_id in selected]
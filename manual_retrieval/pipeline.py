@@ -0,0 +1,315 @@
+import os
+import json
+import time
+import queue
+import hashlib
+import logging
+import argparse
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from manual_retrieval.chunking import read_markdown_file, chunk_markdown_file
+from manual_retrieval.tree_store import TOC_FILE_NAME
+from manual_retrieval.tree_format import CompactNode, compact_name, encode_tree, load_tree
+from manual_retrieval.tree_utils import EMBEDDINGS_DIR, build_tree_parallel, build_node_embeddings
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CHECKPOINT_DIR = 'checkpoints'
+DONE = object()  # end-of-stream marker passed down the queues
+
+
+class LocalBlobContainer:
+    """
+    Local filesystem stand-in for an Azure blob ContainerClient: blob names are paths under root.
+
+    Implements the calls the pipeline and the TreeStore make (get_blob_client().upload_blob /
+    download_blob, list_blobs), with the content hash as ETag.
+    """
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def get_blob_client(self, name: str) -> 'LocalBlobClient':
+        return LocalBlobClient(self.root / name)
+
+    def list_blobs(self, name_starts_with: str = ''):
+        for path in sorted(self.root.rglob('*')):
+            name = path.relative_to(self.root).as_posix()
+            if path.is_file() and name.startswith(name_starts_with):
+                content = path.read_bytes()
+                yield SimpleNamespace(name=name, etag=hashlib.md5(content).hexdigest(), size=len(content))
+
+
+class LocalBlobClient:
+    def __init__(self, path: Path):
+        self.path = path
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def upload_blob(self, data, overwrite: bool = False, **kwargs) -> None:
+        if self.path.exists() and not overwrite:
+            raise FileExistsError(self.path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        tmp_path.write_bytes(data.encode('utf-8') if isinstance(data, str) else data)
+        os.replace(tmp_path, self.path)  # readers never see a partial blob
+
+    def download_blob(self):
+        content = self.path.read_bytes()
+        return SimpleNamespace(readall=lambda: content,
+                               properties=SimpleNamespace(etag=hashlib.md5(content).hexdigest()))
+
+
+class PipelineStage(NamedTuple):
+    name: str
+    run: Callable[[Any], Any]  # item -> item for the next stage (None drops it)
+    workers: int
+
+
+def run_pipeline(items: Iterable[Any], stages: List[PipelineStage], queue_size: int = 4,
+                 report_interval: float = 10) -> Dict[str, Dict[str, float]]:
+    """
+    Stream items through stages connected by bounded queues, each stage running its own worker
+    threads; a full queue blocks the stage before it, so a slow stage throttles the whole pipeline.
+    A failed item is logged and dropped.
+
+    Returns:
+        Dict[str, Dict[str, float]]: Per stage: items done, items failed, busy seconds and items/min.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    stats = {stage.name: {'done': 0, 'failed': 0, 'busy_seconds': 0.0} for stage in stages}
+    lock = threading.Lock()
+    start = time.monotonic()
+
+    def worker(stage, inbox, outbox, remaining):
+        while True:
+            item = inbox.get()
+            if item is DONE:
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    outbox.put(DONE)
+                else:
+                    inbox.put(DONE)  # let the other workers of the stage see it too
+                return
+            began = time.monotonic()
+            try:
+                result = stage.run(item)
+            except Exception as e:
+                logger.error('Stage %s failed on %s: %s', stage.name, item, e)
+                result = None
+                with lock:
+                    stats[stage.name]['failed'] += 1
+            else:
+                with lock:
+                    stats[stage.name]['done'] += 1
+            with lock:
+                stats[stage.name]['busy_seconds'] += time.monotonic() - began
+            if result is not None:
+                outbox.put(result)
+
+    threads = []
+    for i, stage in enumerate(stages):
+        remaining = [stage.workers]
+        for n in range(stage.workers):
+            thread = threading.Thread(target=worker, args=(stage, queues[i], queues[i + 1], remaining),
+                                      name=f'pipeline-{stage.name}-{n}', daemon=True)
+            thread.start()
+            threads.append(thread)
+
+    def report():
+        elapsed = time.monotonic() - start
+        with lock:
+            line = ', '.join(f"{name} {s['done']}" + (f" ({s['failed']} failed)" if s['failed'] else '')
+                             for name, s in stats.items())
+        logger.info('[%6.0fs] %s', elapsed, line)
+
+    def drain():
+        last_report = time.monotonic()
+        while True:
+            try:
+                if queues[-1].get(timeout=1) is DONE:
+                    return
+            except queue.Empty:
+                pass
+            if time.monotonic() - last_report >= report_interval:
+                report()
+                last_report = time.monotonic()
+
+    drainer = threading.Thread(target=drain, name='pipeline-drain', daemon=True)
+    drainer.start()
+    for item in items:
+        queues[0].put(item)
+    queues[0].put(DONE)
+    drainer.join()
+    report()
+
+    elapsed = time.monotonic() - start
+    for s in stats.values():
+        s['per_minute'] = s['done'] / elapsed * 60 if elapsed else 0.0
+    return stats
+
+
+class CourseTreePipeline:
+    """
+    The offline manual-retrieval build of a course: course markdown -> chunks -> trees -> node
+    embeddings -> blobs (trees, embeddings and the table of contents under the tree prefix the tree
+    store reads, chunks under chunk_prefix).
+
+    Trees already in the container are passed to the builder as previous trees, so only the
+    summaries of changed chunks are regenerated; summaries are checkpointed under work_dir. With
+    compact, trees are uploaded in the compact binary format (as <name>.tree) with their node
+    embeddings inside instead of an embeddings sidecar.
+    """
+
+    def __init__(self, container_client, embedding_model: str, tree_prefix: str = 'docs_manual/trees/',
+                 chunk_prefix: str = 'docs_manual/chunks/', work_dir: str = 'pipeline_work',
+                 branch_factor: int = 3, summary_workers: int = 8, requests_per_minute: Optional[int] = None,
+                 compact: bool = False):
+        self.container_client = container_client
+        self.tree_prefix = tree_prefix
+        self.chunk_prefix = chunk_prefix
+        self.work_dir = work_dir
+        self.branch_factor = branch_factor
+        self.summary_workers = summary_workers
+        self.requests_per_minute = requests_per_minute
+        self.embedding_model = embedding_model
+        self.compact = compact
+        self.toc = {}
+        self.toc_lock = threading.Lock()
+
+    def _download_json(self, name: str) -> Optional[Any]:
+        blob_client = self.container_client.get_blob_client(name)
+        if not blob_client.exists():
+            return None
+        return json.loads(blob_client.download_blob().readall())
+
+    def _download_tree(self, name: str) -> Optional[Dict[str, Any]]:
+        blob_client = self.container_client.get_blob_client(name)
+        if not blob_client.exists():
+            return None
+        tree = load_tree(blob_client.download_blob().readall())
+        return tree.to_dict() if isinstance(tree, CompactNode) else tree
+
+    def _download_previous_tree(self, file_name: str) -> Optional[Dict[str, Any]]:
+        # The tree may have been built in the other format last time
+        names = [compact_name(file_name), file_name] if self.compact else [file_name, compact_name(file_name)]
+        for name in names:
+            tree = self._download_tree(f'{self.tree_prefix}{name}')
+            if tree is not None:
+                return tree
+        return None
+
+    def _upload_json(self, name: str, data: Any) -> None:
+        self.container_client.get_blob_client(name).upload_blob(json.dumps(data), overwrite=True)
+
+    def chunk(self, path: str) -> Dict[str, Any]:
+        file_name = os.path.basename(path).replace('.md', '.json')
+        return {'file_name': file_name, 'chunks': chunk_markdown_file(read_markdown_file(path))}
+
+    def build(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        file_name = item['file_name']
+        checkpoint_path = os.path.join(self.work_dir, CHECKPOINT_DIR, file_name + 'l')
+        item['tree'] = build_tree_parallel(item['chunks'], branch_factor=self.branch_factor,
+                                           max_workers=self.summary_workers,
+                                           requests_per_minute=self.requests_per_minute,
+                                           checkpoint_path=checkpoint_path,
+                                           previous_tree=self._download_previous_tree(file_name))
+        return item if item['tree'] else None
+
+    def embed(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        item['embeddings'] = build_node_embeddings(item['tree'], self.embedding_model)
+        return item
+
+    def upload(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        file_name = item['file_name']
+        self._upload_json(f'{self.chunk_prefix}{file_name}', item['chunks'])
+        if self.compact:
+            file_name = compact_name(file_name)
+            self.container_client.get_blob_client(f'{self.tree_prefix}{file_name}').upload_blob(
+                encode_tree(item['tree'], item['embeddings']['vectors']), overwrite=True)
+        else:
+            self._upload_json(f'{self.tree_prefix}{EMBEDDINGS_DIR}/{file_name}', item['embeddings'])
+            self._upload_json(f'{self.tree_prefix}{file_name}', item['tree'])  # last, so its embeddings are in place
+        with self.toc_lock:
+            self.toc[file_name] = max(item['tree'].keys())
+        return {'file_name': file_name}
+
+    def run(self, input_dir: str, chunk_workers: int = 2, tree_workers: int = 2, embed_workers: int = 2,
+            upload_workers: int = 4, queue_size: int = 4) -> Dict[str, Dict[str, float]]:
+        paths = [os.path.join(input_dir, filename) for filename in sorted(os.listdir(input_dir))
+                 if filename.endswith('.md')]
+        logger.info('Building %d trees from %s', len(paths), input_dir)
+        stats = run_pipeline(paths, [
+            PipelineStage('chunk', self.chunk, chunk_workers),
+            PipelineStage('tree', self.build, tree_workers),
+            PipelineStage('embed', self.embed, embed_workers),
+            PipelineStage('upload', self.upload, upload_workers),
+        ], queue_size=queue_size)
+
+        # Merge into the existing table of contents, so files not in this batch stay listed
+        # (and a tree rebuilt in the other format replaces its old entry)
+        toc = self._download_json(f'{self.tree_prefix}{TOC_FILE_NAME}') or {}
+        rebuilt = {os.path.splitext(file_name)[0] for file_name in self.toc}
+        toc = {file_name: summary for file_name, summary in toc.items() if os.path.splitext(file_name)[0] not in rebuilt}
+        toc.update(self.toc)
+        self._upload_json(f'{self.tree_prefix}{TOC_FILE_NAME}', dict(sorted(toc.items())))
+        logger.info('Table of contents updated with %d trees', len(self.toc))
+        return stats
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Chunk course markdown, build the manual-retrieval trees and upload them')
+    parser.add_argument('input_dir', help='Directory of course markdown files')
+    parser.add_argument('--course', help='Course config to load (configs/<course>.env)')
+    parser.add_argument('--container', help='Blob container (default: AZURE_BLOB_CONTAINER_NAME of the course)')
+    parser.add_argument('--embedding-model', help='Embedding model of the node embeddings (default: EMBEDDING_MODEL_NAME of the course)')
+    parser.add_argument('--local-blob-dir', help='Write the blobs under this directory instead of blob storage')
+    parser.add_argument('--prefix', default='docs_manual/trees/')
+    parser.add_argument('--chunk-prefix', default='docs_manual/chunks/')
+    parser.add_argument('--work-dir', default='pipeline_work')
+    parser.add_argument('--branch-factor', type=int, default=3)
+    parser.add_argument('--chunk-workers', type=int, default=2)
+    parser.add_argument('--tree-workers', type=int, default=2)
+    parser.add_argument('--summary-workers', type=int, default=8)
+    parser.add_argument('--upload-workers', type=int, default=4)
+    parser.add_argument('--queue-size', type=int, default=4)
+    parser.add_argument('--requests-per-minute', type=int)
+    parser.add_argument('--compact', action='store_true', help='Upload trees in the compact binary format (<name>.tree)')
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv('./keys.env')
+    config = None
+    if args.course:
+        from courses import get_course_config
+        config = get_course_config(args.course)
+    embedding_model = args.embedding_model or (config.embedding_model_name if config else None)
+    if not embedding_model:
+        parser.error('an embedding model is required: pass --course or --embedding-model')
+
+    if args.local_blob_dir:
+        container_client = LocalBlobContainer(args.local_blob_dir)
+    else:
+        from clients import get_container_client
+        container_name = args.container or (config.container_name if config else None)
+        if not container_name:
+            parser.error('a blob container is required: pass --course, --container or --local-blob-dir')
+        container_client = get_container_client(container_name)
+
+    pipeline = CourseTreePipeline(container_client, embedding_model, tree_prefix=args.prefix,
+                                  chunk_prefix=args.chunk_prefix, work_dir=args.work_dir,
+                                  branch_factor=args.branch_factor, summary_workers=args.summary_workers,
+                                  requests_per_minute=args.requests_per_minute, compact=args.compact)
+    stats = pipeline.run(args.input_dir, chunk_workers=args.chunk_workers, tree_workers=args.tree_workers,
+                         upload_workers=args.upload_workers, queue_size=args.queue_size)
+    for name, s in stats.items():
+        print(f"{name:<7} {s['done']:4d} done  {s['failed']:3d} failed  busy {s['busy_seconds']:7.1f}s  {s['per_minute']:6.1f}/min")
@@ -0,0 +1,108 @@
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from local_index import BM25Index, reciprocal_rank_fusion, top_ranks
+from utils import embed_text, embed_texts
+
+FILES_TO_SELECT = 3
+TOC_CANDIDATES = 6
+
+# Assignment kinds, with the spellings used in tree file names, CATEGORY_MAPPING values and questions
+KIND_ALIASES = {
+    'homework': ('homework', 'hw'),
+    'lab': ('lab',),
+    'project': ('project', 'proj'),
+    'discussion': ('discussion', 'disc', 'dis'),
+    'exam': ('exam', 'midterm', 'mt', 'final'),
+}
+ALIAS_KINDS = {alias: kind for kind, aliases in KIND_ALIASES.items() for alias in aliases}
+ASSIGNMENT_ID_PATTERN = re.compile(
+    r'\b(' + '|'.join(sorted(ALIAS_KINDS, key=len, reverse=True)) + r')(?:[\s_-]*([a-z]?\d+[a-z]?)\b|\b)',
+    re.IGNORECASE
+)
+
+
+def normalize_kind(name: Optional[str]) -> Optional[str]:
+    name = (name or '').strip().lower()
+    return ALIAS_KINDS.get(name) or ALIAS_KINDS.get(name.rstrip('s'))
+
+
+def assignment_ids(text: str) -> List[Tuple[str, str]]:
+    """
+    The assignment identifiers mentioned in a text as (kind, number), e.g. "HW 4" and "hw04" -> ('homework', '4').
+    """
+    ids = []
+    for alias, number in ASSIGNMENT_ID_PATTERN.findall(text or ''):
+        if number:
+            ids.append((ALIAS_KINDS[alias.lower()], number.lower().lstrip('0') or '0'))
+    return ids
+
+
+def file_kind(file_name: str) -> Optional[str]:
+    match = ASSIGNMENT_ID_PATTERN.match(os.path.splitext(file_name)[0].replace('_', ' '))
+    return ALIAS_KINDS[match.group(1).lower()] if match else None
+
+
+def get_assignment_type(category: Optional[str], subcategory: Optional[str], category_mapping: Dict[str, str],
+                        subcategory_mapping: Dict[str, str]) -> Optional[str]:
+    """
+    The assignment kind of a thread from the course's CATEGORY_MAPPING and SUBCATEGORY_MAPPING (the
+    subcategory wins, e.g. cs61a files homework under a single category).
+    """
+    return normalize_kind(subcategory_mapping.get(subcategory) or category_mapping.get(category))
+
+
+def filter_by_type(file_names: List[str], assignment_type: Optional[str]) -> List[str]:
+    """
+    The files of the given assignment kind; all files if the kind is unknown or none match.
+    """
+    kind = normalize_kind(assignment_type)
+    if not kind:
+        return list(file_names)
+    return [file_name for file_name in file_names if file_kind(file_name) == kind] or list(file_names)
+
+
+def shortlist_files(question: str, toc: Dict[str, str], model_name: str, assignment_type: Optional[str] = None,
+                    hint: str = '', max_candidates: int = TOC_CANDIDATES) -> Tuple[List[str], bool]:
+    """
+    Narrow the table of contents down before the LLM file selection.
+
+    Files of other assignment kinds than the thread's are dropped; then, if the question (or the
+    hint, e.g. the thread subcategory) names assignments like "hw4" that match at most
+    FILES_TO_SELECT files, those are the answer. Otherwise the remaining files are ranked by BM25
+    over their name and summary fused with the embedding similarity of their summary.
+
+    Returns:
+        Tuple[List[str], bool]: The candidate files, best first, and whether they are final (no LLM call needed).
+    """
+    file_names = filter_by_type(list(toc), assignment_type)
+
+    mentioned = set(assignment_ids(f"{hint}\n{question}"))
+    if mentioned:
+        matched = [file_name for file_name in file_names
+                   if set(assignment_ids(os.path.splitext(file_name)[0])) & mentioned]
+        if 0 < len(matched) <= FILES_TO_SELECT:
+            return matched, True
+        file_names = matched or file_names
+
+    if len(file_names) <= FILES_TO_SELECT:
+        return file_names, True
+    if len(file_names) <= max_candidates:
+        return file_names, False
+
+    texts = [f"{os.path.splitext(file_name)[0]} {toc[file_name]}" for file_name in file_names]
+    rankings = [top_ranks(BM25Index(texts).scores(f"{hint} {question}"), max_candidates, positive_only=True)]
+    try:
+        summary_vectors = np.asarray(embed_texts([toc[file_name] for file_name in file_names], model_name=model_name),
+                                     dtype=np.float32)
+        question_vector = np.asarray(embed_text(question, model_name=model_name), dtype=np.float32)
+        scores = summary_vectors @ question_vector / np.maximum(np.linalg.norm(summary_vectors, axis=1), 1e-12)
+        rankings.append(top_ranks(scores, max_candidates))
+    except Exception as e:
+        print(f"Error embedding the table of contents: {e}. Ranking files lexically only")
+    ranked = reciprocal_rank_fusion(rankings)
+    ranked += [i for i in range(len(file_names)) if i not in ranked]  # keep TOC order for the rest
+    return [file_names[i] for i in ranked[:max_candidates]], False
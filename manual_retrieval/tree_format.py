@@ -0,0 +1,298 @@
+import os
+import json
+import mmap
+import time
+import struct
+import argparse
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, Optional, Tuple, Union
+
+import numpy as np
+
+from manual_retrieval.tree_utils import EMBEDDINGS_DIR, decode_vector
+
+# Compact tree layout (little endian):
+#   header | node table (NODE_DTYPE, one row per node) | string arena (UTF-8) | key vectors | value vectors
+# Node 0 is the document itself (no key); the children of a node are contiguous rows (breadth-first
+# order). A leaf has first_child == LEAF and its content in the value fields. The vectors, present
+# when HAS_VECTORS is set, are float32 rows aligned with the node table: the embedding of each node
+# summary, and of each leaf content (zeros for internal nodes). The arena is not compressed, so
+# strings can be read in place: a compact tree is about the size of its JSON, only faster to load.
+# Compact trees are stored under COMPACT_SUFFIX instead of .json.
+COMPACT_SUFFIX = '.tree'
+MAGIC = b'EDTR'
+VERSION = 1
+HAS_VECTORS = 1
+HEADER = struct.Struct('<4sHHIIQQ')  # magic, version, flags, node count, dimensions, arena offset, vectors offset
+NODE_DTYPE = np.dtype([
+    ('key_offset', '<u8'), ('key_length', '<u4'),
+    ('value_offset', '<u8'), ('value_length', '<u4'),
+    ('first_child', '<u4'), ('child_count', '<u4'),
+])
+LEAF = 0xFFFFFFFF
+
+
+def compact_name(file_name: str) -> str:
+    """
+    The file name of the compact form of a tree (hw4.json -> hw4.tree).
+    """
+    return os.path.splitext(file_name)[0] + COMPACT_SUFFIX
+
+
+def encode_tree(tree: Dict[str, Any], vectors: Optional[Dict[str, Any]] = None) -> bytes:
+    """
+    Serialize a tree (nested dicts keyed by summary, leaf contents as strings) to the compact format.
+
+    Args:
+        tree (Dict[str, Any]): The tree, as written by the tree builders.
+        vectors (Optional[Dict[str, Any]]): Embeddings by text (lists, arrays or base64 strings as in
+            the embeddings sidecar), stored for every node summary and leaf content found in it.
+
+    Returns:
+        bytes: The compact tree.
+    """
+    nodes = [[None, None, 0, 0]]  # key, leaf content, first child, child count
+    queue = [(0, tree)]
+    while queue:
+        next_queue = []
+        for index, children in queue:
+            nodes[index][2], nodes[index][3] = len(nodes), len(children)
+            for key, value in children.items():
+                if isinstance(value, Mapping):
+                    next_queue.append((len(nodes), value))
+                    nodes.append([key, None, 0, 0])
+                else:
+                    nodes.append([key, value, LEAF, 0])
+        queue = next_queue
+
+    arena = bytearray()
+    offsets = {}
+
+    def intern(text):
+        if text is None:
+            return 0, 0
+        if text not in offsets:
+            encoded = text.encode('utf-8')
+            offsets[text] = (len(arena), len(encoded))
+            arena.extend(encoded)
+        return offsets[text]
+
+    table = np.zeros(len(nodes), dtype=NODE_DTYPE)
+    for i, (key, value, first_child, child_count) in enumerate(nodes):
+        table[i]['key_offset'], table[i]['key_length'] = intern(key)
+        table[i]['value_offset'], table[i]['value_length'] = intern(value)
+        table[i]['first_child'], table[i]['child_count'] = first_child, child_count
+
+    def as_array(vector):
+        return decode_vector(vector) if isinstance(vector, str) else np.asarray(vector, dtype=np.float32)
+
+    dimensions, flags, vector_bytes = 0, 0, b''
+    if vectors:
+        dimensions = len(as_array(next(iter(vectors.values()))))
+        key_vectors = np.zeros((len(nodes), dimensions), dtype=np.float32)
+        value_vectors = np.zeros((len(nodes), dimensions), dtype=np.float32)
+        for i, (key, value, _, _) in enumerate(nodes):
+            if key in vectors:
+                key_vectors[i] = as_array(vectors[key])
+            if value is not None and value in vectors:
+                value_vectors[i] = as_array(vectors[value])
+        flags |= HAS_VECTORS
+        vector_bytes = key_vectors.tobytes() + value_vectors.tobytes()
+
+    arena_offset = HEADER.size + table.nbytes
+    vectors_offset = arena_offset + len(arena) + (-len(arena)) % 4  # float32 rows stay 4-byte aligned
+    header = HEADER.pack(MAGIC, VERSION, flags, len(nodes), dimensions, arena_offset, vectors_offset)
+    padding = b'\0' * (vectors_offset - arena_offset - len(arena))
+    return header + table.tobytes() + bytes(arena) + padding + vector_bytes
+
+
+class CompactTree:
+    """
+    Read-only view of a compact tree over bytes or a memory map: nothing is decoded up front, and
+    strings are decoded only when a node is visited.
+    """
+
+    def __init__(self, buffer: Union[bytes, mmap.mmap]):
+        magic, version, flags, node_count, dimensions, arena_offset, vectors_offset = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Not a compact tree (magic {magic!r}, version {version})")
+        self.buffer = buffer
+        self.nodes = np.frombuffer(buffer, dtype=NODE_DTYPE, count=node_count, offset=HEADER.size)
+        self.arena = memoryview(buffer)[arena_offset:vectors_offset]
+        self.key_vectors = self.value_vectors = None
+        if flags & HAS_VECTORS:
+            self.key_vectors = np.frombuffer(buffer, dtype=np.float32, count=node_count * dimensions,
+                                             offset=vectors_offset).reshape(node_count, dimensions)
+            self.value_vectors = np.frombuffer(buffer, dtype=np.float32, count=node_count * dimensions,
+                                               offset=vectors_offset + self.key_vectors.nbytes).reshape(node_count, dimensions)
+        self._vectors = None
+        self._child_indexes = {}  # node index -> {child key: child index}, built on first lookup
+
+    def text(self, offset: int, length: int) -> str:
+        return str(self.arena[offset:offset + length], 'utf-8')
+
+    @property
+    def root(self) -> 'CompactNode':
+        return CompactNode(self, 0)
+
+    def vectors(self) -> Dict[str, np.ndarray]:
+        """
+        The stored embeddings by text (node summaries and leaf contents), in the form of the
+        embeddings sidecar; empty if the tree was written without vectors.
+        """
+        if self._vectors is None:
+            vectors = {}
+            if self.key_vectors is not None:
+                for i, node in enumerate(self.nodes[1:], start=1):
+                    vectors[self.text(node['key_offset'], node['key_length'])] = self.key_vectors[i]
+                    if node['first_child'] == LEAF:
+                        vectors[self.text(node['value_offset'], node['value_length'])] = self.value_vectors[i]
+            self._vectors = vectors
+        return self._vectors
+
+    def child_indexes(self, index: int) -> Dict[str, int]:
+        """
+        The node indexes of the children of a node by key.
+        """
+        child_indexes = self._child_indexes.get(index)
+        if child_indexes is None:
+            node = self.nodes[index]
+            first = int(node['first_child'])
+            child_indexes = {}
+            for child_index in range(first, first + int(node['child_count'])):
+                child = self.nodes[child_index]
+                child_indexes.setdefault(self.text(child['key_offset'], child['key_length']), child_index)
+            self._child_indexes[index] = child_indexes
+        return child_indexes
+
+
+class CompactNode(Mapping):
+    """
+    An internal node of a CompactTree, read like the dict of the JSON tree: child summary -> child
+    node, or leaf content for a leaf.
+    """
+
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree: CompactTree, index: int):
+        self.tree = tree
+        self.index = index
+
+    def _value(self, child_index: int) -> Union['CompactNode', str]:
+        child = self.tree.nodes[child_index]
+        if child['first_child'] == LEAF:
+            return self.tree.text(child['value_offset'], child['value_length'])
+        return CompactNode(self.tree, child_index)
+
+    def _children(self) -> Iterator[Tuple[str, Union['CompactNode', str]]]:
+        node = self.tree.nodes[self.index]
+        first = int(node['first_child'])
+        for child_index in range(first, first + int(node['child_count'])):
+            child = self.tree.nodes[child_index]
+            yield self.tree.text(child['key_offset'], child['key_length']), self._value(child_index)
+
+    def __getitem__(self, key: str) -> Union['CompactNode', str]:
+        return self._value(self.tree.child_indexes(self.index)[key])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.tree.child_indexes(self.index))
+
+    def __len__(self) -> int:
+        return int(self.tree.nodes[self.index]['child_count'])
+
+    def items(self):
+        return list(self._children())
+
+    def values(self):
+        return [value for _, value in self._children()]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {key: value.to_dict() if isinstance(value, CompactNode) else value for key, value in self._children()}
+
+
+def is_compact(content: bytes) -> bool:
+    return content[:len(MAGIC)] == MAGIC
+
+
+def load_tree(content: Union[bytes, mmap.mmap]) -> Mapping:
+    """
+    Parse a tree blob in either format: a CompactNode for a compact tree, a dict for JSON.
+    """
+    if is_compact(content):
+        return CompactTree(content).root
+    return json.loads(content)
+
+
+def load_tree_file(path: str, use_mmap: bool = True) -> Mapping:
+    """
+    Load a tree file in either format, memory-mapping compact trees if use_mmap.
+    """
+    with open(path, 'rb') as f:
+        if use_mmap and is_compact(f.read(len(MAGIC))):
+            return CompactTree(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).root
+        f.seek(0)
+        return load_tree(f.read())
+
+
+def tree_bytes(tree: Mapping) -> bytes:
+    """
+    The serialized form of a loaded tree, in its own format.
+    """
+    if isinstance(tree, CompactNode):
+        return bytes(tree.tree.buffer)
+    return json.dumps(tree).encode('utf-8')
+
+
+def convert_tree_dir(tree_dir: str, output_dir: str, with_vectors: bool = True) -> None:
+    """
+    Convert the JSON trees of a tree directory to compact trees (hw4.json -> hw4.tree), with the
+    vectors of their embeddings sidecar if with_vectors; the table of contents lists the compact names.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    converted = set()
+    for file_name in sorted(os.listdir(tree_dir)):
+        path = os.path.join(tree_dir, file_name)
+        if not file_name.endswith('.json') or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            content = f.read()
+        if 'table_of_contents' in file_name:
+            continue
+        if is_compact(content):
+            output = content
+        else:
+            vectors = None
+            embeddings_path = os.path.join(tree_dir, EMBEDDINGS_DIR, file_name)
+            if with_vectors and os.path.exists(embeddings_path):
+                with open(embeddings_path, 'r', encoding='utf-8') as f:
+                    vectors = json.load(f)['vectors']
+            start = time.perf_counter()
+            tree = json.loads(content)
+            json_seconds = time.perf_counter() - start
+            output = encode_tree(tree, vectors)
+            start = time.perf_counter()
+            load_tree(output)
+            compact_seconds = time.perf_counter() - start
+            print(f"{file_name}: {len(content):,} -> {len(output):,} bytes"
+                  f"{' (with vectors)' if vectors else ''}, "
+                  f"parse {json_seconds * 1000:.2f}ms -> {compact_seconds * 1000:.3f}ms")
+        with open(os.path.join(output_dir, compact_name(file_name)), 'wb') as f:
+            f.write(output)
+        converted.add(file_name)
+
+    toc_path = os.path.join(tree_dir, 'table_of_contents.json')
+    if os.path.exists(toc_path):
+        with open(toc_path, 'r', encoding='utf-8') as f:
+            toc = json.load(f)
+        toc = {compact_name(name) if name in converted else name: summary for name, summary in toc.items()}
+        with open(os.path.join(output_dir, 'table_of_contents.json'), 'w', encoding='utf-8') as f:
+            json.dump(toc, f, indent=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert JSON manual-retrieval trees to the compact binary format')
+    parser.add_argument('tree_dir')
+    parser.add_argument('output_dir')
+    parser.add_argument('--no-vectors', action='store_true', help='Do not embed the vectors of the embeddings sidecars')
+    args = parser.parse_args()
+    convert_tree_dir(args.tree_dir, args.output_dir, with_vectors=not args.no_vectors)
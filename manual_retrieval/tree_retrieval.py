@@ -1,122 +1,189 @@
 import os
 import json
 import time
-import pandas as pd
+import threading
+from collections.abc import Mapping
+from typing import Any, Dict
+import numpy as np
 from dotenv import load_dotenv
 from openai import AzureOpenAI
-from azure.storage.blob import BlobServiceClient
+from clients import registry, get_container_client
+from courses import resolve_course, get_course_config
+from manual_retrieval.tree_store import TreeStore
+from manual_retrieval.collapsed_tree import CollapsedTreeIndex
+from manual_retrieval.tree_utils import decode_vector, embeddings_name
+from manual_retrieval.tree_format import CompactNode
+from manual_retrieval.toc_filter import TOC_CANDIDATES, filter_by_type, shortlist_files
+from utils import embed_text, embed_texts
 
 load_dotenv('./keys.env')
 
-# Azure + OpenAI setup
-blob_service = BlobServiceClient.from_connection_string(os.getenv("AZURE_STORAGE_CONNECTION_STRING"))
-container_client = blob_service.get_container_client("ds100-su25")
 TREE_PREFIX = "docs_manual/trees/"
 
-client = AzureOpenAI(
-    api_key=os.getenv("OPENAI_KEY"),
-    api_version="2024-02-01",
-    azure_endpoint=os.getenv("LLM_ENDPOINT")
-)
-model = os.getenv("MODEL_NAME")
+# Retrieval mode: "traversal" (pick files from the TOC, then beam search down each tree) or "collapsed"
+# (one lookup in a flat index over every node of every tree)
+DEFAULT_MODE = "traversal"
 
-file_cache = {}
-gpt_call_count = 0
+# Beam search scorer: "llm" asks the LLM at every level, "embedding" ranks children by similarity to the question
+# and only asks the LLM to break near-ties (within TIE_MARGIN cosine similarity) at the last level
+DEFAULT_SCORER = "llm"
+TIE_MARGIN = 0.02
 
-def safe_generate(messages, temperature=0.1):
-    global gpt_call_count
-    while True:
-        try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-            )
-            gpt_call_count += 1
-            return response.choices[0].message.content
-        except Exception as e:
-            print(f"Error calling generate: {e}. Retrying in 1 second...")
-            time.sleep(1)
-
-def get_relevant_files(question, toc):
-    prompt = (
-        f"Given the student question: \"{question}\", and the following table of contents:\n"
-        f"{json.dumps(toc, indent=2)}\n"
-        "Select the three file names whose content is most likely to answer the question. "
-        "Output ONLY a list of exactly three file names, like so: ['hw4.json', 'lab8.json', 'projA1.json'] "
+# Attempts of an LLM call of the retriever, waiting LLM_RETRY_DELAY seconds (doubling) in between;
+# a retrieval stage past its deadline keeps running in the background, so it must not retry forever
+LLM_ATTEMPTS = 3
+LLM_RETRY_DELAY = 1.0
+
+
+def get_llm_client():
+    endpoint, key = os.getenv("LLM_ENDPOINT"), os.getenv("OPENAI_KEY")
+    return registry.get(
+        ("tree_llm", endpoint, key),
+        lambda: AzureOpenAI(api_key=key, api_version="2024-02-01", azure_endpoint=endpoint)
     )
-    messages = [{"role": "system", "content": prompt}]
-    gpt_output = safe_generate(messages, temperature=0.1)
-
-    # print(gpt_output)
-    try:
-        file_list = eval(gpt_output)
-        if isinstance(file_list, list) and len(file_list) == 3:
-            return file_list
-        else:
-            print("Warning: GPT did not return exactly three file names. Using first three keys from TOC.")
-            return list(toc.keys())[:3]
-    except Exception as e:
-        print(f"Error parsing GPT output: {e}. Falling back to first three keys from TOC.")
-        return list(toc.keys())[:3]
-
-def load_blob_json(blob_path):
-    blob_client = container_client.get_blob_client(blob_path)
-    content = blob_client.download_blob().readall().decode("utf-8")
-    return json.loads(content)
-
-def beam_search_across_blobs(question, file_names, beam_width=3, final_doc_count=None):
-    if final_doc_count is None:
-        final_doc_count = beam_width
-
-    beam = []
-    for file_name in file_names:
-        blob_path = f"{TREE_PREFIX}{file_name}"
-        try:
-            if file_name not in file_cache:
-                tree_data = load_blob_json(blob_path)
-                file_cache[file_name] = tree_data
-            else:
-                tree_data = file_cache[file_name]
 
-            root_key = list(tree_data.keys())[0]
-            root_value = tree_data[root_key]
-            beam.append((None, file_name, root_key, root_value))
-        except Exception as e:
-            print(f"Error loading {blob_path}: {e}")
-
-    if not beam:
-        return []
-
-    while True:
-        new_beam = []
-        expanded = False
-
-        candidate_details = {}
-        candidate_display = {}
-        leaf_candidates = []
-
-        for score, file_name, node_key, node in beam:
-            if isinstance(node, dict):
-                for child_key, child_value in node.items():
-                    idx = len(candidate_details) + 1
-                    candidate_details[idx] = (file_name, child_key, child_value)
-                    candidate_display[idx] = child_key
-                expanded = True
-            else:
-                leaf_candidates.append((score, file_name, node_key, node))
 
-        if not expanded or not candidate_details:
-            break
+class ManualRetriever:
+    """
+    Manual (tree) retrieval over the trees of one course: its blob container and tree prefix, tree
+    store and collapsed index, and its retrieval defaults. Clients and the tree store are created on
+    first use, so building a retriever (or importing this module) does not touch the network.
+    """
 
-        if all(not isinstance(child_value, dict) for (file_name, child_key, child_value) in candidate_details.values()):
-            num_to_select = final_doc_count
-        else:
-            num_to_select = beam_width
+    def __init__(self, course, container_name, tree_prefix=TREE_PREFIX, beam_width=3, final_doc_count=1,
+                 scorer=DEFAULT_SCORER, mode=DEFAULT_MODE, toc_candidates=TOC_CANDIDATES, embedding_model=None,
+                 store_settings=None, snapshot_dir=None):
+        self.course = course
+        self.container_name = container_name
+        self.tree_prefix = tree_prefix
+        self.beam_width = beam_width
+        self.final_doc_count = final_doc_count
+        self.scorer = scorer
+        self.mode = mode
+        self.toc_candidates = toc_candidates
+        self.embedding_model = embedding_model
+        self.store_settings = store_settings or {}
+        self.snapshot_dir = snapshot_dir
+        self._tree_store = None
+        self._collapsed_index = None
+        self._lock = threading.Lock()
+        self._local = threading.local()  # LLM calls of the retrieval running in this thread
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build the retriever of a course from its CourseConfig.
+        """
+        snapshot_dir = config.get("TREE_SNAPSHOT_DIR")
+        return cls(
+            config.name,
+            container_name=config.container_name,
+            tree_prefix=config.manual_tree_prefix,
+            beam_width=config.manual_beam_width,
+            final_doc_count=config.manual_final_doc_count,
+            scorer=config.manual_retrieval_scorer,
+            mode=config.manual_retrieval_mode,
+            toc_candidates=config.manual_toc_candidates,
+            embedding_model=config.embedding_model_name,
+            store_settings={
+                "max_bytes": int(config.get("TREE_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+                "refresh_interval": float(config.get("TREE_REFRESH_INTERVAL", "300")),
+                "prefetch_interval": float(config.get("TREE_PREFETCH_INTERVAL", "0")),
+                "prefetch_count": int(config.get("TREE_PREFETCH_COUNT", "10")),
+            },
+            snapshot_dir=os.path.join(snapshot_dir, config.name) if snapshot_dir else None,
+        )
+
+    @property
+    def store_key(self):
+        """
+        What the tree store depends on: retrievers with the same key can share one.
+        """
+        return self.container_name, self.tree_prefix, tuple(sorted(self.store_settings.items())), self.snapshot_dir
+
+    @property
+    def tree_store(self):
+        if self._tree_store is None:
+            with self._lock:
+                if self._tree_store is None:
+                    self._tree_store = TreeStore(get_container_client(self.container_name), self.tree_prefix,
+                                                 **self.store_settings)
+        return self._tree_store
+
+    @property
+    def collapsed_index(self):
+        if self._collapsed_index is None:
+            with self._lock:
+                if self._collapsed_index is None:
+                    self._collapsed_index = CollapsedTreeIndex(self.tree_store, model_name=self.embedding_model)
+        return self._collapsed_index
+
+    def start(self):
+        """
+        Warm the tree store (from TREE_SNAPSHOT_DIR/<course> if set) and start its refresher; in
+        collapsed mode, also start building the collapsed index.
+        """
+        self.tree_store.start(snapshot_dir=self.snapshot_dir)
+        if self.mode == "collapsed":
+            self.collapsed_index.refresh()
+
+    def stop(self):
+        if self._tree_store is not None:
+            self._tree_store.stop()
+
+    @property
+    def llm_calls(self):
+        return getattr(self._local, "calls", 0)
+
+    def reset_llm_calls(self):
+        self._local.calls = 0
+
+    def safe_generate(self, messages, temperature=0.1):
+        """
+        Calls the LLM, up to LLM_ATTEMPTS times. Returns "" if every attempt failed, which the callers
+        handle like an unparsable answer (falling back to the first candidates).
+        """
+        for attempt in range(LLM_ATTEMPTS):
+            try:
+                response = get_llm_client().chat.completions.create(
+                    model=os.getenv("MODEL_NAME"),
+                    messages=messages,
+                    temperature=temperature,
+                )
+                self._local.calls = self.llm_calls + 1
+                return response.choices[0].message.content
+            except Exception as e:
+                if attempt + 1 == LLM_ATTEMPTS:
+                    print(f"Error calling generate: {e}. Giving up after {LLM_ATTEMPTS} attempts.")
+                    return ""
+                delay = LLM_RETRY_DELAY * 2 ** attempt
+                print(f"Error calling generate: {e}. Retrying in {delay:g} seconds...")
+                time.sleep(delay)
 
-        # print(num_to_select)
+    def get_relevant_files(self, question, toc):
+        prompt = (
+            f"Given the student question: \"{question}\", and the following table of contents:\n"
+            f"{json.dumps(toc, indent=2)}\n"
+            "Select the three file names whose content is most likely to answer the question. "
+            "Output ONLY a list of exactly three file names, like so: ['hw4.json', 'lab8.json', 'projA1.json'] "
+        )
+        messages = [{"role": "system", "content": prompt}]
+        gpt_output = self.safe_generate(messages, temperature=0.1)
+
+        # print(gpt_output)
+        try:
+            file_list = eval(gpt_output)
+            if isinstance(file_list, list) and len(file_list) == 3:
+                return file_list
+            else:
+                print("Warning: GPT did not return exactly three file names. Using first three keys from TOC.")
+                return list(toc.keys())[:3]
+        except Exception as e:
+            print(f"Error parsing GPT output: {e}. Falling back to first three keys from TOC.")
+            return list(toc.keys())[:3]
+
+    def select_with_llm(self, question, candidate_display, num_to_select):
         example = str(list(range(1, num_to_select+1)))
-        # print(example)
         prompt = (
             "You are an expert at relevant document selection. "
             f"Here is a student question:\n\"{question}\"\n"
@@ -126,10 +193,8 @@ def beam_search_across_blobs(question, file_names, beam_width=3, final_doc_count
             f"Output ONLY a list of the keys as natural numbers, like this: {example}"
         )
 
-
         messages = [{"role": "system", "content": prompt}]
-        time.sleep(1)
-        gpt_output = safe_generate(messages)
+        gpt_output = self.safe_generate(messages)
         # print(gpt_output)
         try:
             selected_keys = eval(gpt_output)
@@ -137,43 +202,257 @@ def beam_search_across_blobs(question, file_names, beam_width=3, final_doc_count
                 raise ValueError("Invalid GPT output format")
         except Exception as e:
             print(f"Error parsing GPT output: {e}. Falling back to top-{num_to_select}")
-            selected_keys = list(candidate_details.keys())[:num_to_select]
-
-        for idx in selected_keys:
-            if idx in candidate_details:
-                file_name, child_key, child_value = candidate_details[idx]
-                new_beam.append((None, file_name, child_key, child_value))
-        new_beam.extend(leaf_candidates)
-        beam = new_beam
-
-    return [{"File": fname, "Text": text} for (_, fname, _, text) in beam]
-
-def manual_retrieval(question, beam_width=3, final_doc_count=1):
-    global gpt_call_count
-    gpt_call_count = 0
-
-    try:
-        toc = load_blob_json(f"{TREE_PREFIX}table_of_contents.json")
-    except Exception as e:
-        print(f"Error loading TOC: {e}")
-        return [], 0
-
-    selected_files = get_relevant_files(question, toc)
-
-    docs = beam_search_across_blobs(
-        question,
-        selected_files,
-        beam_width=beam_width,
-        final_doc_count=final_doc_count
-    )
+            selected_keys = list(candidate_display.keys())[:num_to_select]
+        return selected_keys
+
+
+    def load_node_vectors(self, trees):
+        """
+        Returns the precomputed node embeddings of the given trees ({file name: tree}): the vectors
+        stored in compact trees, otherwise their (encoded) embeddings sidecar. Trees built before node
+        embeddings existed are simply missing and get their nodes embedded on demand.
+        """
+        node_vectors = {}
+        embedding_files = []
+        for file_name, tree in trees.items():
+            if isinstance(tree, CompactNode) and tree.tree.key_vectors is not None:
+                node_vectors.update(tree.tree.vectors())
+            else:
+                embedding_files.append(embeddings_name(file_name))
+        for embedding_file, embeddings in self.tree_store.get_many(embedding_files).items():
+            try:
+                node_vectors.update(embeddings["vectors"])
+            except Exception as e:
+                print(f"No node embeddings for {embedding_file}: {e}")
+        return node_vectors
+
+
+    def select_with_embeddings(self, question, question_vector, candidate_details, num_to_select, node_vectors, last_level):
+        indices = list(candidate_details.keys())
+        keys = [child_key for (_, child_key, _) in candidate_details.values()]
+        unknown = list(dict.fromkeys(key for key in keys if key not in node_vectors))
+        if unknown:
+            for key, vector in zip(unknown, embed_texts(unknown, model_name=self.embedding_model)):
+                node_vectors[key] = np.asarray(vector, dtype=np.float32)
+        matrix = np.stack([
+            node_vectors[key] if isinstance(node_vectors[key], np.ndarray) else decode_vector(node_vectors[key])
+            for key in keys
+        ])
+        scores = matrix @ question_vector / np.maximum(np.linalg.norm(matrix, axis=1), 1e-12)
+        order = np.argsort(-scores, kind="stable")
+        ranked = [indices[i] for i in order]
+        if not last_level or len(ranked) <= num_to_select:
+            return ranked[:num_to_select]
+
+        # Near-tie at the cut: the candidates clearly above the first excluded one are kept, the LLM picks
+        # the rest among those within TIE_MARGIN of the cut
+        kth, first_excluded = scores[order[num_to_select - 1]], scores[order[num_to_select]]
+        if kth - first_excluded >= TIE_MARGIN:
+            return ranked[:num_to_select]
+        secure = [indices[i] for i in order if scores[i] >= first_excluded + TIE_MARGIN]
+        tied = [indices[i] for i in order if indices[i] not in secure and scores[i] >= kth - TIE_MARGIN]
+        tie_display = {position: candidate_details[idx][1] for position, idx in enumerate(tied, start=1)}
+        chosen = self.select_with_llm(question, tie_display, num_to_select - len(secure))
+        chosen = [tied[position - 1] for position in chosen if isinstance(position, int) and 1 <= position <= len(tied)]
+        return secure + (chosen or tied)[:num_to_select - len(secure)]
+
+
+    def beam_search_across_blobs(self, question, file_names, beam_width=3, final_doc_count=None, scorer=DEFAULT_SCORER):
+        if final_doc_count is None:
+            final_doc_count = beam_width
+
+        # Download the selected trees concurrently
+        trees = self.tree_store.get_many(file_names)
+
+        beam = []
+        for file_name in file_names:
+            blob_path = f"{self.tree_prefix}{file_name}"
+            try:
+                tree_data = trees[file_name]
+
+                root_key = list(tree_data.keys())[0]
+                root_value = tree_data[root_key]
+                beam.append((None, file_name, root_key, root_value))
+            except Exception as e:
+                print(f"Error loading {blob_path}: {e}")
+
+        if not beam:
+            return []
+
+        question_vector = None
+        if scorer == "embedding":
+            try:
+                question_vector = np.asarray(embed_text(question, model_name=self.embedding_model), dtype=np.float32)
+                question_vector /= max(np.linalg.norm(question_vector), 1e-12)
+                node_vectors = self.load_node_vectors({file_name: trees[file_name] for (_, file_name, _, _) in beam})
+            except Exception as e:
+                print(f"Error embedding question: {e}. Falling back to the LLM scorer")
+                question_vector = None
+
+        while True:
+            new_beam = []
+            expanded = False
+
+            candidate_details = {}
+            candidate_display = {}
+            leaf_candidates = []
+
+            for score, file_name, node_key, node in beam:
+                if isinstance(node, Mapping):
+                    for child_key, child_value in node.items():
+                        idx = len(candidate_details) + 1
+                        candidate_details[idx] = (file_name, child_key, child_value)
+                        candidate_display[idx] = child_key
+                    expanded = True
+                else:
+                    leaf_candidates.append((score, file_name, node_key, node))
+
+            if not expanded or not candidate_details:
+                break
+
+            last_level = all(not isinstance(child_value, Mapping) for (file_name, child_key, child_value) in candidate_details.values())
+            if last_level:
+                num_to_select = final_doc_count
+            else:
+                num_to_select = beam_width
+
+            if question_vector is not None:
+                selected_keys = self.select_with_embeddings(question, question_vector, candidate_details, num_to_select,
+                                                       node_vectors, last_level)
+            else:
+                selected_keys = self.select_with_llm(question, candidate_display, num_to_select)
+
+            for idx in selected_keys:
+                if idx in candidate_details:
+                    file_name, child_key, child_value = candidate_details[idx]
+                    new_beam.append((None, file_name, child_key, child_value))
+            new_beam.extend(leaf_candidates)
+            beam = new_beam
+
+        return [{"File": fname, "Text": text} for (_, fname, _, text) in beam]
+
+    def retrieve(self, question, beam_width=None, final_doc_count=None, scorer=None, mode=None, assignment_type=None,
+                 hint="", toc_candidates=None):
+        """
+        Arguments left as None use the course's defaults. assignment_type: the kind of assignment of the
+        thread (a CATEGORY_MAPPING value, e.g. "homework"); trees of other kinds are not considered.
+        hint: thread metadata (e.g. its subcategory) searched for assignment identifiers along with the
+        question. toc_candidates: the number of files shortlisted for the LLM file selection.
+        """
+        self.reset_llm_calls()
+        beam_width = beam_width or self.beam_width
+        final_doc_count = final_doc_count or self.final_doc_count
+
+        if (mode or self.mode) == "collapsed":
+            try:
+                files = filter_by_type(list(self.tree_store.table_of_contents()), assignment_type) if assignment_type else None
+                docs = self.collapsed_index.search(question, final_doc_count=final_doc_count, files=files)
+            except Exception as e:
+                print(f"Error searching the collapsed tree: {e}")
+                return [], 0
+            return f"Retrieved assignment documents\n==========================================\n{docs}", self.llm_calls
+
+        try:
+            toc = self.tree_store.table_of_contents()
+        except Exception as e:
+            print(f"Error loading TOC: {e}")
+            return [], 0
+
+        # Narrow the TOC down locally; the LLM only picks among the candidates when they are ambiguous
+        candidates, decided = shortlist_files(question, toc, assignment_type=assignment_type, hint=hint,
+                                              max_candidates=toc_candidates or self.toc_candidates,
+                                              model_name=self.embedding_model)
+        if decided:
+            selected_files = candidates
+        else:
+            selected_files = self.get_relevant_files(question, {file_name: toc[file_name] for file_name in candidates})
+
+        docs = self.beam_search_across_blobs(
+            question,
+            selected_files,
+            beam_width=beam_width,
+            final_doc_count=final_doc_count,
+            scorer=scorer or self.scorer
+        )
+
+        doc_string = f"Retrieved assignment documents\n==========================================\n{docs}"
+
+        return doc_string, self.llm_calls
+
+
+_manual_retrievers = {}
+_manual_retrievers_lock = threading.Lock()
+
+
+def get_manual_retriever(course: str) -> ManualRetriever:
+    """
+    Get the manual retriever of a course, building it from its config on first use.
+    """
+    course = resolve_course(course)
+    with _manual_retrievers_lock:
+        if course not in _manual_retrievers:
+            _manual_retrievers[course] = ManualRetriever.from_config(get_course_config(course))
+        return _manual_retrievers[course]
+
+
+def start_manual_retrievers(courses) -> None:
+    """
+    Build the retrievers of the given courses and start their tree stores, so the first request of
+    each course does not wait for its trees.
+    """
+    for course in courses:
+        try:
+            get_manual_retriever(course).start()
+        except Exception as e:
+            print(f"Error starting the manual retriever of {course}: {e}")
+
+
+def reload_manual_retrievers(configs) -> None:
+    """
+    Rebuild the retrievers of reloaded course configs. A retriever whose container, prefix and
+    store settings are unchanged keeps its warm tree store (and collapsed index, for the same
+    embedding model); otherwise the new store is started and the old one stopped.
+    """
+    for course, config in configs.items():
+        retriever = ManualRetriever.from_config(config)
+        with _manual_retrievers_lock:
+            previous = _manual_retrievers.get(course)
+        if previous is None:
+            continue
+        if previous.store_key == retriever.store_key:
+            retriever._tree_store = previous._tree_store
+            if previous.embedding_model == retriever.embedding_model:
+                retriever._collapsed_index = previous._collapsed_index
+        else:
+            try:
+                retriever.start()
+            except Exception as e:
+                print(f"Error starting the manual retriever of {course}: {e}")
+                continue
+            previous.stop()
+        with _manual_retrievers_lock:
+            _manual_retrievers[course] = retriever
+
+
+def manual_retriever_stats() -> Dict[str, Any]:
+    with _manual_retrievers_lock:
+        retrievers = dict(_manual_retrievers)
+    return {course: retriever.tree_store.stats() for course, retriever in retrievers.items()
+            if retriever._tree_store is not None}
+
 
-    doc_string = f"Retrieved assignment documents\n==========================================\n{docs}"
+def manual_retrieval(question, course, **kwargs):
+    """
+    Retrieve the assignment documents of a course for a question (see ManualRetriever.retrieve).
 
-    return doc_string, gpt_call_count
+    Returns:
+        tuple: The retrieved documents string and the number of LLM calls made.
+    """
+    return get_manual_retriever(course).retrieve(question, **kwargs)
 
 
 if __name__ == "__main__":
     question = "how do i do 1d"
-    docs, calls = manual_retrieval(question, beam_width=3)
+    docs, calls = manual_retrieval(question, "ds100", beam_width=3)
     print(json.dumps(docs, indent=2))
     # print(f"GPT calls: {calls}")
\ No newline at end of file
@@ -0,0 +1,318 @@
+import json
+import logging
+import argparse
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+from manual_retrieval.tree_format import COMPACT_SUFFIX, load_tree, load_tree_file, tree_bytes
+from manual_retrieval.tree_utils import EMBEDDINGS_DIR
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+TOC_FILE_NAME = 'table_of_contents.json'
+MANIFEST_FILE_NAME = 'manifest.json'
+
+
+class TreeStore:
+    """
+    Bounded in-memory cache of the manual-retrieval trees (and table of contents) of a blob container.
+
+    Trees are kept parsed (JSON trees as dicts, compact trees as CompactNode views over their
+    bytes), evicted least recently used once their serialized size exceeds max_bytes,
+    and revalidated against the blob ETags: a background refresher lists the tree prefix every
+    refresh_interval seconds and re-downloads the trees whose ETag changed, so rebuilt trees are
+    picked up without a restart. A snapshot directory (trees + a manifest of ETags) lets a new
+    process start warm and only fetch what changed since the snapshot was taken.
+
+    Lookups are counted per tree with exponential decay; when prefetch_interval is set, a
+    prefetcher keeps the prefetch_count hottest trees resident (exempt from eviction and reloaded
+    if they were evicted before becoming hot), so popular trees never wait on blob I/O.
+    """
+
+    def __init__(self, container_client, prefix: str, max_bytes: int = 256 * 1024 * 1024,
+                 refresh_interval: float = 300, prefetch_interval: float = 0, prefetch_count: int = 10,
+                 download_workers: int = 8):
+        self.container_client = container_client
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.refresh_interval = refresh_interval
+        self.entries = OrderedDict()  # file name -> (tree, etag, size)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.prefetch_interval = prefetch_interval
+        self.prefetch_count = prefetch_count
+        self.download_workers = download_workers
+        self.refresher = None
+        self.prefetcher = None
+        self.stopped = threading.Event()
+        self.etags = {}  # file name -> last seen etag, kept when the tree is evicted
+        self.version = 0  # bumped whenever a seen tree changes or is removed
+        self.popularity = Counter()  # file name -> decayed lookup count
+        self.hot = set()  # file names kept resident by the prefetcher
+        self.counters = {'hits': 0, 'misses': 0, 'reloads': 0, 'evictions': 0, 'prefetches': 0}
+
+    def _store(self, file_name: str, tree: Dict[str, Any], etag: Optional[str], size: int) -> None:
+        with self.lock:
+            if file_name in self.entries:
+                self.total_bytes -= self.entries[file_name][2]
+            if file_name in self.etags and self.etags[file_name] != etag:
+                self.version += 1
+            self.etags[file_name] = etag
+            self.entries[file_name] = (tree, etag, size)
+            self.entries.move_to_end(file_name)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                evictable = [name for name in self.entries if name != file_name and name not in self.hot]
+                evicted = evictable[0] if evictable else next(iter(self.entries))
+                self.total_bytes -= self.entries.pop(evicted)[2]
+                self.counters['evictions'] += 1
+
+    def _download(self, file_name: str) -> Dict[str, Any]:
+        downloader = self.container_client.get_blob_client(f'{self.prefix}{file_name}').download_blob()
+        content = downloader.readall()
+        tree = load_tree(content)
+        self._store(file_name, tree, downloader.properties.etag, len(content))
+        return tree
+
+    def get(self, file_name: str) -> Dict[str, Any]:
+        """
+        Get a tree by file name, downloading it on a miss.
+
+        Args:
+            file_name (str): The file name of the tree under the tree prefix (e.g. 'hw4.json' or 'hw4.tree').
+
+        Returns:
+            Dict[str, Any]: The parsed tree.
+        """
+        with self.lock:
+            entry = self.entries.get(file_name)
+            if entry is not None:
+                self.entries.move_to_end(file_name)
+                self.counters['hits'] += 1
+                self.popularity[file_name] += 1
+                return entry[0]
+            self.counters['misses'] += 1
+        tree = self._download(file_name)
+        with self.lock:
+            self.popularity[file_name] += 1
+        return tree
+
+    def get_many(self, file_names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Get several trees, downloading the missing ones concurrently.
+
+        Returns:
+            Dict[str, Dict[str, Any]]: The parsed trees by file name; trees that failed to load are
+            left out (and logged).
+        """
+        file_names = list(dict.fromkeys(file_names))
+        trees, missing = {}, []
+        with self.lock:
+            for file_name in file_names:
+                entry = self.entries.get(file_name)
+                if entry is not None:
+                    self.entries.move_to_end(file_name)
+                    self.counters['hits'] += 1
+                    trees[file_name] = entry[0]
+                else:
+                    self.counters['misses'] += 1
+                    missing.append(file_name)
+
+        def download(file_name):
+            try:
+                return self._download(file_name)
+            except Exception as e:
+                logger.error(f"Error loading tree {file_name}: {e}")
+                return None
+
+        if len(missing) == 1:
+            downloaded = [download(missing[0])]
+        elif missing:
+            with ThreadPoolExecutor(max_workers=min(self.download_workers, len(missing))) as executor:
+                downloaded = list(executor.map(download, missing))
+        else:
+            downloaded = []
+        trees.update((file_name, tree) for file_name, tree in zip(missing, downloaded) if tree is not None)
+        with self.lock:
+            self.popularity.update(trees.keys())
+        return {file_name: trees[file_name] for file_name in file_names if file_name in trees}
+
+    def prefetch(self) -> int:
+        """
+        Mark the prefetch_count most looked-up trees hot, load the ones that are not resident, and
+        decay the lookup counts so popularity follows recent traffic.
+
+        Returns:
+            int: The number of trees loaded.
+        """
+        with self.lock:
+            self.hot = {file_name for file_name, _ in self.popularity.most_common(self.prefetch_count)}
+            missing = [file_name for file_name in self.hot if file_name not in self.entries]
+            for file_name in list(self.popularity):
+                self.popularity[file_name] /= 2
+                if self.popularity[file_name] < 0.01:
+                    del self.popularity[file_name]
+        loaded = 0
+        for file_name in missing:
+            try:
+                self._download(file_name)
+                loaded += 1
+            except Exception as e:
+                logger.error(f"Error prefetching tree {file_name}: {e}")
+        with self.lock:
+            self.counters['prefetches'] += loaded
+        return loaded
+
+    def table_of_contents(self) -> Dict[str, Any]:
+        return self.get(TOC_FILE_NAME)
+
+    def refresh(self, load_missing: bool = False) -> int:
+        """
+        Reload the cached trees whose blob ETag changed and drop the ones that were deleted.
+
+        Args:
+            load_missing (bool): Also load the trees that are not cached yet, while they fit in max_bytes.
+                Node embedding sidecars are left to load on first use.
+
+        Returns:
+            int: The number of trees (re)loaded.
+        """
+        remote = {
+            blob.name[len(self.prefix):]: (blob.etag, blob.size)
+            for blob in self.container_client.list_blobs(name_starts_with=self.prefix)
+            if blob.name.endswith(('.json', COMPACT_SUFFIX))
+        }
+        with self.lock:
+            cached = {file_name: etag for file_name, (_, etag, _) in self.entries.items()}
+            for file_name in set(self.etags) - set(remote):
+                if file_name in self.entries:
+                    self.total_bytes -= self.entries.pop(file_name)[2]
+                del self.etags[file_name]
+                self.version += 1
+        loaded = 0
+        for file_name, (etag, size) in remote.items():
+            if file_name in cached:
+                if cached[file_name] == etag:
+                    continue
+            elif (not load_missing or file_name.startswith(f'{EMBEDDINGS_DIR}/')
+                  or self.total_bytes + size > self.max_bytes):
+                continue
+            try:
+                self._download(file_name)
+                loaded += 1
+            except Exception as e:
+                logger.error(f"Error reloading tree {file_name}: {e}")
+        with self.lock:
+            self.counters['reloads'] += loaded
+        if loaded:
+            logger.info('Reloaded %d trees under %s', loaded, self.prefix)
+        return loaded
+
+    def warm_from_snapshot(self, snapshot_dir: str) -> int:
+        """
+        Load the trees of a snapshot directory written by save_snapshot (compact trees are memory-mapped).
+
+        Returns:
+            int: The number of trees loaded.
+        """
+        snapshot_dir = Path(snapshot_dir)
+        manifest_path = snapshot_dir / MANIFEST_FILE_NAME
+        if not manifest_path.exists():
+            logger.warning('No tree snapshot at %s', snapshot_dir)
+            return 0
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        for file_name, etag in manifest.items():
+            path = snapshot_dir / file_name
+            self._store(file_name, load_tree_file(str(path)), etag, path.stat().st_size)
+        logger.info('Loaded %d trees from snapshot %s', len(manifest), snapshot_dir)
+        return len(manifest)
+
+    def save_snapshot(self, snapshot_dir: str) -> None:
+        """
+        Write the cached trees and their ETags to a snapshot directory.
+        """
+        snapshot_dir = Path(snapshot_dir)
+        snapshot_dir.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            entries = list(self.entries.items())
+        for file_name, (tree, _, _) in entries:
+            (snapshot_dir / file_name).parent.mkdir(parents=True, exist_ok=True)
+            with open(snapshot_dir / file_name, 'wb') as f:
+                f.write(tree_bytes(tree))
+        with open(snapshot_dir / MANIFEST_FILE_NAME, 'w') as f:
+            json.dump({file_name: etag for file_name, (_, etag, _) in entries}, f, indent=2)
+
+    def start(self, snapshot_dir: Optional[str] = None) -> None:
+        """
+        Warm the store (from the snapshot if given) and start the background refresher, whose first
+        pass loads every tree not in the snapshot, and the prefetcher if prefetch_interval is set.
+        """
+        if snapshot_dir:
+            self.warm_from_snapshot(snapshot_dir)
+        if self.refresher is not None:
+            return
+
+        def refresh_forever():
+            load_missing = True
+            while True:
+                try:
+                    self.refresh(load_missing=load_missing)
+                    load_missing = False
+                except Exception as e:
+                    logger.error(f"Error refreshing trees: {e}")
+                if self.refresh_interval <= 0 or self.stopped.wait(self.refresh_interval):
+                    return
+
+        self.refresher = threading.Thread(target=refresh_forever, name='tree-store-refresher', daemon=True)
+        self.refresher.start()
+
+        if self.prefetch_interval > 0:
+            def prefetch_forever():
+                while not self.stopped.wait(self.prefetch_interval):
+                    try:
+                        self.prefetch()
+                    except Exception as e:
+                        logger.error(f"Error prefetching trees: {e}")
+
+            self.prefetcher = threading.Thread(target=prefetch_forever, name='tree-store-prefetcher', daemon=True)
+            self.prefetcher.start()
+
+    def stop(self) -> None:
+        """
+        Stop the background refresher and prefetcher (after their current pass).
+        """
+        self.stopped.set()
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            return {
+                **self.counters,
+                'hit_rate': self.counters['hits'] / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'hot': len(self.hot),
+            }
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Write a snapshot of the manual-retrieval trees to warm the tree store from')
+    parser.add_argument('snapshot_dir')
+    parser.add_argument('--container', default='ds100-su25')
+    parser.add_argument('--prefix', default='docs_manual/trees/')
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    from clients import get_container_client
+
+    load_dotenv('./keys.env')
+    store = TreeStore(get_container_client(args.container), args.prefix, max_bytes=2 ** 62)
+    store.refresh(load_missing=True)
+    store.save_snapshot(args.snapshot_dir)
+    print(f"Saved {len(store.entries)} trees to {args.snapshot_dir}")
@@ -1,8 +1,24 @@
 # tree_utils.py
 import json
 import os
+import time
+import base64
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from utils import generate
+import numpy as np
+
+from utils import generate, embed_texts
+
+EMBEDDINGS_DIR = "embeddings"
+
+
+def embeddings_name(file_name):
+    """
+    Returns the name of the embeddings sidecar of a tree (JSON or compact) relative to the tree prefix.
+    """
+    return f"{EMBEDDINGS_DIR}/{os.path.splitext(file_name)[0]}.json"
 
 
 def get_summary_prompt(text, contents=False):
@@ -75,6 +91,24 @@ def create_TOC(tree_folder):
     print("table_of_contents.json created successfully!")
 
 
+def update_TOC_entry(tree_folder, filename, tree):
+    """
+    Updates the TOC entry of a single tree instead of re-reading every tree of the folder.
+    """
+    toc_path = os.path.join(tree_folder, "table_of_contents.json")
+    if not os.path.exists(toc_path):
+        create_TOC(tree_folder)
+        return
+    with open(toc_path, "r", encoding="utf-8") as toc_file:
+        table_of_contents = json.load(toc_file)
+    table_of_contents[filename] = max(tree.keys())
+    table_of_contents = dict(sorted(table_of_contents.items()))
+    with open(toc_path, "w", encoding="utf-8") as toc_file:
+        json.dump(table_of_contents, toc_file, indent=4)
+
+    print(f"table_of_contents.json entry of {filename} updated!")
+
+
 def build_balanced_tree(nodes, branch_factor=2, contents=False):
     """
     Recursively constructs a balanced tree from a list of nodes.
@@ -121,4 +155,246 @@ def build_balanced_tree(nodes, branch_factor=2, contents=False):
     # Combine all child summaries to form the parent's summary.
     combined_text = "\n\n".join(child_summaries)
     parent_summary = extract_summary(combined_text, contents)
-    return {parent_summary: children_dict}
\ No newline at end of file
+    return {parent_summary: children_dict}
+
+
+class RateLimiter:
+    """
+    Spaces out calls to at most requests_per_minute across all threads (no limit if None).
+    """
+
+    def __init__(self, requests_per_minute=None):
+        self.interval = 60 / requests_per_minute if requests_per_minute else 0
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(max(0, slot - now))
+
+
+class SummaryCheckpoint:
+    """
+    Append-only JSON-lines file of completed summaries keyed by the hash of their input, so an
+    interrupted build resumes where it stopped (and unchanged nodes of a rebuild are free).
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.summaries = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn last line of a crashed build
+                    self.summaries[entry["key"]] = entry["summary"]
+
+    @staticmethod
+    def key(text, contents=False):
+        return hashlib.sha256(f"{int(contents)}:{text}".encode("utf-8")).hexdigest()
+
+    def get(self, text, contents=False):
+        return self.summaries.get(self.key(text, contents))
+
+    def put(self, text, summary, contents=False):
+        key = self.key(text, contents)
+        with self.lock:
+            if self.summaries.get(key) == summary:
+                return
+            self.summaries[key] = summary
+            if self.path:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps({"key": key, "summary": summary}) + "\n")
+
+
+def seed_checkpoint_from_tree(checkpoint, tree, contents=False):
+    """
+    Records the summaries of an existing tree under the hashes of their inputs (a leaf's chunk, or
+    the joined summaries of a parent's children), so a rebuild only re-summarizes the nodes whose
+    inputs changed: the changed leaves and their paths to the root.
+    """
+    for key, value in tree.items():
+        if key in ("Error in summary", "Summary unavailable"):
+            continue
+        if isinstance(value, dict):
+            seed_checkpoint_from_tree(checkpoint, value, contents)
+            checkpoint.put("\n\n".join(value.keys()), key, contents)
+        else:
+            checkpoint.put(value, key, contents)
+
+
+def plan_balanced_tree(num_nodes, branch_factor=2):
+    """
+    Returns the shape build_balanced_tree gives num_nodes leaves: a leaf index for a single node,
+    otherwise a list of child plans (leaf indices directly when num_nodes <= branch_factor).
+    """
+    def plan(start, count):
+        if count == 1:
+            return start
+        if count <= branch_factor:
+            return list(range(start, start + count))
+        children = []
+        group_size, remainder = divmod(count, branch_factor)
+        for i in range(branch_factor):
+            size = group_size + (1 if i < remainder else 0)
+            children.append(plan(start, size))
+            start += size
+        return children
+    return plan(0, num_nodes)
+
+
+def build_tree_parallel(chunks, branch_factor=2, contents=False, max_workers=8, requests_per_minute=None,
+                        checkpoint_path=None, max_attempts=3, previous_tree=None):
+    """
+    Builds the same tree as generate_leaf_nodes + build_balanced_tree, but level by level: all leaf
+    summaries are generated concurrently, then all parents whose children are done, and so on up
+    to the root. Calls go through a bounded worker pool and a rate limiter, failed summaries are
+    retried with backoff, and every completed summary is checkpointed so a rerun resumes.
+
+    Summaries are looked up by the hash of their input first (in the checkpoint, and in
+    previous_tree if given), so rebuilding after a document change only recomputes dirty paths.
+    """
+    checkpoint = SummaryCheckpoint(checkpoint_path)
+    if previous_tree:
+        seed_checkpoint_from_tree(checkpoint, previous_tree, contents)
+    limiter = RateLimiter(requests_per_minute)
+    generated = []
+
+    def summarize(text):
+        summary = checkpoint.get(text, contents)
+        if summary is not None:
+            return summary
+        generated.append(text)
+        for attempt in range(max_attempts):
+            limiter.wait()
+            summary = extract_summary(text, contents)
+            if summary not in ("Error in summary", "Summary unavailable"):
+                checkpoint.put(text, summary, contents)
+                return summary
+            time.sleep(2 ** attempt)
+        return summary
+
+    chunks = [chunk for chunk in chunks if chunk.strip()]
+    if not chunks:
+        return {}
+    plan = plan_balanced_tree(len(chunks), branch_factor)
+
+    # Group the internal nodes by height so each level only waits for the one below it
+    levels = []
+
+    def collect(node):
+        if isinstance(node, int):
+            return 0
+        height = 1 + max(collect(child) for child in node)
+        while len(levels) < height:
+            levels.append([])
+        levels[height - 1].append(node)
+        return height
+    collect(plan)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        leaf_summaries = list(executor.map(summarize, chunks))
+        summaries = {}  # id of a plan node -> summary
+        for level in levels:
+            texts = [
+                "\n\n".join(leaf_summaries[child] if isinstance(child, int) else summaries[id(child)] for child in node)
+                for node in level
+            ]
+            for node, summary in zip(level, executor.map(summarize, texts)):
+                summaries[id(node)] = summary
+
+    def assemble(node):
+        if isinstance(node, int):
+            return leaf_summaries[node], chunks[node]
+        children = {}
+        for child in node:
+            key, value = assemble(child)
+            children[key] = value
+        return summaries[id(node)], children
+
+    key, value = assemble(plan)
+    total = len(chunks) + sum(len(level) for level in levels)
+    print(f"Tree built: {total - len(generated)} summaries reused, {len(generated)} generated")
+    return {key: value}
+
+
+def collect_node_keys(tree):
+    """
+    Returns the summaries of every node of a tree (its dict keys), parents before children.
+    """
+    keys = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            keys.extend(node.keys())
+            stack.extend(reversed(list(node.values())))
+    return keys
+
+
+def encode_vector(vector):
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode("ascii")
+
+
+def decode_vector(encoded):
+    return np.frombuffer(base64.b64decode(encoded), dtype=np.float32)
+
+
+def collect_leaf_texts(tree):
+    """
+    Returns the content of every leaf of a tree.
+    """
+    texts = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            stack.extend(reversed(list(node.values())))
+        else:
+            texts.append(node)
+    return texts
+
+
+def build_node_embeddings(tree, model_name):
+    """
+    Embeds every node summary and leaf chunk of a tree, for the embedding scorer of the beam search
+    and the collapsed-tree index.
+
+    Returns a dict {"model": model_name, "vectors": {text: base64 float32 vector}}, stored next to
+    the tree as embeddings/<tree file name>.
+    """
+    keys = list(dict.fromkeys(collect_node_keys(tree) + collect_leaf_texts(tree)))
+    vectors = embed_texts(keys, model_name=model_name)
+    return {"model": model_name, "vectors": {key: encode_vector(vector) for key, vector in zip(keys, vectors)}}
+
+
+def write_node_embeddings(tree, tree_file, model_name):
+    """
+    Writes the node embeddings of a tree, reusing the vectors of the previous embeddings file for
+    unchanged texts.
+    """
+    tree_dir, file_name = os.path.split(tree_file)
+    embeddings_file = os.path.join(tree_dir, EMBEDDINGS_DIR, file_name)
+    os.makedirs(os.path.dirname(embeddings_file), exist_ok=True)
+    previous = {}
+    if os.path.exists(embeddings_file):
+        with open(embeddings_file, "r", encoding="utf-8") as file:
+            data = json.load(file)
+        if data.get("model") == model_name:
+            previous = data["vectors"]
+    texts = list(dict.fromkeys(collect_node_keys(tree) + collect_leaf_texts(tree)))
+    missing = [text for text in texts if text not in previous]
+    computed = dict(zip(missing, embed_texts(missing, model_name=model_name))) if missing else {}
+    vectors = {text: previous[text] if text in previous else encode_vector(computed[text]) for text in texts}
+    with open(embeddings_file, "w", encoding="utf-8") as file:
+        json.dump({"model": model_name, "vectors": vectors}, file)
+    print(f"Node embeddings saved to {embeddings_file}")
@@ -0,0 +1,154 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Fraction of max_disk_entries freed once the disk cache is over it, so evictions run in batches
+DISK_EVICTION_BATCH = 0.1
+
+
+def url_key(url: str) -> str:
+    return f'url:{url}'
+
+
+def content_key(content: bytes) -> str:
+    return f'sha256:{hashlib.sha256(content).hexdigest()}'
+
+
+class OCRCache:
+    """
+    Content-addressed cache of OCR results.
+
+    Entries are stored under both the image URL and the SHA-256 of the image bytes, so a
+    screenshot re-sent with an earlier turn hits on its URL and a re-uploaded copy of the
+    same image hits on its content. The in-memory layer is an LRU bounded by max_entries;
+    when db_path is set, entries are also persisted to SQLite (bounded by max_disk_entries)
+    and survive restarts.
+    """
+
+    def __init__(self, max_entries: int = 10000, db_path: Optional[str] = None, max_disk_entries: int = 1000000):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'url_hits': 0, 'content_hits': 0, 'misses': 0}
+        self.db = None
+        self.disk_entries = 0  # upper bound on the rows on disk, recounted before evicting
+        if db_path:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS ocr_cache (key TEXT PRIMARY KEY, text TEXT, last_used REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS ocr_cache_last_used ON ocr_cache (last_used)')
+            self.db.commit()
+            self.disk_entries = self.db.execute('SELECT COUNT(*) FROM ocr_cache').fetchone()[0]
+
+    @classmethod
+    def from_env(cls) -> 'OCRCache':
+        return cls(
+            max_entries=int(os.getenv('OCR_CACHE_SIZE', '10000')),
+            db_path=os.getenv('OCR_CACHE_PATH') or None
+        )
+
+    def _get(self, key: str) -> Optional[str]:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.db is not None:
+            row = self.db.execute('SELECT text FROM ocr_cache WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.db.execute('UPDATE ocr_cache SET last_used = ? WHERE key = ?', (time.time(), key))
+                self.db.commit()
+                self._remember(key, row[0])
+                return row[0]
+        return None
+
+    def _remember(self, key: str, text: str) -> None:
+        self.entries[key] = text
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_by_url(self, url: str) -> Optional[str]:
+        with self.lock:
+            text = self._get(url_key(url))
+            if text is not None:
+                self.counters['url_hits'] += 1
+            return text
+
+    def get_by_content(self, url: str, content: bytes) -> Optional[str]:
+        """
+        Look up an image by its bytes after a URL miss; a hit is also recorded under the URL.
+        A miss is counted here, since the caller will have to OCR the image.
+        """
+        with self.lock:
+            text = self._get(content_key(content))
+            if text is None:
+                self.counters['misses'] += 1
+                return None
+            self.counters['content_hits'] += 1
+        self.put([url_key(url)], text)
+        return text
+
+    def put(self, keys: Iterable[str], text: str) -> None:
+        with self.lock:
+            keys = list(keys)
+            for key in keys:
+                self._remember(key, text)
+            if self.db is not None:
+                now = time.time()
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO ocr_cache (key, text, last_used) VALUES (?, ?, ?)',
+                    [(key, text, now) for key in keys]
+                )
+                self.disk_entries += len(keys)
+                if self.disk_entries > self.max_disk_entries:
+                    self._evict_disk()
+                self.db.commit()
+
+    def _evict_disk(self) -> None:
+        """
+        Delete the least recently used rows beyond max_disk_entries (less DISK_EVICTION_BATCH of it).
+        """
+        self.disk_entries = self.db.execute('SELECT COUNT(*) FROM ocr_cache').fetchone()[0]
+        if self.disk_entries <= self.max_disk_entries:
+            return
+        keep = int(self.max_disk_entries * (1 - DISK_EVICTION_BATCH))
+        self.disk_entries -= self.db.execute(
+            'DELETE FROM ocr_cache WHERE key IN '
+            '(SELECT key FROM ocr_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+            (keep,)
+        ).rowcount
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            hits = self.counters['url_hits'] + self.counters['content_hits']
+            lookups = hits + self.counters['misses']
+            return {
+                **self.counters,
+                'hits': hits,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+            }
+
+
+_ocr_cache = None
+_ocr_cache_lock = threading.Lock()
+
+
+def get_ocr_cache() -> OCRCache:
+    """
+    Get the process-wide OCR cache, configured by OCR_CACHE_SIZE and OCR_CACHE_PATH on first use.
+    """
+    global _ocr_cache
+    with _ocr_cache_lock:
+        if _ocr_cache is None:
+            _ocr_cache = OCRCache.from_env()
+        return _ocr_cache
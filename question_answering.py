@@ -0,0 +1,323 @@
+import os
+import time
+import logging
+from typing import Any, Dict, Optional
+
+from courses import CourseConfig, resolve_course, reload_course_configs, get_course_config
+from manual_retrieval.tree_retrieval import reload_manual_retrievers
+from manual_retrieval.toc_filter import get_assignment_type
+from local_index import preload_local_indexes
+from scheduler import Stage
+from assignment_generation import latency_tracker
+from semantic_cache import get_semantic_cache, get_cache_namespace
+from job_queue import PermanentJobError
+from utils import CommentPostedError, xml_to_markdown
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# The question pipeline shared by the Flask app (app.py) and the ASGI app (asgi.py). The steps are
+# written once, as coroutines over a backend doing the I/O: app.SyncBackend calls the blocking
+# functions of utils.py, asgi.AsyncBackend the httpx ones of async_utils.py. Besides the awaited
+# I/O methods, a backend has retrieve_qa, retrieve_docs_hybrid and manual_retrieval, which build the
+# run of a retrieval Stage in the form its run_stages expects (a blocking call or a coroutine). The
+# blocking backend never suspends, so run_sync drives its coroutines without an event loop.
+
+
+def run_sync(coroutine):
+    """
+    Run a pipeline coroutine on a blocking backend to completion, on the calling thread.
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coroutine.close()
+    raise RuntimeError('The pipeline suspended on a blocking backend')
+
+
+def check_question(input_dict: Dict[str, Any]) -> Optional[str]:
+    """
+    The reason a question request cannot be answered, or None if it is well-formed.
+    """
+    if not input_dict.get('course'):
+        return 'No course specified'
+    try:
+        resolve_course(input_dict['course'])
+    except ValueError as e:
+        return str(e)
+    if not input_dict.get('category'):
+        return 'No category specified'
+    return None
+
+
+def reload_configs() -> list:
+    """
+    Reload the course configs and prompts, then the manual retrievers and local indexes they point to.
+    """
+    configs = reload_course_configs()
+    reload_manual_retrievers(configs)
+    preload_local_indexes()
+    return list(configs)
+
+
+async def answer_question(io, input_dict: Dict[str, Any], request_start: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Answer a forum question end to end: OCR, retrieval, generation, then logging and posting.
+
+    Args:
+        io: The backend doing the I/O (app.SyncBackend or asgi.AsyncBackend).
+        input_dict (Dict[str, Any]): The request sent by the Ed bot, checked by check_question.
+        request_start (Optional[float]): The time.monotonic() the latency budget counts from. Defaults to now.
+
+    Returns:
+        Dict[str, Any]: The intermediate and final outputs of the pipeline.
+    """
+    request_start = request_start or time.monotonic()
+    course = input_dict['course']
+    logger.info('Course: %s', course)
+    # One immutable snapshot for the whole request, even if the configs are reloaded meanwhile
+    config = get_course_config(course)
+    prompts = config.prompts
+
+    question_category = input_dict['category']
+    logger.info('Question category: %s', question_category)
+
+    # Conversation processing (OCR)
+    fields = ["thread_title", "category", "subcategory", "subsubcategory"]
+    metadata = [input_dict.get(f, "") for f in fields]
+    metadata_str = " | ".join(f"{f}: {val}" for f, val in zip(fields, metadata) if val)
+    logger.info("Metadata string: %s", metadata_str)
+    processed_conversation = await io.ocr_process_input(
+        metadata=metadata_str,
+        conversation_history=input_dict.get("conversation_history")
+    )
+    logger.info('Processed conversation: %s', processed_conversation)
+
+    processed_conversation_search = await io.process_conversation_search(
+        processed_conversation=processed_conversation,
+        prompt_summarize=prompts.get_summarize_conversation_prompt(processed_conversation[:-1])
+    )
+    logger.info('Processed (summarized) conversation for search: %s', processed_conversation_search)
+
+    # Semantic response cache (first-turn questions only: follow-ups depend on earlier TA replies)
+    cache_namespace = get_cache_namespace(config.name, question_category, input_dict, config.version)
+    cache_vector = None
+    if config.semantic_cache and len(processed_conversation) == 1:
+        try:
+            cache_vector = await io.embed_text(processed_conversation_search, model_name=config.embedding_model_name)
+        except Exception as e:
+            logger.error(f"Error embedding question for the semantic cache: {e}")
+    if cache_vector is not None:
+        cached_output = get_semantic_cache().lookup(cache_namespace, cache_vector,
+                                                    threshold=config.semantic_cache_threshold)
+        if cached_output is not None:
+            output_dict = {
+                **cached_output,
+                'processed_conversation': processed_conversation,
+                'processed_conversation_search': processed_conversation_search,
+                'semantic_cache_hit': True
+            }
+            await log_and_post(io, course, input_dict, output_dict, config,
+                               post_comment=input_dict.get('post_comment') == 'true')
+            return output_dict
+
+    # Retrieval (QA, hybrid and manual stages only depend on the summarized conversation, so they run concurrently)
+    stages = {
+        'qa': Stage(
+            run=lambda: io.retrieve_qa(
+                conversation=processed_conversation_search,
+                top_k=config.qa_top_k,
+                project_name=config.qa_project_name,
+                deployment_name=config.qa_deployment_name
+            ),
+            timeout=config.qa_timeout,
+            fallback='None'
+        )
+    }
+
+    # Hybrid document retrieval
+    hybrid_index_params = config.hybrid_index_params(question_category)
+    if hybrid_index_params:
+        index_name, index_top_k, semantic_reranking = hybrid_index_params
+        stages['hybrid'] = Stage(
+            run=lambda: io.retrieve_docs_hybrid(
+                text=processed_conversation_search,
+                index_name=index_name,
+                top_k=index_top_k,
+                semantic_reranking=semantic_reranking,
+                model_name=config.embedding_model_name,
+                retrieval_backend=config.retrieval_backend,
+                local_index_dir=config.local_index_dir,
+                local_index_mmap=config.local_index_mmap
+            ),
+            timeout=config.hybrid_timeout,
+            fallback='none'
+        )
+
+    # Manual document retrieval
+    problem_list_manual = selected_doc_manual = 'none'
+    if question_category in (config.assignment_categories + config.worksheet_categories):
+        assignment_type = get_assignment_type(question_category, input_dict.get('subcategory'),
+                                              config.category_mapping, config.subcategory_mapping)
+        thread_hint = ' '.join(filter(None, (input_dict.get(f) for f in ('subcategory', 'subsubcategory', 'thread_title'))))
+        stages['manual'] = Stage(
+            run=lambda: io.manual_retrieval(processed_conversation_search, config.name,
+                                            scorer=config.manual_retrieval_scorer,
+                                            mode=config.manual_retrieval_mode,
+                                            assignment_type=assignment_type,
+                                            hint=thread_hint,
+                                            toc_candidates=config.manual_toc_candidates),
+            timeout=config.manual_timeout,
+            fallback=('none', 0)
+        )
+
+    results = await io.run_stages(stages)
+    retrieved_qa_pairs = results['qa']
+    retrieved_docs_hybrid = results.get('hybrid', 'none')
+    retrieved_docs_manual, gpt_num_called = results.get('manual', ('none', 0))
+    logger.info('Retrieved QA pairs: %s', retrieved_qa_pairs)
+    logger.info('Retrieved hybrid documents: %s', retrieved_docs_hybrid)
+    logger.info('Retrieved manual documents: %s', retrieved_docs_manual)
+
+    # Response generation
+    response_0 = response = ''
+    final_prompt = None
+    if question_category in config.assignment_categories:
+        response_0, final_prompt = await io.prepare_assignment_response(
+            prompts=prompts,
+            course=course,
+            processed_conversation=processed_conversation,
+            retrieved_qa_pairs=retrieved_qa_pairs,
+            retrieved_docs_manual=retrieved_docs_manual,
+            mode=config.assignment_generation_mode,
+            latency_budget=config.assignment_latency_budget,
+            elapsed=time.monotonic() - request_start
+        )
+        logger.info('Initial response (assignment question): %s', response_0)
+    elif question_category in config.content_categories:
+        final_prompt = prompts.get_content_prompt(
+            processed_conversation=processed_conversation,
+            retrieved_qa_pairs=retrieved_qa_pairs,
+            retrieved_docs_hybrid=retrieved_docs_hybrid
+        )
+    elif question_category in config.logistics_categories:
+        final_prompt = prompts.get_logistics_prompt(
+            processed_conversation=processed_conversation,
+            retrieved_qa_pairs=retrieved_qa_pairs,
+            retrieved_docs_hybrid=retrieved_docs_hybrid
+        )
+    elif question_category in config.worksheet_categories:
+        final_prompt = prompts.get_worksheet_prompt(
+            processed_conversation=processed_conversation,
+            retrieved_qa_pairs=retrieved_qa_pairs,
+            retrieved_docs_manual=retrieved_docs_manual,
+            retrieved_docs_hybrid=retrieved_docs_hybrid
+        )
+
+    # With stream_comment, the private Ed comment is posted early and edited as tokens arrive. It is
+    # posted without the 'edison' prefix: the Ed bot (edstem_frontend.js) re-posts prefixed comments
+    # and drops the originals, which would leave the edits on a comment that no longer exists
+    final_start = time.monotonic()
+    streamed = bool(final_prompt) and input_dict.get('post_comment') == 'true' and input_dict.get('stream_comment') == 'true'
+    if streamed:
+        try:
+            response = await io.stream_to_ed(
+                course=course,
+                id=input_dict.get('comment_id'),
+                prompt=final_prompt,
+                min_chars=int(os.getenv('STREAM_MIN_CHARS', '200')),
+                edit_interval=float(os.getenv('STREAM_EDIT_INTERVAL', '2.0'))
+            )
+        except CommentPostedError as e:
+            # A retry of the (queued) request would post a second comment
+            raise PermanentJobError(str(e)) from e
+    elif final_prompt:
+        response = await io.generate(prompt=final_prompt)
+    if response_0:
+        latency_tracker.record(course, 'final_pass', time.monotonic() - final_start)
+    logger.info('Final response: %s', response)
+
+    # Logging and posting
+    output_dict = {
+        'processed_conversation': processed_conversation,
+        'processed_conversation_search': processed_conversation_search,
+        'retrieved_qa_pairs': retrieved_qa_pairs,
+        'retrieved_docs_hybrid': retrieved_docs_hybrid,
+        'problem_list_manual': problem_list_manual,
+        'selected_doc_manual': selected_doc_manual,
+        'retrieved_docs_manual': retrieved_docs_manual,
+        'response_0': response_0,
+        'response': response,
+        'semantic_cache_hit': False
+    }
+    if cache_vector is not None and response:
+        get_semantic_cache().put(cache_namespace, cache_vector, output_dict)
+
+    await log_and_post(io, course, input_dict, output_dict, config,
+                       post_comment=input_dict.get('post_comment') == 'true' and not streamed)
+    return output_dict
+
+
+async def log_and_post(io, course: str, input_dict: Dict[str, Any], output_dict: Dict[str, Any],
+                       config: CourseConfig, post_comment: bool) -> None:
+    prod = input_dict.get('prod') == 'true'
+    version = config.version
+    experiment_name = input_dict.get('experiment_name', 'test')
+
+    # Logging failures are not fatal: the answer is (or, when streamed, already was) posted either
+    # way, and a failed queued job would be retried and post it again
+    if input_dict.get('log_blob') == 'true':
+        log_path_blob = f"logs/{'production' if prod else 'test'}/{version if prod else experiment_name}.jsonl"
+        try:
+            await io.log_blob({"inputs": input_dict, "outputs": output_dict}, log_path_blob, config.container_name)
+        except Exception as e:
+            logger.error(f"Error logging to blob: {e}")
+
+    if input_dict.get('log_local') == 'true':
+        log_path_local = f"logs/{course}/{'production' if prod else 'test'}/{version if prod else experiment_name}.jsonl"
+        try:
+            await io.log_local({"inputs": input_dict, "outputs": output_dict}, log_path_local)
+        except Exception as e:
+            logger.error(f"Error logging to local: {e}")
+
+    if post_comment:
+        await io.reply_to_ed(course=course, id=input_dict.get('comment_id'), text='edison'+output_dict['response'],
+                             post_answer=False, private=True)
+
+
+async def publish_answer(io, input_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Publish a TA-approved answer (the `/public` route): delete the bot's private comments and post
+    the text publicly.
+
+    Args:
+        io: The backend doing the I/O (app.SyncBackend or asgi.AsyncBackend).
+        input_dict (Dict[str, Any]): The request sent by the Ed bot.
+
+    Returns:
+        Dict[str, Any]: A success message.
+    """
+    course = input_dict.get('course')
+    config = get_course_config(course)
+
+    question_id = input_dict.get('question_id', '')
+    input_dict['text'] = xml_to_markdown(input_dict.get('text', ''))
+    post_answer = "thread" in question_id
+
+    await io.delete_comments(course=course, ids=[input_dict.get('curr_comment_id'),
+                                                 input_dict.get('parent_comment_id')])
+    input_dict.pop('curr_comment_id', None)
+    input_dict.pop('parent_comment_id', None)
+
+    if input_dict.get('log_blob') == 'true':
+        log_path_blob = f"logs/production/{config.version}_final.jsonl"
+        await io.log_blob(input_dict, log_path_blob, config.container_name)
+
+    await io.reply_to_ed(
+        course=course,
+        id=question_id.split('_')[-1],
+        text=f"publicedison{'answer' if post_answer else 'comment'}{input_dict['text']}",
+        post_answer=post_answer,
+        private=False)
+    return {'message': 'Success'}
@@ -0,0 +1,71 @@
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Any, Callable, Dict, NamedTuple
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Shared across requests; stages that miss their deadline keep running here in the background.
+executor = ThreadPoolExecutor(max_workers=int(os.getenv('RETRIEVAL_WORKERS', '32')),
+                              thread_name_prefix='retrieval')
+
+
+class Stage(NamedTuple):
+    run: Callable[[], Any]  # a function for run_stages, a coroutine function for run_stages_async
+    timeout: float          # seconds, measured from the start of the fan-out
+    fallback: Any           # result used when the stage times out or fails
+
+
+def run_stages(stages: Dict[str, Stage]) -> Dict[str, Any]:
+    """
+    Run independent pipeline stages concurrently in the shared thread pool.
+
+    Args:
+        stages (Dict[str, Stage]): The stages to run, keyed by name.
+
+    Returns:
+        Dict[str, Any]: The result of each stage, or its fallback if it missed its deadline or failed.
+    """
+    start = time.monotonic()
+    futures = {name: executor.submit(stage.run) for name, stage in stages.items()}
+    results = {}
+    for name, future in futures.items():
+        stage = stages[name]
+        try:
+            results[name] = future.result(timeout=max(0.0, start + stage.timeout - time.monotonic()))
+        except TimeoutError:
+            logger.warning('Stage %s missed its %.1fs deadline, using fallback', name, stage.timeout)
+            results[name] = stage.fallback
+        except Exception as e:
+            logger.error('Stage %s failed: %s', name, e)
+            results[name] = stage.fallback
+    logger.info('Retrieval stages finished in %.2fs', time.monotonic() - start)
+    return results
+
+
+async def run_stages_async(stages: Dict[str, Stage]) -> Dict[str, Any]:
+    """
+    Async variant of run_stages: run independent coroutine stages concurrently.
+
+    Args:
+        stages (Dict[str, Stage]): The stages to run, keyed by name.
+
+    Returns:
+        Dict[str, Any]: The result of each stage, or its fallback if it missed its deadline or failed.
+    """
+    async def run_stage(name: str, stage: Stage) -> Any:
+        try:
+            return await asyncio.wait_for(stage.run(), timeout=stage.timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Stage %s missed its %.1fs deadline, using fallback', name, stage.timeout)
+        except Exception as e:
+            logger.error('Stage %s failed: %s', name, e)
+        return stage.fallback
+
+    start = time.monotonic()
+    results = await asyncio.gather(*(run_stage(name, stage) for name, stage in stages.items()))
+    logger.info('Retrieval stages finished in %.2fs', time.monotonic() - start)
+    return dict(zip(stages, results))
@@ -0,0 +1,131 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class SemanticResponseCache:
+    """
+    In-process vector index of pipeline outputs keyed by the embedding of the summarized question.
+
+    Entries live in namespaces (course, category, subcategories, config version) so a cached answer
+    is only served for the same course, category, assignment and prompts. A lookup returns the most
+    similar entry of the namespace if its cosine similarity reaches the threshold. Entries expire
+    after ttl seconds and the least recently used ones are evicted beyond max_entries.
+    """
+
+    def __init__(self, ttl: float = 86400, max_entries: int = 5000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # entry id -> (namespace, unit vector, value, expires_at)
+        self.indexes = {}  # namespace -> (entry ids, matrix of unit vectors), rebuilt lazily
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    @classmethod
+    def from_env(cls) -> 'SemanticResponseCache':
+        return cls(
+            ttl=float(os.getenv('SEMANTIC_CACHE_TTL', '86400')),
+            max_entries=int(os.getenv('SEMANTIC_CACHE_SIZE', '5000'))
+        )
+
+    @staticmethod
+    def normalize(vector: List[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_id: int) -> None:
+        namespace = self.entries.pop(entry_id)[0]
+        self.indexes.pop(namespace, None)
+
+    def _expire(self, now: float) -> None:
+        expired = [entry_id for entry_id, entry in self.entries.items() if entry[3] <= now]
+        for entry_id in expired:
+            self._remove(entry_id)
+        self.counters['expirations'] += len(expired)
+
+    def _index(self, namespace: Hashable):
+        if namespace not in self.indexes:
+            ids = [entry_id for entry_id, entry in self.entries.items() if entry[0] == namespace]
+            matrix = np.stack([self.entries[entry_id][1] for entry_id in ids]) if ids else None
+            self.indexes[namespace] = (ids, matrix)
+        return self.indexes[namespace]
+
+    def lookup(self, namespace: Hashable, vector: List[float], threshold: float) -> Optional[Any]:
+        """
+        Get the cached value of the most similar question of a namespace, if similar enough.
+
+        Args:
+            namespace (Hashable): The (course, category, subcategories, config version) namespace.
+            vector (List[float]): The embedding of the summarized question.
+            threshold (float): The minimum cosine similarity of a hit.
+
+        Returns:
+            Optional[Any]: The cached value, or None on a miss.
+        """
+        with self.lock:
+            self._expire(time.time())
+            ids, matrix = self._index(namespace)
+            if matrix is not None:
+                similarities = matrix @ self.normalize(vector)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= threshold:
+                    self.entries.move_to_end(ids[best])
+                    self.counters['hits'] += 1
+                    logger.info('Semantic cache hit (similarity %.3f)', similarities[best])
+                    return self.entries[ids[best]][2]
+            self.counters['misses'] += 1
+            return None
+
+    def put(self, namespace: Hashable, vector: List[float], value: Any) -> None:
+        with self.lock:
+            self.entries[self.next_id] = (namespace, self.normalize(vector), value, time.time() + self.ttl)
+            self.next_id += 1
+            self.indexes.pop(namespace, None)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.counters['evictions'] += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            return {
+                **self.counters,
+                'hit_rate': self.counters['hits'] / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+            }
+
+
+_semantic_cache = None
+_semantic_cache_lock = threading.Lock()
+
+
+def get_semantic_cache() -> SemanticResponseCache:
+    """
+    Get the process-wide semantic response cache, configured by SEMANTIC_CACHE_TTL and SEMANTIC_CACHE_SIZE.
+    """
+    global _semantic_cache
+    with _semantic_cache_lock:
+        if _semantic_cache is None:
+            _semantic_cache = SemanticResponseCache.from_env()
+        return _semantic_cache
+
+
+def get_cache_namespace(course: str, question_category: str, input_dict: Dict[str, Any], version: str) -> tuple:
+    """
+    Namespace of a request: answers are only shared within a course, category, subcategory and
+    subsubcategory (for assignments, the homework and question) and prompt version (the experiment
+    name stands in for the version outside production).
+    """
+    prod = input_dict.get('prod') == 'true'
+    return (course, question_category, input_dict.get('subcategory'), input_dict.get('subsubcategory'),
+            version if prod else input_dict.get('experiment_name', 'test'))
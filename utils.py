@@ -1,3 +1,4 @@
+import io
 import os
 import re
 import ast
@@ -6,26 +7,120 @@ import time
 import json
 import logging
 from pathlib import Path
-from typing import List, Dict, Any, Callable
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional
 from datetime import datetime
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from xml.etree import ElementTree as ET
 
-import requests
-from azure.cognitiveservices.vision.computervision import ComputerVisionClient
+import tiktoken
+
 from azure.cognitiveservices.vision.computervision.models import OperationStatusCodes
-from msrest.authentication import CognitiveServicesCredentials
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.language.questionanswering import QuestionAnsweringClient
-from openai import AzureOpenAI
-from azure.storage.blob import BlobServiceClient
-from azure.search.documents import SearchClient
 from azure.search.documents.models import VectorizedQuery
 
+from clients import (
+    get_http_session,
+    get_computervision_client,
+    get_qa_client,
+    get_openai_client,
+    get_search_client,
+    get_container_client
+)
+
+from ocr_cache import get_ocr_cache, url_key, content_key
+from embedding_cache import get_embedding_cache, embedding_key
+from local_index import get_local_index
+
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+OCR_POLL_INITIAL_DELAY = 0.25
+OCR_POLL_BACKOFF = 1.5
+OCR_POLL_MAX_DELAY = 2.0
+
+EMBEDDING_MAX_INPUT_TOKENS = 8191
+EMBEDDING_BATCH_SIZE = 2048
+EMBEDDING_BATCH_TOKENS = 300000
+
+
+def get_image_links(xml: str) -> List[str]:
+    """
+    Get the URLs of all images embedded in an XML document.
+
+    Args:
+        xml (str): An XML string containing image elements with 'src' attribute pointing to the image URL.
+
+    Returns:
+        List[str]: The image URLs in document order.
+    """
+    root = ET.fromstring(xml)
+    return [image.get('src') for image in root.iter('image')]
+
+
+def download_image(url: str) -> bytes:
+    response = get_http_session().get(url, timeout=30)
+    response.raise_for_status()
+    return response.content
+
+
+def ocr_images(image_links: List[str]) -> List[str]:
+    """
+    Extract text from many images at once using Azure's Computer Vision OCR service.
+
+    Images already in the OCR cache (by URL, or by content hash after downloading them) are
+    not sent to the service. The remaining read operations are submitted up front and then
+    polled together, starting at OCR_POLL_INITIAL_DELAY and backing off by OCR_POLL_BACKOFF
+    up to OCR_POLL_MAX_DELAY.
+
+    Args:
+        image_links (List[str]): The URLs of the images.
+
+    Returns:
+        List[str]: The extracted text of each image, in the same order as image_links.
+    """
+    cache = get_ocr_cache()
+    extracted_texts = [cache.get_by_url(link) for link in image_links]
+    missing = [i for i, text in enumerate(extracted_texts) if text is None]
+    if not missing:
+        return extracted_texts
+
+    computervision_client = get_computervision_client()
+    with ThreadPoolExecutor(max_workers=min(len(missing), 16)) as executor:
+        contents = dict(zip(missing, executor.map(download_image, [image_links[i] for i in missing])))
+        for i, content in contents.items():
+            extracted_texts[i] = cache.get_by_content(image_links[i], content)
+        to_ocr = [i for i in missing if extracted_texts[i] is None]
+
+        read_responses = executor.map(
+            lambda i: computervision_client.read_in_stream(io.BytesIO(contents[i]), raw=True), to_ocr
+        )
+        pending = {
+            i: read_response.headers["Operation-Location"].split("/")[-1]
+            for i, read_response in zip(to_ocr, read_responses)
+        }
+        read_results = {}
+        delay = OCR_POLL_INITIAL_DELAY
+        while pending:
+            time.sleep(delay)
+            delay = min(delay * OCR_POLL_BACKOFF, OCR_POLL_MAX_DELAY)
+            polled = executor.map(computervision_client.get_read_result, pending.values())
+            for i, read_result in zip(list(pending), polled):
+                if read_result.status not in ['notStarted', 'running']:
+                    read_results[i] = read_result
+                    del pending[i]
+
+    for i in to_ocr:
+        extracted_text = []
+        if read_results[i].status == OperationStatusCodes.succeeded:
+            for text_result in read_results[i].analyze_result.read_results:
+                extracted_text.extend(line.text for line in text_result.lines)
+            cache.put([url_key(image_links[i]), content_key(contents[i])], "\n".join(extracted_text))
+        extracted_texts[i] = "\n".join(extracted_text)
+    return extracted_texts
+
+
 def question_ocr(xml: str) -> str:
     """
     Extract text from images embedded in an XML document using Azure's Computer Vision OCR service.
@@ -36,26 +131,7 @@ def question_ocr(xml: str) -> str:
     Returns:
         str: A concatenated string of all extracted text from the images in the XML.
     """
-    computervision_client = ComputerVisionClient(
-        os.getenv('OCR_ENDPOINT'), 
-        CognitiveServicesCredentials(os.getenv('OCR_KEY'))
-    )
-    root = ET.fromstring(xml)
-    image_links = [image.get('src') for image in root.iter('image')]
-    extracted_text = []
-
-    for img_link in image_links:
-        read_response = computervision_client.read(img_link, raw=True)
-        operation_id = read_response.headers["Operation-Location"].split("/")[-1]
-        while True:
-            read_result = computervision_client.get_read_result(operation_id)
-            if read_result.status not in ['notStarted', 'running']:
-                break
-            time.sleep(1)
-        if read_result.status == OperationStatusCodes.succeeded:
-            for text_result in read_result.analyze_result.read_results:
-                extracted_text.extend(line.text for line in text_result.lines)
-    return "\n".join(extracted_text)
+    return "\n".join(text for text in ocr_images(get_image_links(xml)) if text)
 
 
 def process_question(question_text: str):
@@ -85,6 +161,13 @@ def ocr_process_input(metadata: str, conversation_history: List[Dict[str, Any]])
     Returns:
         List[Dict[str, Any]]: A list representing the processed conversation turns, including extracted image context.
     """
+    # OCR every image of every turn in one batch, then split the results back per turn
+    turn_image_links = [get_image_links(turn['document']) for turn in conversation_history]
+    image_texts = iter(ocr_images([link for links in turn_image_links for link in links]))
+    image_contexts = [
+        "\n".join(text for text in (next(image_texts) for _ in links) if text)
+        for links in turn_image_links
+    ]
     processed_conversation = [
         {
             'role': (
@@ -93,9 +176,9 @@ def ocr_process_input(metadata: str, conversation_history: List[Dict[str, Any]])
                 else 'TA'
             ),
             'text': process_question(turn['text']) if turn['user_role'].lower() == 'student' else turn['text'],
-            'image_context': question_ocr(turn['document'])
+            'image_context': image_context
         }
-        for turn in conversation_history
+        for turn, image_context in zip(conversation_history, image_contexts)
     ]
     processed_conversation[0]['text'] = metadata + '\n' + processed_conversation[0]['text']
     return processed_conversation
@@ -142,33 +225,86 @@ def generate(prompt: List[Dict[str, str]], temperature: float = 0.7, top_p: floa
         "temperature": temperature,
         "top_p": top_p,
     }
-    response = requests.post(os.getenv('LLM_ENDPOINT'), headers=headers, json=payload)
+    response = get_http_session().post(os.getenv('LLM_ENDPOINT'), headers=headers, json=payload)
     response.raise_for_status()
     return response.json()['choices'][0]['message']['content']
 
 
-def retrieve_qa(conversation: str, top_k: int, confidence_threshold: float = 0.08) -> str:
+def parse_sse_data(line: str) -> Optional[str]:
+    """
+    Parse one line of a streamed chat completion (server-sent events).
+
+    Args:
+        line (str): A line of the event stream.
+
+    Returns:
+        Optional[str]: The content delta carried by the line ('' for lines without content),
+            or None once the stream is done.
+    """
+    if not line.startswith('data:'):
+        return ''
+    data = line[len('data:'):].strip()
+    if data == '[DONE]':
+        return None
+    choices = json.loads(data).get('choices') or []
+    if not choices:
+        return ''
+    return (choices[0].get('delta') or {}).get('content') or ''
+
+
+def generate_stream(prompt: List[Dict[str, str]], temperature: float = 0.7, top_p: float = 0.95) -> Iterator[str]:
+    """
+    Streaming variant of generate: yield the response of the LLM as content deltas arrive.
+
+    Args:
+        prompt (List[Dict[str, str]]): A list of message dictionaries representing the conversation history.
+        temperature (float, optional): The sampling temperature for the model's output. Defaults to 0.7.
+        top_p (float, optional): The cumulative probability cutoff for top-p sampling. Defaults to 0.95.
+
+    Yields:
+        str: The next piece of the response message.
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "api-key": os.getenv('OPENAI_KEY')
+    }
+    payload = {
+        "messages": prompt,
+        "temperature": temperature,
+        "top_p": top_p,
+        "stream": True,
+    }
+    with get_http_session().post(os.getenv('LLM_ENDPOINT'), headers=headers, json=payload, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines(decode_unicode=True):
+            delta = parse_sse_data(line or '')
+            if delta is None:
+                break
+            if delta:
+                yield delta
+
+
+def retrieve_qa(conversation: str, top_k: int, project_name: str, deployment_name: str,
+                confidence_threshold: float = 0.08) -> str:
     """
     Retrieve historical question-answer pairs related to a given conversation using Azure's Question Answering service.
 
     Args:
         conversation (str): Summary of the conversation of previous turns and the most recent student question.
         top_k (int): The maximum number of top answers to retrieve.
+        project_name (str): The Question Answering project of the course.
+        deployment_name (str): The deployment of the Question Answering project.
         confidence_threshold (float): The minimum confidence threshold for answers. Defaults to 0.08.
 
     Returns:
         str: A formatted string containing the top matching question-answer pairs retrieved from the service.
     """
-    client = QuestionAnsweringClient(
-        os.getenv('QA_ENDPOINT'), 
-        AzureKeyCredential(os.getenv('QA_KEY'))
-    )
-    output = client.get_answers(
+    output = get_qa_client().get_answers(
         question=conversation[-4999:],  # the limit is 5000 chars
         top=top_k,
         confidence_threshold=confidence_threshold,
-        project_name=os.getenv('QA_PROJECT_NAME'),
-        deployment_name=os.getenv('QA_DEPLOYMENT_NAME')
+        project_name=project_name,
+        deployment_name=deployment_name
     )
     if not output.answers:
         return "None"
@@ -181,6 +317,90 @@ def retrieve_qa(conversation: str, top_k: int, confidence_threshold: float = 0.0
     return "Retrieved historical QA" + qa_pairs
 
 
+@lru_cache(maxsize=1)
+def get_token_encoding() -> Optional[tiktoken.Encoding]:
+    """
+    Get the tokenizer of the embedding models, or None if it cannot be loaded (it is downloaded on first use).
+    """
+    try:
+        return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        logger.warning(f"Could not load the tiktoken encoding, estimating token counts from lengths: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_token_encoding()
+    if encoding is None:
+        return len(text) // 2 + 1  # conservative estimate
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int = EMBEDDING_MAX_INPUT_TOKENS) -> str:
+    encoding = get_token_encoding()
+    if encoding is None:
+        return text[:2 * max_tokens]
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+
+def batch_texts(texts: List[str], max_inputs: int = EMBEDDING_BATCH_SIZE,
+                max_tokens: int = EMBEDDING_BATCH_TOKENS) -> List[List[str]]:
+    """
+    Pack texts into as few embeddings requests as the per-request input and token limits allow.
+    Texts longer than the per-input limit are truncated to it.
+
+    Args:
+        texts (List[str]): The texts to embed.
+        max_inputs (int): The maximum number of inputs per request.
+        max_tokens (int): The maximum number of tokens per request.
+
+    Returns:
+        List[List[str]]: The (truncated) texts, grouped into requests in their original order.
+    """
+    batches, batch, batch_tokens = [], [], 0
+    for text in texts:
+        text = truncate_to_tokens(text)
+        tokens = count_tokens(text)
+        if batch and (len(batch) == max_inputs or batch_tokens + tokens > max_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def embed_texts(texts: List[str], model_name: str, dimensions: Optional[int] = None) -> List[List[float]]:
+    """
+    Generate embeddings for several texts via Azure OpenAI, serving repeated texts from the embedding cache
+    and packing the rest into batched requests.
+
+    Args:
+        texts (List[str]): The input texts to generate embeddings for.
+        model_name (str): The name of the model to use for generating the embeddings.
+        dimensions (Optional[int]): The number of dimensions of the embeddings, if not the model's default.
+
+    Returns:
+        List[List[float]]: The embedding vectors, in the order of the input texts.
+    """
+    cache = get_embedding_cache()
+    keys = [embedding_key(model_name, dimensions, text) for text in texts]
+    vectors = cache.get_many(keys)
+    missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in vectors))
+    extra = {'dimensions': dimensions} if dimensions else {}
+    start = 0
+    for batch in batch_texts(missing):
+        response = get_openai_client().embeddings.create(input=batch, model=model_name, **extra)
+        computed = [(embedding_key(model_name, dimensions, text), item.embedding)
+                    for text, item in zip(missing[start:start + len(batch)], sorted(response.data, key=lambda item: item.index))]
+        cache.put_many(computed)
+        vectors.update(computed)
+        start += len(batch)
+    return [vectors[key] for key in keys]
+
+
 def embed_text(text: str, model_name: str) -> List[float]:
     """
     Generate an embedding for a given text using a specified model via Azure OpenAI.
@@ -192,36 +412,42 @@ def embed_text(text: str, model_name: str) -> List[float]:
     Returns:
         List[float]: A list representing the embedding vector for the input text.
     """
-    client = AzureOpenAI(
-        api_key=os.getenv("OPENAI_KEY"),  
-        api_version="2024-02-01",
-        azure_endpoint=os.getenv("OPENAI_ENDPOINT")
-    )
-    response = client.embeddings.create(input=text, model=model_name)
-    return response.data[0].embedding
+    return embed_texts([text], model_name=model_name)[0]
 
 
-def retrieve_docs_hybrid(text: str, index_name: str, top_k: int, semantic_reranking: bool) -> str:
+def retrieve_docs_hybrid(text: str, index_name: str, top_k: int, semantic_reranking: bool, model_name: str,
+                         retrieval_backend: str = 'azure', local_index_dir: str = 'indexes',
+                         local_index_mmap: bool = False) -> str:
     """
     Retrieve documents using a hybrid search combining text and vector queries.
 
+    With retrieval_backend 'local' (RETRIEVAL_BACKEND=local in the course config), documents are served from
+    the in-process index of the same name under local_index_dir (semantic reranking is not available
+    there) instead of Azure AI Search.
+
     Args:
         text (str): The text query for the search.
         index_name (str): The name of the search index.
         top_k (int): The number of top documents to retrieve.
         semantic_reranking (bool): Whether to use semantic reranking.
+        model_name (str): The embedding model of the vector query.
+        retrieval_backend (str): 'azure' or 'local'. Defaults to 'azure'.
+        local_index_dir (str): The directory of the local indexes. Defaults to 'indexes'.
+        local_index_mmap (bool): Whether to memory-map the local index. Defaults to False.
 
     Returns:
         str: The retrieved documents or an empty string if an error occurs.
     """
     try:
-        search_client = SearchClient(
-            os.getenv("SEARCH_ENDPOINT"), 
-            index_name, 
-            AzureKeyCredential(os.getenv("SEARCH_KEY"))
-        )
+        if retrieval_backend == 'local':
+            index = get_local_index(local_index_dir, index_name, mmap=local_index_mmap)
+            documents = index.search(text, embed_text(text, model_name=model_name), top_k)
+            return "Retrieved course documents" + "".join(
+                f"\n==========================================\n{document}" for document in documents
+            )
+        search_client = get_search_client(index_name)
         vector_query = VectorizedQuery(
-            vector=embed_text(text, model_name=os.getenv("EMBEDDING_MODEL_NAME")),
+            vector=embed_text(text, model_name=model_name),
             k_nearest_neighbors=top_k,
             fields="vector"
         )
@@ -247,23 +473,23 @@ def retrieve_docs_hybrid(text: str, index_name: str, top_k: int, semantic_rerank
         return ''
 
 
-def get_file_names_dir(directory_path: str) -> List[str]:
+def get_file_names_dir(directory_path: str, container_name: str) -> List[str]:
     """
     Retrieve a list of file names from a specified directory within an Azure Blob Storage container.
 
     Args:
         directory_path (str): The path of the directory within the blob storage container.
+        container_name (str): The blob container of the course.
 
     Returns:
         List[str]: A list of file names found in the specified directory.
     """
-    blob_service_client = BlobServiceClient.from_connection_string(os.getenv('AZURE_STORAGE_CONNECTION_STRING'))
-    container_client = blob_service_client.get_container_client(os.getenv('AZURE_BLOB_CONTAINER_NAME'))
+    container_client = get_container_client(container_name)
     blobs_list = container_client.list_blobs(name_starts_with=directory_path)
     return ['/'.join(Path(blob.name).parts[2:]) for blob in blobs_list]
 
 
-def retrieve_docs_manual(question_category: str, category_mapping: dict, question_subcategory: str, subcategory_mapping: dict, question_info: str, get_prompt: Callable[[List, str], List]) -> tuple:
+def retrieve_docs_manual(question_category: str, category_mapping: dict, question_subcategory: str, subcategory_mapping: dict, question_info: str, get_prompt: Callable[[List, str], List], container_name: str) -> tuple:
     """
     Retrieve and return the contents of a specific document from Azure Blob Storage based on a provided question category and information.
 
@@ -274,15 +500,16 @@ def retrieve_docs_manual(question_category: str, category_mapping: dict, questio
         subcategory_mapping (dict): Mapping of subcategories to directory paths.
         question_info (str): The detailed information about the question.
         get_prompt (Callable[[List, str], List]): A function that generates a prompt for selecting a document path.
+        container_name (str): The blob container of the course.
 
     Returns:
         tuple: A tuple containing the problem paths list, selected path, and retrieved document content.
     """
     problem_paths_list = 'none'
     if question_category in category_mapping:
-        problem_paths_list = get_file_names_dir(f'docs_manual/{category_mapping[question_category]}')
+        problem_paths_list = get_file_names_dir(f'docs_manual/{category_mapping[question_category]}', container_name)
     elif question_subcategory in subcategory_mapping:
-        problem_paths_list = get_file_names_dir(f'docs_manual/{subcategory_mapping[question_subcategory]}')
+        problem_paths_list = get_file_names_dir(f'docs_manual/{subcategory_mapping[question_subcategory]}', container_name)
 
     prompt = get_prompt(paths='\n'.join(problem_paths_list),
                         question_info=re.sub(pattern=r"\n+", repl=" ", string=question_info))
@@ -304,8 +531,7 @@ def retrieve_docs_manual(question_category: str, category_mapping: dict, questio
             
     if selected_path != 'none':
         try:
-            blob_service_client = BlobServiceClient.from_connection_string(os.getenv('AZURE_STORAGE_CONNECTION_STRING'))
-            container_client = blob_service_client.get_container_client(os.getenv('AZURE_BLOB_CONTAINER_NAME'))
+            container_client = get_container_client(container_name)
             if question_category in category_mapping:
                 blob_path = f'docs_manual/{category_mapping[question_category]}/{selected_path}'
             elif question_subcategory in subcategory_mapping:
@@ -335,17 +561,17 @@ def log_local(log_dict: Dict[str, Any], file_path: str) -> None:
         f.write('\n')
 
 
-def log_blob(log_dict: Dict[str, Any], blob_name: str) -> None:
+def log_blob(log_dict: Dict[str, Any], blob_name: str, container_name: str) -> None:
     """
     Save a log entry to an Azure Blob Storage append blob.
 
     Args:
         log_dict (Dict[str, Any]): The dictionary containing data to be logged.
         blob_name (str): The name of the blob file where the log entry will be saved.
+        container_name (str): The blob container of the course to log to.
     """
     log_dict['timestamp'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    blob_service_client = BlobServiceClient.from_connection_string(os.getenv('AZURE_STORAGE_CONNECTION_STRING'))
-    container_client = blob_service_client.get_container_client(os.getenv('AZURE_BLOB_CONTAINER_NAME'))
+    container_client = get_container_client(container_name)
     if not container_client.exists():
         container_client.create_container()
     blob_client = container_client.get_blob_client(blob=blob_name)
@@ -431,6 +657,16 @@ def process_markdown(text: str) -> str:
     }[m.group()], text)
 
 
+def get_ed_api_url() -> str:
+    """
+    Get the base URL of the EdStem API (overridable with ED_API_URL, e.g. for local stub servers).
+
+    Returns:
+        str: The base URL of the EdStem API.
+    """
+    return os.getenv('ED_API_URL', 'https://us.edstem.org/api').rstrip('/')
+
+
 def get_edstem_token(course: str) -> str:
     """
     Get the EdStem API token for a given course.
@@ -458,16 +694,20 @@ def delete_comment(course: str, id: str) -> None:
         course (str): The course identifier.
         comment_id (str): The ID of the comment to delete.
     """
-    url = f"https://us.edstem.org/api/comments/{id}"
+    url = f"{get_ed_api_url()}/comments/{id}"
     headers = {
         'Authorization': f'Bearer {get_edstem_token(course)}',
         'Content-Type': 'application/json'
     }
-    response = requests.delete(url, headers=headers)
+    response = get_http_session().delete(url, headers=headers)
     response.raise_for_status()
 
 
-def reply_to_ed(course: str, id: str, text: str, post_answer: bool, private: bool) -> None:
+def get_ed_comment_content(text: str) -> str:
+    return f"<document version=\"2.0\"><paragraph>{process_markdown(text)}</paragraph></document>"
+
+
+def reply_to_ed(course: str, id: str, text: str, post_answer: bool, private: bool) -> Optional[int]:
     """
     Reply to a thread on EdStem for a given course.
 
@@ -477,12 +717,15 @@ def reply_to_ed(course: str, id: str, text: str, post_answer: bool, private: boo
         text (str): The content of the reply.
         post_answer (bool): Whether to post as an answer or a comment.
         private (bool): Whether the reply should be private.
+
+    Returns:
+        Optional[int]: The ID of the posted comment.
     """
-    url = f"https://us.edstem.org/api/{'threads' if post_answer else 'comments'}/{id}/comments"
+    url = f"{get_ed_api_url()}/{'threads' if post_answer else 'comments'}/{id}/comments"
     payload = {
         "comment": {
             "type": "answer" if post_answer else "comment",
-            "content": f"<document version=\"2.0\"><paragraph>{process_markdown(text)}</paragraph></document>",
+            "content": get_ed_comment_content(text),
             "is_private": private,
         }
     }
@@ -490,5 +733,86 @@ def reply_to_ed(course: str, id: str, text: str, post_answer: bool, private: boo
         'Authorization': f'Bearer {get_edstem_token(course)}',
         'Content-Type': 'application/json'
     }
-    response = requests.post(url, headers=headers, json=payload)
+    response = get_http_session().post(url, headers=headers, json=payload)
     response.raise_for_status()
+    return (response.json().get('comment') or {}).get('id')
+
+
+def edit_comment(course: str, id: str, text: str) -> None:
+    """
+    Replace the content of a comment on EdStem for a given course.
+
+    Args:
+        course (str): The course identifier.
+        id (str): The ID of the comment to edit.
+        text (str): The new content of the comment.
+    """
+    headers = {
+        'Authorization': f'Bearer {get_edstem_token(course)}',
+        'Content-Type': 'application/json'
+    }
+    payload = {"comment": {"content": get_ed_comment_content(text)}}
+    response = get_http_session().put(f"{get_ed_api_url()}/comments/{id}", headers=headers, json=payload)
+    response.raise_for_status()
+
+
+class CommentPostedError(Exception):
+    """
+    A streamed response failed after its Ed comment was created; retrying would post it again.
+    """
+
+    def __init__(self, comment_id: Any):
+        super().__init__(f"Streaming failed after posting comment {comment_id}")
+        self.comment_id = comment_id
+
+
+def stream_to_ed(course: str, id: str, chunks: Iterable[str], prefix: str = '',
+                 min_chars: int = 200, edit_interval: float = 2.0) -> str:
+    """
+    Progressively post a streamed response as a private Ed comment.
+
+    The comment is created once min_chars characters have arrived and is then edited at most
+    every edit_interval seconds, with a final edit carrying the complete response. If Ed returns
+    no id for the comment, it is not edited and the complete response is posted once at the end.
+
+    Args:
+        course (str): The course identifier.
+        id (str): The ID of the comment to reply to.
+        chunks (Iterable[str]): The streamed pieces of the response.
+        prefix (str, optional): Text prepended to the comment. Defaults to ''.
+        min_chars (int, optional): Characters to accumulate before the comment is created. Defaults to 200.
+        edit_interval (float, optional): Minimum number of seconds between edits. Defaults to 2.0.
+
+    Returns:
+        str: The complete response.
+
+    Raises:
+        CommentPostedError: If generation or an edit failed after the comment was created.
+    """
+    response = ''
+    posted_text = None  # the text of the comment as last posted or edited
+    comment_id = None
+    last_update = 0.0
+    try:
+        for chunk in chunks:
+            response += chunk
+            if posted_text is None:
+                if len(response) >= min_chars:
+                    comment_id = reply_to_ed(course=course, id=id, text=prefix+response, post_answer=False, private=True)
+                    posted_text, last_update = response, time.monotonic()
+            elif comment_id is not None and time.monotonic() - last_update >= edit_interval:
+                edit_comment(course=course, id=comment_id, text=prefix+response)
+                posted_text, last_update = response, time.monotonic()
+
+        if posted_text is None:
+            reply_to_ed(course=course, id=id, text=prefix+response, post_answer=False, private=True)
+        elif posted_text != response:
+            if comment_id is None:  # Ed returned no id to edit: post the complete response once instead
+                reply_to_ed(course=course, id=id, text=prefix+response, post_answer=False, private=True)
+            else:
+                edit_comment(course=course, id=comment_id, text=prefix+response)
+    except Exception as e:
+        if posted_text is not None:
+            raise CommentPostedError(comment_id) from e
+        raise
+    return response